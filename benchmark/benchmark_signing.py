@@ -0,0 +1,84 @@
+"""Benchmark of the USBL1 request signing
+
+Compares the signatures per second of the original per-request signing algorithm
+with the cached `RequestSigner`, and checks that both produce identical headers.
+"""
+
+import datetime
+import hashlib
+import hmac
+import time
+
+import usabilla as ub
+
+HOST = 'data.usabilla.com'
+URI = '/live/websites/button/42/feedback'
+QUERY = 'limit=100&since=1400000000000'
+
+
+def legacy_sign_request(credentials, canonical_uri, canonical_querystring, t):
+    """The signing algorithm as it was inlined in `APIClient.send_signed_request`."""
+    usbldate = t.strftime('%a, %d %b %Y %H:%M:%S GMT')
+    datestamp = t.strftime('%Y%m%d')
+    long_date = t.strftime('%Y%m%dT%H%M%SZ')
+
+    canonical_headers = 'date:' + usbldate + '\n' + 'host:' + HOST + '\n'
+    signed_headers = 'date;host'
+    payload_hash = hashlib.sha256(''.encode('utf-8')).hexdigest()
+    canonical_request = '{method}\n{uri}\n{query}\n{can_headers}\n{signed_headers}\n{hash}'.format(
+        method='GET',
+        uri=canonical_uri,
+        query=canonical_querystring,
+        can_headers=canonical_headers,
+        signed_headers=signed_headers,
+        hash=payload_hash
+    )
+
+    algorithm = 'USBL1-HMAC-SHA256'
+    credential_scope = datestamp + '/' + 'usbl1_request'
+    string_to_sign = '{algorithm}\n{long_date}\n{credential_scope}\n{digest}'.format(
+        algorithm=algorithm,
+        long_date=long_date,
+        credential_scope=credential_scope,
+        digest=hashlib.sha256(canonical_request.encode('utf-8')).hexdigest(),
+    )
+
+    k_date = hmac.new(('USBL1' + credentials.secret_key).encode('utf-8'), datestamp.encode('utf-8'), hashlib.sha256)
+    signing_key = hmac.new(k_date.digest(), 'usbl1_request'.encode('utf-8'), hashlib.sha256).digest()
+    signature = hmac.new(signing_key, (string_to_sign).encode('utf-8'), hashlib.sha256).hexdigest()
+
+    authorization_header = (
+        '{algorithm} Credential={cred}/{cred_scope}, SignedHeaders={signed_headers}, Signature={signature}'
+    ).format(
+        algorithm=algorithm,
+        cred=credentials.client_key,
+        cred_scope=credential_scope,
+        signed_headers=signed_headers,
+        signature=signature,
+    )
+
+    return {'date': usbldate, 'Authorization': authorization_header}
+
+
+def signatures_per_second(sign, rounds):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        sign()
+    return rounds / (time.perf_counter() - start)
+
+
+if __name__ == '__main__':
+    credentials = ub.Credentials('YOUR-ACCESS-KEY', 'YOUR-SECRET-KEY')
+    signer = ub.RequestSigner(credentials)
+    rounds = 50000
+
+    t = datetime.datetime.utcnow().replace(microsecond=0)
+    assert legacy_sign_request(credentials, URI, QUERY, t) == signer.sign_request(URI, QUERY, HOST, t=t)
+
+    before = signatures_per_second(
+        lambda: legacy_sign_request(credentials, URI, QUERY, datetime.datetime.utcnow()), rounds)
+    after = signatures_per_second(lambda: signer.sign_request(URI, QUERY, HOST), rounds)
+
+    print('legacy signing:  %10.0f signatures/s' % before)
+    print('RequestSigner:   %10.0f signatures/s' % after)
+    print('speedup:         %10.2fx' % (after / before))
@@ -0,0 +1,178 @@
+"""A local stand-in for data.usabilla.com
+
+Serves paginated `items`/`hasMore`/`lastTimestamp` responses for every resource url,
+verifies the USBL1 signature of every request and can inject latency and errors.
+Run it standalone to point a client at it:
+
+    python benchmark/mock_server.py --port 8080 --items 100000
+"""
+
+import argparse
+import email.utils
+import hmac
+import json
+import random
+import threading
+import time
+import urllib.parse
+
+import http.server
+
+import usabilla as ub
+
+
+class MockUsabillaServer(object):
+
+    """A threaded HTTP server that mimics the paginated Usabilla API.
+
+    Every resource url serves the same `items` feedback items, one second apart. `since`
+    is inclusive and `lastTimestamp` is the timestamp of the last item of a page, like
+    the API. The `limit` query parameter sets the page size, `page_size` by default.
+    """
+
+    base_timestamp = 1400000000000
+
+    def __init__(self, client_key='ACCESS-KEY', secret_key='SECRET-KEY', items=10000, page_size=100,
+                 latency=0.0, error_rate=0.0, throttle_rate=0.0, comment_size=200, seed=0, port=0):
+        self.client_key = client_key
+        self.signer = ub.RequestSigner(ub.Credentials(client_key, secret_key))
+        self.items = items
+        self.page_size = page_size
+        self.latency = latency
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.comment = ('lorem ipsum dolor sit amet ' * (comment_size // 27 + 1))[:comment_size]
+        self.random = random.Random(seed)
+        self.requests = 0
+        self.rejected = 0
+        self._lock = threading.Lock()
+
+        server = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+            wbufsize = 65536
+
+            def do_GET(self):
+                status, headers, body = server.handle(self.path, self.headers)
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def host(self):
+        return '127.0.0.1:%d' % self.server.server_address[1]
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, args=(0.05,), daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def client(self, client_class=ub.APIClient, **kwargs):
+        """Create a client of the given class that sends its requests to this server."""
+        client = client_class(self.client_key, self.signer.credentials.secret_key, **kwargs)
+        client.host = self.host
+        client.host_protocol = 'http://'
+        return client
+
+    def item(self, index):
+        timestamp = self.base_timestamp + index * 1000
+        date = time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(timestamp // 1000)) + '.000Z'
+        return {
+            'id': '%024x' % index,
+            'userAgent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15',
+            'comment': self.comment,
+            'location': ['Amsterdam, Netherlands', 'Berlin, Germany', 'New York, United States'][index % 3],
+            'browser': {'name': ['Chrome', 'Firefox', 'Safari'][index % 3], 'version': '120.0'},
+            'date': date,
+            'custom': {'plan': ['free', 'pro'][index % 2]},
+            'data': {'nps': index % 11, 'rating': index % 5 + 1, 'comment': self.comment},
+            'email': '',
+            'image': '',
+            'labels': [],
+            'nps': index % 11,
+            'publicUrl': '',
+            'rating': index % 5 + 1,
+            'buttonId': 'button',
+            'tags': [],
+            'url': 'https://www.example.com/page/%d' % (index % 50),
+        }
+
+    def verify_signature(self, path, query, headers):
+        authorization = headers.get('Authorization', '')
+        try:
+            t = email.utils.parsedate_to_datetime(headers['date'])
+        except (KeyError, TypeError, ValueError):
+            return False
+        expected = self.signer.sign_request(path, query, headers.get('Host', ''), t=t)
+        return hmac.compare_digest(expected['Authorization'], authorization)
+
+    def handle(self, raw_path, headers):
+        with self._lock:
+            self.requests += 1
+            failure = self.random.random()
+
+        path, _, query = raw_path.partition('?')
+        if not self.verify_signature(path, query, headers):
+            with self._lock:
+                self.rejected += 1
+            return 403, {}, json.dumps({'error': 'invalid signature'}).encode('utf-8')
+
+        if self.latency:
+            time.sleep(self.latency)
+        if failure < self.throttle_rate:
+            return 429, {'Retry-After': '0'}, b'{}'
+        if failure < self.throttle_rate + self.error_rate:
+            return 503, {}, b'{}'
+
+        parameters = dict(urllib.parse.parse_qsl(query))
+        since = int(float(parameters.get('since', 0)))
+        return 200, {}, self.page_body(since, int(parameters.get('limit', self.page_size)))
+
+    def page_body(self, since=0, limit=None):
+        """The JSON body of the page of items from `since`, of `limit` items or `page_size`."""
+        start = max(0, -(-(since - self.base_timestamp) // 1000))
+        end = min(self.items, start + (limit or self.page_size))
+        items = [self.item(index) for index in range(start, end)]
+        last_timestamp = self.base_timestamp + (end - 1) * 1000 if items else since
+        body = {'items': items, 'count': len(items), 'hasMore': end < self.items, 'lastTimestamp': last_timestamp}
+        return json.dumps(body).encode('utf-8')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--items', type=int, default=10000)
+    parser.add_argument('--page-size', type=int, default=100)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every response')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of 503 responses')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='fraction of 429 responses')
+    arguments = parser.parse_args()
+
+    server = MockUsabillaServer(
+        items=arguments.items, page_size=arguments.page_size, latency=arguments.latency,
+        error_rate=arguments.error_rate, throttle_rate=arguments.throttle_rate, port=arguments.port)
+    print('Serving on http://%s with client key ACCESS-KEY and secret key SECRET-KEY' % server.host)
+    server.server.serve_forever()
@@ -0,0 +1,340 @@
+"""Benchmark suite of the Usabilla API client
+
+Runs the client against a local `MockUsabillaServer` and reports throughput, latency
+percentiles and peak memory of its request paths, and the cost of signing. It does not
+need network access:
+
+    PYTHONPATH=. python benchmark/run_benchmarks.py --quick --json results.json
+
+With `--baseline`, the throughput of every benchmark is compared to an earlier `--json`
+report and the run fails when one dropped by more than `--tolerance`. With `--relative`,
+the throughput of every benchmark is first divided by that of its reference benchmark in
+`REFERENCES`, such as `signing` by `legacy signing`, so a baseline of another machine can
+be used: CI compares quick runs to `benchmark/baseline.json` this way.
+"""
+
+import argparse
+import concurrent.futures
+import datetime
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+import usabilla as ub
+
+from benchmark_signing import legacy_sign_request
+from mock_server import MockUsabillaServer
+
+# The benchmark every benchmark is measured against with `--relative`, both run on the same machine.
+REFERENCES = {
+    'signing': 'legacy signing',
+    'get_resource x8 threads': 'get_resource',
+    'get_resource x8 threads coalesce': 'get_resource',
+    'item_iterator prefetch=4': 'item_iterator',
+    'item_iterator metrics': 'item_iterator',
+    'item_iterator stream': 'item_iterator',
+    'item_iterator tuned': 'item_iterator',
+    'campaign_result_batches': 'item_iterator',
+    'raw_page_iterator': 'item_iterator',
+    'hold items as RecordBatch': 'hold items as dicts',
+    'get_resources_for_ids x8': 'item_iterator',
+    'get_resources_for_ids threads': 'item_iterator',
+    'get_resources_for_ids processes': 'item_iterator',
+    'backfill windows=8': 'item_iterator',
+    'ClientPool 4 accounts x2': 'item_iterator',
+    'decode orjson': 'decode json',
+    'decode ujson': 'decode json',
+    'decode simplejson': 'decode json',
+    'FeedbackAggregator': 'hold items as dicts',
+}
+
+
+class Benchmarks(object):
+
+    def __init__(self, server, items, requests):
+        self.server = server
+        self.items = items
+        self.requests = requests
+        self.client = server.client(pool_maxsize=32)
+
+    def signing(self):
+        signer = ub.RequestSigner(ub.Credentials('ACCESS-KEY', 'SECRET-KEY'))
+        rounds = self.requests * 100
+        start = time.perf_counter()
+        for _ in range(rounds):
+            signer.sign_request('/live/websites/button/42/feedback', 'limit=100&since=1400000000000', self.server.host)
+        return {'operations': rounds, 'seconds': time.perf_counter() - start}
+
+    def legacy_signing(self):
+        credentials = ub.Credentials('ACCESS-KEY', 'SECRET-KEY')
+        rounds = self.requests * 100
+        start = time.perf_counter()
+        for _ in range(rounds):
+            legacy_sign_request(credentials, '/live/websites/button/42/feedback', 'limit=100&since=1400000000000',
+                                datetime.datetime.utcnow())
+        return {'operations': rounds, 'seconds': time.perf_counter() - start}
+
+    def get_resource(self):
+        latencies = []
+        for _ in range(self.requests):
+            start = time.perf_counter()
+            self.client.get_resource('live', 'websites', 'button', query_parameters={'limit': 10})
+            latencies.append(time.perf_counter() - start)
+        return {'operations': self.requests, 'seconds': sum(latencies), 'latencies': latencies}
+
+    def concurrent_get_resource(self, **kwargs):
+        def run():
+            client = self.server.client(pool_maxsize=8, **kwargs)
+            with concurrent.futures.ThreadPoolExecutor(8) as executor:
+                calls = [executor.submit(client.get_resource, 'live', 'websites', 'button')
+                         for _ in range(self.requests * 8)]
+                for call in calls:
+                    call.result()
+            client.close()
+            return len(calls)
+        return run
+
+    def item_iterator(self, **kwargs):
+        def run():
+            count = 0
+            for _ in self.client.get_resource('live', 'websites', 'feedback', '*', iterate=True, **kwargs):
+                count += 1
+            return count
+        return run
+
+    def campaign_result_batches(self):
+        schema = {'fields': [{'name': 'nps', 'type': 'nps'}, {'name': 'rating', 'type': 'rating'}]}
+        batches = self.client.get_campaign_result_batches(
+            'live', 'apps', '*', ['date', 'data.nps', 'data.rating'], batch_size=1000, schema=schema)
+        return sum(len(batch) for batch in batches)
+
+    def hold_items(self, compact):
+        def run():
+            items = self.client.get_resource('live', 'websites', 'feedback', '*', iterate=True)
+            held = ub.RecordBatch.from_items(items) if compact else list(items)
+            return len(held)
+        return run
+
+    def aggregate(self):
+        aggregator = ub.FeedbackAggregator(values=['rating', 'nps'], group_by='url', interval=3600)
+        for page in self.client.page_iterator('/live/websites/button/%2A/feedback'):
+            aggregator.update(page['items'])
+        return int(aggregator.counts.sum())
+
+    def tuned_item_iterator(self):
+        tuner = ub.PageSizeTuner(minimum=50, maximum=1000)
+        return self.item_iterator(tuner=tuner)()
+
+    def item_iterator_with_metrics(self):
+        metrics = ub.MetricsAggregator()
+        self.client.add_hook(metrics)
+        try:
+            return self.item_iterator()()
+        finally:
+            self.client.remove_hook(metrics)
+
+    def raw_page_iterator(self):
+        with open(os.devnull, 'wb') as target:
+            pages = self.client.raw_page_iterator('/live/websites/button/%2A/feedback', target)
+            return sum(page['count'] for page in pages)
+
+    def get_resources_for_ids(self, client=None):
+        count = 0
+        ids = ['button-%d' % i for i in range(8)]
+        for _ in (client or self.client).get_resources_for_ids('live', 'websites', 'feedback', ids, max_workers=8):
+            count += 1
+        return count
+
+    def decode(self, decoder):
+        body = self.server.page_body()
+        page = json.loads(body)
+        rounds = max(1, self.items // len(page['items']))
+
+        def run():
+            for _ in range(rounds):
+                decoder(body)
+            return rounds * len(page['items'])
+        return run
+
+    def get_resources_for_ids_decoded(self, executor_class):
+        def run():
+            with executor_class(4) as executor:
+                client = self.server.client(pool_maxsize=32, decode_executor=executor)
+                try:
+                    return self.get_resources_for_ids(client)
+                finally:
+                    client.close()
+        return run
+
+    def backfill(self):
+        until = self.server.base_timestamp + self.items * 1000
+        items = self.client.backfill(
+            'live', 'websites', 'feedback', '*', since=self.server.base_timestamp, until=until, windows=8)
+        return sum(1 for _ in items)
+
+    def client_pool(self):
+        credentials = (self.server.client_key, self.server.signer.credentials.secret_key)
+        with ub.ClientPool(dict(('account-%d' % i, credentials) for i in range(4)), max_workers=8) as pool:
+            for client in pool.clients.values():
+                client.host, client.host_protocol = self.server.host, 'http://'
+            for account in pool.clients:
+                for button in range(2):
+                    pool.submit(account, 'live', 'websites', 'feedback', 'button-%d' % button)
+            return sum(1 for _ in pool.run())
+
+    def async_item_iterator(self):
+        import asyncio
+
+        async def run():
+            async with self.server.client(ub.AsyncAPIClient, max_concurrency=8) as client:
+                ids = ['button-%d' % i for i in range(8)]
+
+                async def count(resource_id):
+                    iterator = client.get_resource('live', 'websites', 'feedback', resource_id, iterate=True)
+                    return sum([1 async for _ in iterator])
+
+                return sum(await asyncio.gather(*[count(resource_id) for resource_id in ids]))
+
+        return asyncio.run(run())
+
+    def suite(self):
+        suite = [
+            ('signing', self.signing, False),
+            ('legacy signing', self.legacy_signing, False),
+            ('get_resource', self.get_resource, False),
+            ('get_resource x8 threads', self.concurrent_get_resource(), True),
+            ('get_resource x8 threads coalesce', self.concurrent_get_resource(coalesce=True), True),
+            ('item_iterator', self.item_iterator(), True),
+            ('item_iterator prefetch=4', self.item_iterator(prefetch=4), True),
+            ('item_iterator metrics', self.item_iterator_with_metrics, True),
+            ('item_iterator stream', self.item_iterator(stream=True), True),
+            ('item_iterator tuned', self.tuned_item_iterator, True),
+            ('campaign_result_batches', self.campaign_result_batches, True),
+            ('raw_page_iterator', self.raw_page_iterator, True),
+            ('hold items as dicts', self.hold_items(False), True),
+            ('hold items as RecordBatch', self.hold_items(True), True),
+            ('get_resources_for_ids x8', self.get_resources_for_ids, True),
+            ('backfill windows=8', self.backfill, True),
+            ('ClientPool 4 accounts x2', self.client_pool, True),
+        ]
+        for backend in ('orjson', 'ujson', 'simplejson', 'json'):
+            try:
+                decoder = ub.get_json_decoder(backend)
+            except ub.GeneralError:
+                continue
+            suite.append(('decode %s' % backend, self.decode(decoder), True))
+        suite.append(('get_resources_for_ids threads', self.get_resources_for_ids_decoded(
+            concurrent.futures.ThreadPoolExecutor), True))
+        suite.append(('get_resources_for_ids processes', self.get_resources_for_ids_decoded(
+            concurrent.futures.ProcessPoolExecutor), True))
+        if ub.numpy is not None:
+            suite.append(('FeedbackAggregator', self.aggregate, True))
+        if ub.aiohttp is not None:
+            suite.append(('AsyncAPIClient x8', self.async_item_iterator, True))
+        return suite
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+
+def measure(benchmark, counts_items):
+    start = time.perf_counter()
+    result = benchmark()
+    seconds = time.perf_counter() - start
+
+    # Tracing allocations slows everything down, so peak memory is measured in a second run.
+    tracemalloc.start()
+    benchmark()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    if counts_items:
+        result = {'operations': result, 'seconds': seconds}
+    report = {
+        'operations': result['operations'],
+        'seconds': result['seconds'],
+        'per_second': result['operations'] / result['seconds'],
+        'peak_memory': peak,
+    }
+    if 'latencies' in result:
+        for name, fraction in [('p50', 0.5), ('p90', 0.9), ('p99', 0.99)]:
+            report[name] = percentile(result['latencies'], fraction)
+    return report
+
+
+def print_report(reports):
+    print('%-32s %12s %10s %14s %9s %9s %9s %11s' % (
+        'benchmark', 'operations', 'seconds', 'per second', 'p50 ms', 'p90 ms', 'p99 ms', 'peak KiB'))
+    for name, report in reports.items():
+        latencies = ['%9.2f' % (report[p] * 1000) if p in report else '%9s' % '-' for p in ('p50', 'p90', 'p99')]
+        print('%-32s %12d %10.3f %14.0f %s %11.0f' % (
+            name, report['operations'], report['seconds'], report['per_second'], ' '.join(latencies),
+            report['peak_memory'] / 1024.0))
+
+
+def compare(reports, baseline, tolerance, relative=False):
+    regressions = []
+    for name, report in reports.items():
+        if name not in baseline:
+            continue
+        if not relative:
+            if report['per_second'] < baseline[name]['per_second'] * (1 - tolerance):
+                regressions.append('%s: %.0f/s, baseline %.0f/s' % (
+                    name, report['per_second'], baseline[name]['per_second']))
+            continue
+        reference = REFERENCES.get(name)
+        if reference not in reports or reference not in baseline:
+            continue
+        ratio = report['per_second'] / reports[reference]['per_second']
+        expected = baseline[name]['per_second'] / baseline[reference]['per_second']
+        if ratio < expected * (1 - tolerance):
+            regressions.append('%s: %.2fx %s, baseline %.2fx' % (name, ratio, reference, expected))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--items', type=int, default=20000, help='items per feed')
+    parser.add_argument('--requests', type=int, default=200, help='requests of the get_resource benchmark')
+    parser.add_argument('--page-size', type=int, default=100)
+    parser.add_argument('--latency', type=float, default=0.005, help='seconds added to every response')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of 503 responses')
+    parser.add_argument('--quick', action='store_true', help='a short run for CI')
+    parser.add_argument('--only', help='only run the benchmarks whose name contains this text')
+    parser.add_argument('--json', help='write the report to this file')
+    parser.add_argument('--baseline', help='fail when slower than the report in this file')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed throughput drop, 0.25 is 25%%')
+    parser.add_argument('--relative', action='store_true',
+                        help='compare the throughput relative to a reference benchmark of the same run, '
+                             'for baselines of other machines')
+    arguments = parser.parse_args()
+
+    if arguments.quick:
+        arguments.items, arguments.requests = 2000, 50
+
+    reports = {}
+    with MockUsabillaServer(items=arguments.items, page_size=arguments.page_size, latency=arguments.latency,
+                            error_rate=arguments.error_rate) as server:
+        benchmarks = Benchmarks(server, arguments.items, arguments.requests)
+        if arguments.error_rate:
+            benchmarks.client.retry_policy = ub.RetryPolicy(max_retries=10, backoff_factor=0.01)
+        for name, benchmark, counts_items in benchmarks.suite():
+            if arguments.only and arguments.only not in name:
+                continue
+            reports[name] = measure(benchmark, counts_items)
+        if server.rejected:
+            sys.exit('The mock server rejected %d requests with an invalid signature.' % server.rejected)
+
+    print_report(reports)
+    if arguments.json:
+        with open(arguments.json, 'w') as f:
+            json.dump(reports, f, indent=2, sort_keys=True)
+    if arguments.baseline:
+        with open(arguments.baseline) as f:
+            regressions = compare(reports, json.load(f), arguments.tolerance, arguments.relative)
+        if regressions:
+            sys.exit('Throughput regressions:\n' + '\n'.join(regressions))
@@ -15,6 +15,11 @@ if __name__ == '__main__':
     feedback_items = api.get_resource(api.SCOPE_LIVE, api.PRODUCT_WEBSITES, api.RESOURCE_FEEDBACK, first_button['id'], iterate=True)
     print len([item for item in feedback_items])
 
+    # Get the feedback items of all buttons, eight buttons at a time
+    button_ids = [button['id'] for button in buttons['items']]
+    for button_id, item in api.get_resources_for_ids(api.SCOPE_LIVE, api.PRODUCT_WEBSITES, api.RESOURCE_FEEDBACK, button_ids, max_workers=8):
+        print(button_id, item['id'])
+
     # ---------------------------------------
     # Get all campaigns for this account
     campaigns = api.get_resource(api.SCOPE_LIVE, api.PRODUCT_WEBSITES, api.RESOURCE_CAMPAIGN)
@@ -11,8 +11,16 @@ setup(
     description="Python client for Usabilla API",
     license='MIT',
     install_requires=['requests'],
+    extras_require={
+        'async': ['aiohttp'],
+        'numpy': ['numpy'],
+        'parquet': ['pyarrow'],
+    },
     packages=find_packages(),
     py_modules=['usabilla'],
+    entry_points={
+        'console_scripts': ['usabilla-export = usabilla:main'],
+    },
     author='Usabilla',
     author_email='development@usabilla.com',
     url='https://github.com/usabilla/api-python',
@@ -1,10 +1,31 @@
+import asyncio
+import concurrent.futures
+import csv
+import datetime
+import email.utils
+import gzip
+import io
+import json
 import logging
-from unittest.mock import call
+import math
+import os
+import shutil
+import tempfile
+import threading
+import http.server
+import time
+from collections import OrderedDict
+from unittest.mock import call, patch
 import requests
 import usabilla as ub
 
-from mock import Mock
-from unittest import TestCase, main as unittest_main
+from mock import AsyncMock, Mock
+from unittest import IsolatedAsyncioTestCase, TestCase, main as unittest_main, skipIf
+
+try:
+    from aiohttp import web
+except ImportError:
+    web = None
 
 
 logging.basicConfig(level=logging.DEBUG)
@@ -51,6 +72,1037 @@ class TestGeneralError(TestCase):
         self.assertEqual(repr(self.error), 'GeneralError(type=type)')
 
 
+class TestRequestSigner(TestCase):
+
+    def setUp(self):
+        self.signer = ub.RequestSigner(ub.Credentials('ACCESS-KEY', 'SECRET-KEY'))
+        self.t = datetime.datetime(2015, 1, 15, 10, 11, 12)
+
+    def test_sign_request(self):
+        headers = self.signer.sign_request(
+            '/live/websites/button', 'limit=10&since=1400000000000', 'data.usabilla.com', t=self.t)
+        self.assertEqual(headers, {
+            'date': 'Thu, 15 Jan 2015 10:11:12 GMT',
+            'Authorization': 'USBL1-HMAC-SHA256 Credential=ACCESS-KEY/20150115/usbl1_request, '
+                             'SignedHeaders=date;host, '
+                             'Signature=33622c4f5080d41e841bbcbe93ca17e1de5f9a92c6d09fde488b61326902ab0b'
+        })
+
+    def test_get_signing_key_matches_client(self):
+        client = ub.APIClient('ACCESS-KEY', 'SECRET-KEY')
+        self.assertEqual(
+            self.signer.get_signing_key('20150115'),
+            client.get_signature_key('SECRET-KEY', '20150115'))
+
+    def test_get_signing_key_is_cached_per_datestamp(self):
+        key = self.signer.get_signing_key('20150115')
+        self.assertIs(self.signer.get_signing_key('20150115'), key)
+        self.assertNotEqual(self.signer.get_signing_key('20150116'), key)
+
+    def test_get_dates(self):
+        self.assertEqual(
+            self.signer.get_dates(self.t),
+            ('Thu, 15 Jan 2015 10:11:12 GMT', '20150115', '20150115T101112Z'))
+        t = datetime.datetime(2015, 2, 1, 0, 0, 0)
+        self.assertEqual(
+            self.signer.get_dates(t),
+            (t.strftime('%a, %d %b %Y %H:%M:%S GMT'), t.strftime('%Y%m%d'), t.strftime('%Y%m%dT%H%M%SZ')))
+
+    def test_sign_batch(self):
+        batch = self.signer.sign_batch([('/live/websites/button', ''), ('/live/websites/campaign', '')],
+                                       'data.usabilla.com', t=self.t)
+        self.assertEqual(len(batch), 2)
+        self.assertEqual(batch[0], self.signer.sign_request('/live/websites/button', '', 'data.usabilla.com', t=self.t))
+        self.assertNotEqual(batch[0]['Authorization'], batch[1]['Authorization'])
+
+
+class TestReadAhead(TestCase):
+
+    def test_read_ahead(self):
+        self.assertEqual(list(ub.read_ahead(iter(range(10)), 3)), list(range(10)))
+        with self.assertRaises(ub.GeneralError):
+            list(ub.read_ahead([], 0))
+
+    def test_read_ahead_is_bounded(self):
+        produced = []
+
+        def values():
+            for i in range(100):
+                produced.append(i)
+                yield i
+
+        iterator = ub.read_ahead(values(), 2)
+        self.assertEqual(next(iterator), 0)
+        time.sleep(0.05)
+        # One value consumed, two buffered and one waiting to be buffered.
+        self.assertLessEqual(len(produced), 4)
+        iterator.close()
+
+
+class StubServer(object):
+
+    """A local HTTP server that answers with scripted `(status, headers, body)` responses."""
+
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.requests = []
+        stub = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                stub.requests.append((self.path, dict(self.headers)))
+                status, headers, body = stub.responses.pop(0)
+                body = json.dumps(body).encode('utf-8')
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever, args=(0.05,), daemon=True)
+        self.thread.start()
+
+    @property
+    def host(self):
+        return '127.0.0.1:%d' % self.server.server_address[1]
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class TestRetryPolicy(TestCase):
+
+    def test_should_retry(self):
+        policy = ub.RetryPolicy(max_retries=2)
+        self.assertTrue(policy.should_retry(0, 429))
+        self.assertTrue(policy.should_retry(1, 503))
+        self.assertTrue(policy.should_retry(1))
+        self.assertFalse(policy.should_retry(2, 503))
+        self.assertFalse(policy.should_retry(0, 404))
+        self.assertFalse(ub.RetryPolicy(retry_connection_errors=False).should_retry(0))
+
+    def test_get_backoff(self):
+        policy = ub.RetryPolicy(backoff_factor=1, max_backoff=5)
+        for attempt in range(6):
+            self.assertTrue(0 <= policy.get_backoff(attempt) <= min(5, 2 ** attempt))
+        self.assertEqual(policy.get_backoff(0, '3'), 3)
+        self.assertEqual(policy.get_backoff(0, '120'), 120)
+        retry_at = email.utils.formatdate(time.time() + 2, usegmt=True)
+        self.assertTrue(0 < policy.get_backoff(0, retry_at) <= 2)
+        self.assertTrue(0 <= policy.get_backoff(0, 'soon') <= 1)
+
+
+class TestRateLimiter(TestCase):
+
+    def test_reserve(self):
+        limiter = ub.RateLimiter(10, burst=2)
+        self.assertEqual(limiter.reserve(), 0)
+        self.assertEqual(limiter.reserve(), 0)
+        self.assertAlmostEqual(limiter.reserve(), 0.1, places=2)
+        self.assertAlmostEqual(limiter.reserve(), 0.2, places=2)
+
+    def test_pause(self):
+        limiter = ub.RateLimiter(10)
+        limiter.pause(1)
+        self.assertAlmostEqual(limiter.reserve(), 1.1, places=2)
+
+    def test_pause_after_a_long_request(self):
+        with patch('usabilla.time.monotonic', return_value=100.0):
+            limiter = ub.RateLimiter(1)
+            limiter.acquire()
+        with patch('usabilla.time.monotonic', return_value=102.0):
+            limiter.pause(1.5)
+            self.assertAlmostEqual(limiter.get_delay(), 2.5)
+            self.assertAlmostEqual(limiter.reserve(), 2.5)
+
+    def test_acquire_is_shared_between_threads(self):
+        limiter = ub.RateLimiter(200, burst=1)
+        start = time.monotonic()
+        threads = [threading.Thread(target=lambda: [limiter.acquire() for _ in range(5)]) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertGreaterEqual(time.monotonic() - start, 19 / 200.0)
+
+    def test_invalid_rate(self):
+        with self.assertRaises(ub.GeneralError):
+            ub.RateLimiter(0)
+
+
+class TestClientRetries(TestCase):
+
+    def setUp(self):
+        self.page = {'hasMore': False, 'items': [1], 'lastTimestamp': 1}
+
+    def _client(self, responses, **kwargs):
+        self.server = StubServer(responses)
+        self.addCleanup(self.server.close)
+        client = ub.APIClient('ACCESS-KEY', 'SECRET-KEY', **kwargs)
+        client.host = self.server.host
+        client.host_protocol = 'http://'
+        return client
+
+    def test_retries_and_resigns(self):
+        client = self._client(
+            [(503, {}, {}), (429, {'Retry-After': '0'}, {}), (200, {}, self.page)],
+            retry_policy=ub.RetryPolicy(backoff_factor=0.01))
+        client.signer.get_dates = Mock(side_effect=[
+            ('Thu, 15 Jan 2015 10:11:1%d GMT' % i, '20150115', '20150115T10111%dZ' % i) for i in range(3)])
+
+        self.assertEqual(client.send_signed_request('/live/websites/button'), self.page)
+        self.assertEqual(len(self.server.requests), 3)
+        signatures = set(headers['Authorization'] for _, headers in self.server.requests)
+        self.assertEqual(len(signatures), 3)
+
+    def test_gives_up_after_max_retries(self):
+        client = self._client([(500, {}, {})] * 3, retry_policy=ub.RetryPolicy(max_retries=2, backoff_factor=0.01))
+        with self.assertRaises(requests.exceptions.HTTPError):
+            client.send_signed_request('/live/websites/button')
+        self.assertEqual(len(self.server.requests), 3)
+
+    def test_no_retries_by_default(self):
+        client = self._client([(503, {}, {})])
+        with self.assertRaises(requests.exceptions.HTTPError):
+            client.send_signed_request('/live/websites/button')
+
+    def test_does_not_retry_client_errors(self):
+        client = self._client([(404, {}, {})], retry_policy=ub.RetryPolicy())
+        with self.assertRaises(requests.exceptions.HTTPError):
+            client.send_signed_request('/live/websites/button')
+
+    def test_too_many_requests_pauses_rate_limiter(self):
+        limiter = ub.RateLimiter(1000)
+        limiter.pause = Mock()
+        client = self._client(
+            [(429, {'Retry-After': '0.05'}, {}), (200, {}, self.page)],
+            retry_policy=ub.RetryPolicy(), rate_limiter=limiter)
+        self.assertEqual(client.send_signed_request('/live/websites/button'), self.page)
+        limiter.pause.assert_called_once_with(0.05)
+
+    def test_hooks(self):
+        pages = [{'hasMore': True, 'items': [1], 'lastTimestamp': 1}, self.page]
+        client = self._client(
+            [(200, {}, pages[0]), (502, {}, {}), (200, {}, pages[1])],
+            retry_policy=ub.RetryPolicy(backoff_factor=0.01))
+        events = []
+        metrics = ub.MetricsAggregator()
+        client.add_hook(events.append)
+        client.add_hook(metrics)
+
+        self.assertEqual(list(client.item_iterator('/live/websites/button')), [1, 1])
+        self.assertEqual([event['type'] for event in events], ['request', 'page', 'request', 'request', 'page'])
+        first_request, first_page, retried, retry, second_page = events
+        self.assertEqual(sorted(first_request['timings']), ['decode', 'download', 'response', 'sign'])
+        self.assertEqual(first_request['bytes'], len(json.dumps(pages[0])))
+        self.assertEqual((retried['status'], retried['error'], retry['attempt']), (502, 'HTTPError', 1))
+        self.assertEqual(second_page['cursor'], 1)
+        self.assertEqual(metrics.snapshot()['counters']['retries'], 1)
+
+        client.remove_hook(events.append)
+        client.remove_hook(metrics)
+        self.assertEqual(client.hooks, [])
+
+    def test_hooks_on_error(self):
+        client = self._client([(404, {}, {})])
+        events = []
+        client.add_hook(events.append)
+        with self.assertRaises(requests.exceptions.HTTPError):
+            client.send_signed_request('/live/websites/button')
+        self.assertEqual((events[0]['status'], events[0]['error']), (404, 'HTTPError'))
+
+    def test_item_iterator_stream(self):
+        pages = [{'items': [1, {'id': 2}], 'hasMore': True, 'lastTimestamp': 7}, self.page]
+        client = self._client([(200, {}, pages[0]), (200, {}, pages[1])])
+        events = []
+        client.add_hook(events.append)
+
+        items = list(client.get_resource('live', 'websites', 'button', iterate=True, stream=True))
+        self.assertEqual(items, [1, {'id': 2}, 1])
+        self.assertEqual([path for path, _ in self.server.requests],
+                         ['/live/websites/button', '/live/websites/button?since=7'])
+        self.assertEqual([event['items'] for event in events if event['type'] == 'page'], [2, 1])
+
+        with self.assertRaises(ub.GeneralError):
+            client.item_iterator('/live/websites/button', prefetch=2, stream=True)
+        with self.assertRaises(ub.GeneralError):
+            client.get_resource('live', 'websites', 'button', iterate=True, prefetch=2, stream=True)
+
+    def test_item_iterator_stream_drops_boundary_duplicates(self):
+        items = [{'id': i, 'date': '2015-01-01T00:00:0%d.000Z' % (i // 2)} for i in range(4)]
+        pages = [{'items': items[:2], 'hasMore': True, 'lastTimestamp': 1420070400000},
+                 {'items': items, 'hasMore': False, 'lastTimestamp': 1420070401000}]
+        client = self._client([(200, {}, pages[0]), (200, {}, pages[1])])
+        metrics = ub.MetricsAggregator()
+        client.add_hook(metrics)
+
+        self.assertEqual(list(client.item_iterator('/live/websites/button', stream=True)), items)
+        self.assertEqual(client.dropped_duplicates, 2)
+        self.assertEqual(metrics.snapshot()['counters']['duplicates'], 2)
+
+    def test_item_iterator_survives_transient_errors(self):
+        pages = [{'hasMore': True, 'items': [1], 'lastTimestamp': 1}, self.page]
+        client = self._client(
+            [(200, {}, pages[0]), (502, {}, {}), (200, {}, pages[1])],
+            retry_policy=ub.RetryPolicy(backoff_factor=0.01))
+        self.assertEqual(list(client.item_iterator('/live/websites/button')), [1, 1])
+        self.assertEqual([path for path, _ in self.server.requests],
+                         ['/live/websites/button', '/live/websites/button?since=1', '/live/websites/button?since=1'])
+
+
+    def test_export_raw(self):
+        pages = [{'items': [1, 2], 'hasMore': True, 'lastTimestamp': 7}, {'items': [3], 'hasMore': False, 'lastTimestamp': 9}]
+        client = self._client([(200, {}, pages[0]), (200, {}, pages[1])])
+        target = io.BytesIO()
+        result = client.export_raw(target, 'live', 'websites', 'button', query_parameters={'limit': 2})
+        self.assertEqual(result, {'pages': 2, 'bytes': len(target.getvalue()) - 2, 'lastTimestamp': 9})
+        self.assertEqual([json.loads(line) for line in target.getvalue().splitlines()], pages)
+        self.assertEqual([path for path, _ in self.server.requests],
+                         ['/live/websites/button?limit=2', '/live/websites/button?limit=2&since=7'])
+
+    def test_raw_page_iterator_requires_paging_fields(self):
+        client = self._client([(200, {}, {'items': []})])
+        with self.assertRaises(ub.GeneralError):
+            list(client.raw_page_iterator('/live/websites/button', io.BytesIO()))
+
+    def test_item_iterator_tunes_page_size(self):
+        items = [{'id': i} for i in range(10)]
+        pages = [{'items': items[:2], 'hasMore': True, 'lastTimestamp': 1},
+                 {'items': items[2:6], 'hasMore': True, 'lastTimestamp': 2},
+                 {'items': items[6:], 'hasMore': False, 'lastTimestamp': 3}]
+        client = self._client([(200, {}, page) for page in pages])
+        tuner = ub.PageSizeTuner(minimum=2, maximum=8, factor=2)
+        limits = iter([4, 8, 8])
+
+        def observe(items, seconds, size):
+            tuner.limit = next(limits)
+
+        tuner.observe = Mock(side_effect=observe)
+
+        self.assertEqual(list(client.item_iterator('/live/websites/button', tuner=tuner)), items)
+        self.assertEqual([path for path, _ in self.server.requests], [
+            '/live/websites/button?limit=2', '/live/websites/button?limit=4&since=1',
+            '/live/websites/button?limit=8&since=2'])
+        self.assertEqual([c[0][0] for c in tuner.observe.call_args_list], [2, 4, 4])
+        self.assertEqual([c[0][2] for c in tuner.observe.call_args_list],
+                         [len(json.dumps(page)) for page in pages])
+
+    def test_coalesce(self):
+        client = self._client([(200, {}, self.page)], coalesce=True)
+        send = client._send
+        deadline = time.time() + 5
+
+        def send_when_shared(*args):
+            while client.single_flight.shared < 3 and time.time() < deadline:
+                time.sleep(0.001)
+            return send(*args)
+
+        client._send = send_when_shared
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(client.send_signed_request('/live/websites/button')))
+                   for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, [self.page] * 4)
+        self.assertEqual(len(self.server.requests), 1)
+        self.assertEqual(len(set(id(result) for result in results)), 4)
+        self.assertIsNone(ub.APIClient('ACCESS-KEY', 'SECRET-KEY').single_flight)
+
+    def test_json_decoder(self):
+        decoder = Mock(side_effect=json.loads)
+        client = self._client([(200, {}, self.page)], json_decoder=decoder)
+        self.assertEqual(client.send_signed_request('/live/websites/button'), self.page)
+        decoder.assert_called_once_with(json.dumps(self.page).encode('utf-8'))
+
+    def test_decode_executor(self):
+        with concurrent.futures.ThreadPoolExecutor(1) as executor:
+            client = self._client([(200, {}, self.page)], json_decoder='json', decode_executor=executor)
+            self.assertEqual(client.send_signed_request('/live/websites/button'), self.page)
+
+    def test_hook_added_while_signing(self):
+        client = self._client([(200, {}, self.page), (200, {}, self.page)])
+        sign_request = client.signer.sign_request
+        events = []
+
+        def add_hook_and_sign(*args):
+            client.add_hook(events.append)
+            return sign_request(*args)
+
+        client.signer.sign_request = add_hook_and_sign
+        self.assertEqual(client.send_signed_request('/live/websites/button'), self.page)
+        self.assertEqual(events, [])
+        client.signer.sign_request = sign_request
+        client.send_signed_request('/live/websites/button')
+        self.assertEqual([event['status'] for event in events], [200])
+
+    def test_decodes_a_page_while_the_next_is_requested(self):
+        pages = [{'items': [{'id': 1}], 'hasMore': True, 'lastTimestamp': 1},
+                 {'hasMore': True, 'lastTimestamp': 2, 'items': [{'id': 2, 'lastTimestamp': 7}]},
+                 {'items': [{'id': 3}], 'hasMore': False, 'lastTimestamp': 3}]
+        requested = []
+
+        def decoder(body):
+            page = json.loads(body)
+            # Only returns once the page after it was requested, or fails the test.
+            deadline = time.time() + 5
+            while page['hasMore'] and len(self.server.requests) <= len(requested) + 1 and time.time() < deadline:
+                time.sleep(0.001)
+            requested.append(len(self.server.requests))
+            return page
+
+        with concurrent.futures.ThreadPoolExecutor(1) as executor:
+            client = self._client([(200, {}, page) for page in pages] + [(200, {}, pages[2])],
+                                  json_decoder=decoder, decode_executor=executor)
+            items = list(client.item_iterator('/live/websites/button'))
+        self.assertEqual([item['id'] for item in items], [1, 2, 3])
+        self.assertEqual(requested[:2], [2, 3])
+        # The cursor of an item in the second page is requested ahead, then dropped.
+        self.assertEqual([path for path, _ in self.server.requests], [
+            '/live/websites/button', '/live/websites/button?since=1', '/live/websites/button?since=7',
+            '/live/websites/button?since=2'])
+
+
+    def test_decoded_ahead_pages_before_an_error(self):
+        with concurrent.futures.ThreadPoolExecutor(1) as executor:
+            client = self._client([(200, {}, {'items': [1], 'hasMore': True, 'lastTimestamp': 1}), (500, {}, {})],
+                                  decode_executor=executor)
+            items = client.item_iterator('/live/websites/button')
+            self.assertEqual(next(items), 1)
+            with self.assertRaises(requests.exceptions.HTTPError):
+                next(items)
+            self.assertEqual(len(self.server.requests), 2)
+
+
+class TestGetJsonDecoder(TestCase):
+
+    def test_get_json_decoder(self):
+        self.assertIs(ub.get_json_decoder('json'), json.loads)
+        self.assertEqual(ub.get_json_decoder()(b'{"items": [1]}'), {'items': [1]})
+
+    def test_missing_backend(self):
+        with self.assertRaises(ub.GeneralError):
+            ub.get_json_decoder('no_such_json_backend')
+
+
+class CheckpointStoreTests(object):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.store = self.create_store()
+        self.key = ('live', 'websites', 'feedback', '42')
+
+    def test_cursors(self):
+        self.assertIsNone(self.store.get_cursor(self.key))
+        self.store.set_cursor(self.key, 1400000000001)
+        self.store.set_cursor(('live', 'websites', 'button', None), 5)
+        self.assertEqual(self.store.get_cursor(self.key), 1400000000001)
+        self.assertEqual(self.create_store().get_cursor(self.key), 1400000000001)
+        self.store.delete_cursor(self.key)
+        self.assertIsNone(self.store.get_cursor(self.key))
+        self.assertEqual(self.store.get_cursor(('live', 'websites', 'button', None)), 5)
+
+
+class TestFileCheckpointStore(CheckpointStoreTests, TestCase):
+
+    def create_store(self):
+        return ub.FileCheckpointStore(os.path.join(self.directory, 'checkpoints.json'))
+
+
+class TestSQLiteCheckpointStore(CheckpointStoreTests, TestCase):
+
+    def create_store(self):
+        return ub.SQLiteCheckpointStore(os.path.join(self.directory, 'checkpoints.db'))
+
+
+class TestLeaseStore(TestCase):
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.path = os.path.join(directory, 'leases.db')
+        self.store = ub.LeaseStore(self.path, lease_seconds=60, max_attempts=2)
+
+    def test_add_shards(self):
+        self.assertEqual(self.store.add_shards('live', 'websites', 'feedback', ['a', 'b'], since=0, until=300,
+                                               windows={'b': 3}), 4)
+        self.assertEqual(self.store.add_shards('live', 'websites', 'feedback', ['a', '*'], since=0, until=300), 1)
+
+        jobs = [self.store.claim('worker') for _ in range(5)]
+        self.assertEqual((jobs[0]['since'], jobs[0]['until']), (0, 300))
+        self.assertEqual([job['shard'] for job in jobs], [
+            'live-websites-feedback-a-0-300', 'live-websites-feedback-b-0-100', 'live-websites-feedback-b-100-200',
+            'live-websites-feedback-b-200-300', 'live-websites-feedback-_-0-300'])
+        self.assertIsNone(self.store.claim('worker'))
+
+    def test_claims_every_shard_once(self):
+        self.store.add_shards('live', 'websites', 'feedback', range(40))
+        claims = []
+
+        def work(owner):
+            store = ub.LeaseStore(self.path)
+            job = store.claim(owner)
+            while job is not None:
+                claims.append(job['shard'])
+                store.complete(job['shard'], owner)
+                job = store.claim(owner)
+
+        threads = [threading.Thread(target=work, args=('worker-%d' % i,)) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(sorted(claims), sorted(set(claims)))
+        self.assertEqual(len(claims), 40)
+        self.assertEqual(self.store.stats()['done'], 40)
+
+    def test_expired_lease_is_taken_over(self):
+        self.store.add_shards('live', 'websites', 'feedback', ['a'])
+        shard = self.store.claim('first')['shard']
+        self.assertIsNone(self.store.claim('second'))
+        self.assertTrue(self.store.renew(shard, 'first'))
+        self.assertFalse(self.store.renew(shard, 'second'))
+
+        with patch('usabilla.time.time', return_value=time.time() + 61):
+            self.assertEqual(self.store.claim('second')['shard'], shard)
+        self.assertFalse(self.store.complete(shard, 'first', {'items': 1}))
+        self.assertTrue(self.store.complete(shard, 'second', {'items': 2}))
+        self.assertEqual(self.store.get_results(), {shard: {'items': 2}})
+
+    def test_expired_leases_are_given_up_after_max_attempts(self):
+        self.store.add_shards('live', 'websites', 'feedback', ['a'])
+        later = time.time()
+        for _ in range(2):
+            later += 61
+            with patch('usabilla.time.time', return_value=later):
+                self.assertIsNotNone(self.store.claim('crashing'))
+        with patch('usabilla.time.time', return_value=later + 61):
+            self.assertIsNone(self.store.claim('worker'))
+        self.assertEqual(self.store.stats()['failed'], 1)
+
+    def test_release_gives_up_after_max_attempts(self):
+        self.store.add_shards('live', 'websites', 'feedback', ['a'])
+        for state in ['pending', 'failed']:
+            shard = self.store.claim('worker')['shard']
+            self.assertTrue(self.store.release(shard, 'worker', 'mocked error'))
+            self.assertEqual(self.store.stats()[state], 1)
+        self.assertIsNone(self.store.claim('worker'))
+
+
+class TestSQLiteMirror(TestCase):
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.mirror = ub.SQLiteMirror(os.path.join(directory, 'mirror.db'))
+        self.key = ('live', 'websites', 'feedback', '*')
+
+    def test_store_and_query(self):
+        items = [{'id': 'a', 'date': '2015-01-01T00:00:00.000Z', 'buttonId': 'x', 'rating': 2},
+                 {'id': 'b', 'date': '2015-01-02T00:00:00.000Z', 'buttonId': 'x', 'rating': 5},
+                 {'id': 'c', 'date': '2015-01-03T00:00:00.000Z', 'buttonId': 'y', 'rating': 1}]
+        self.assertEqual(self.mirror.store(self.key, items), 3)
+        self.assertEqual(self.mirror.store(self.key, [dict(items[0], rating=1)]), 1)
+
+        self.assertEqual(self.mirror.get_newest_timestamp(self.key), 1420243200000)
+        self.assertIsNone(self.mirror.get_newest_timestamp(('live', 'apps', 'feedback', None)))
+        self.assertEqual(self.mirror.query(self.key, where='buttonId = ? AND rating < ?', parameters=('x', 3)),
+                         [dict(items[0], rating=1)])
+        self.assertEqual([item['id'] for item in self.mirror.query(since=1420156800000)], ['b', 'c'])
+        self.assertEqual([item['id'] for item in self.mirror.query(order_by='timestamp DESC', limit=1)], ['c'])
+        self.assertEqual(self.mirror.query(where="json_extract(data, '$.id') = 'b'")[0]['rating'], 5)
+
+    def test_requires_ids(self):
+        with self.assertRaises(ub.GeneralError):
+            self.mirror.store(self.key, [{'rating': 1}])
+
+
+class TestColumnBatch(TestCase):
+
+    def test_get_schema_field_types(self):
+        schema = {'fields': [{'name': 'nps', 'type': 'nps'}, {'id': 'comment', 'type': 'text'}, {'type': 'mood'}]}
+        self.assertEqual(ub.get_schema_field_types(schema), {'data.nps': 'number', 'data.comment': 'object'})
+        self.assertEqual(ub.get_schema_field_types({'items': [{'name': 'mood', 'type': 'mood'}]}),
+                         {'data.mood': 'number'})
+
+    def test_append(self):
+        batch = ub.ColumnBatch(['id', 'data.nps', 'data.comment'], {'data.nps': 'number'})
+        batch.append({'id': 'a', 'data': {'nps': 9, 'comment': 'good', 'other': 1}})
+        batch.append({'id': 'b', 'data': {'nps': 'n/a'}})
+        batch.append({'id': 'c'})
+
+        self.assertEqual(len(batch), 3)
+        self.assertEqual(batch.columns['data.nps'].typecode, 'd')
+        self.assertEqual(batch.columns['data.nps'][0], 9.0)
+        self.assertTrue(all(math.isnan(value) for value in batch.columns['data.nps'][1:]))
+        self.assertEqual(batch.columns['data.comment'], ['good', None, None])
+        self.assertEqual(batch.rows()[0], ('a', 9.0, 'good'))
+
+
+class TestRecordBatch(TestCase):
+
+    items = [
+        {'id': 'a', 'date': '2020-01-01T10:00:00.000Z', 'url': 'https://example.com/', 'rating': 5,
+         'browser': {'name': 'Firefox'}, 'labels': [], 'comment': 'good'},
+        {'id': 'b', 'date': '2020-01-01T11:00:00.000Z', 'url': 'https://example.com/', 'rating': 1,
+         'browser': {'name': 'Firefox'}, 'labels': ['[]'], 'nps': None, 'extra': {'x': 1}},
+        {'id': 'c', 'location': '[]'},
+    ]
+
+    def test_round_trip(self):
+        batch = ub.RecordBatch.from_items(json.loads(json.dumps(self.items)))
+        self.assertEqual(len(batch), 3)
+        self.assertEqual(list(batch), self.items)
+        self.assertEqual(batch[-1], self.items[2])
+        self.assertEqual(batch[1:], self.items[1:])
+        self.assertEqual(batch.column('rating'), [5, 1, None])
+        with self.assertRaises(IndexError):
+            batch[3]
+
+    def test_shares_repeated_values(self):
+        batch = ub.RecordBatch.from_items(json.loads(json.dumps(self.items)))
+        self.assertIs(batch.columns['url'][0], batch.columns['url'][1])
+        self.assertIs(batch.columns['browser'][0], batch.columns['browser'][1])
+        self.assertEqual(list(batch.extra), [1])
+
+    def test_resource_fields(self):
+        batch = ub.RecordBatch('campaign_result')
+        batch.append({'id': 'a', 'data': {'nps': 9}, 'customData': {}})
+        self.assertEqual(batch[0], {'id': 'a', 'data': {'nps': 9}, 'customData': {}})
+        self.assertEqual(batch.extra, {})
+        with self.assertRaises(ub.GeneralError):
+            ub.RecordBatch('button')
+        self.assertEqual(ub.RecordBatch('button', fields=['id']).fields, ['id'])
+
+
+@skipIf(ub.numpy is None, 'numpy is not installed')
+class TestFeedbackAggregator(TestCase):
+
+    items = [
+        {'url': 'a', 'rating': 5, 'date': '2020-01-01T10:00:00.000Z', 'data': {'nps': 10}},
+        {'url': 'a', 'rating': 3, 'date': '2020-01-01T12:00:00.000Z', 'data': {'nps': 2}},
+        {'url': 'a', 'rating': 1, 'date': '2020-01-02T10:00:00.000Z'},
+        {'url': None, 'rating': 'n/a', 'date': '2020-01-02T10:00:00.000Z', 'data': {'nps': 8}},
+    ]
+
+    def test_totals(self):
+        aggregator = ub.FeedbackAggregator(values=['rating', 'data.nps'])
+        self.assertEqual(aggregator.update(self.items), 4)
+
+        result = aggregator.results()[None]
+        self.assertEqual(result['count'], 4)
+        self.assertEqual(dict(result['rating']), {'count': 3, 'mean': 3.0, 'p50': 3.0, 'p90': 5.0})
+        self.assertEqual(result['data.nps']['count'], 3)
+        self.assertAlmostEqual(result['data.nps']['nps'], 0.0)
+
+    def test_groups_and_time_buckets(self):
+        aggregator = ub.FeedbackAggregator(group_by='url', interval=86400, batch_size=3)
+        aggregator.update(self.items)
+
+        day = 1577836800000
+        results = aggregator.results()
+        self.assertEqual(list(results), [('', day + 86400000), ('a', day), ('a', day + 86400000)])
+        self.assertEqual(results[('a', day)]['rating']['mean'], 4.0)
+        self.assertTrue(math.isnan(results[('', day + 86400000)]['rating']['mean']))
+
+    def test_columns(self):
+        dates = ['2020-01-01T10:00:00.250Z', '2020-01-01T12:00:00+02:00', None, 'invalid']
+        self.assertEqual(ub.FeedbackAggregator.get_timestamp_column(dates[:1] + dates[2:3]).tolist(),
+                         [1577872800250, 0])
+        self.assertEqual(ub.FeedbackAggregator.get_timestamp_column(dates).tolist(),
+                         [1577872800250, 1577872800000, 0, 0])
+        self.assertEqual(ub.FeedbackAggregator.get_group_column([3, 1]).tolist(), ['3', '1'])
+        self.assertEqual(ub.FeedbackAggregator.get_group_column(['a', None, 2]).tolist(), ['a', '', '2'])
+
+    def test_incremental_updates(self):
+        aggregator = ub.FeedbackAggregator(group_by='url')
+        for item in self.items:
+            aggregator.update([item])
+        aggregator.update([{'url': 'b', 'rating': 4}])
+
+        results = aggregator.results()
+        self.assertEqual([result['count'] for result in results.values()], [1, 3, 1])
+        self.assertEqual(results['a']['rating']['mean'], 3.0)
+        self.assertEqual(results['b']['rating']['p90'], 4.0)
+
+    def test_add_batch(self):
+        aggregator = ub.FeedbackAggregator(values=['data.nps'])
+        batch = ub.ColumnBatch(['data.nps'], {'data.nps': 'number'})
+        for nps in [0, 6, 9, 10, 11]:
+            batch.append({'data': {'nps': nps}})
+        aggregator.add_batch(batch)
+
+        # The score out of the scale counts toward the mean, not the NPS.
+        self.assertEqual(aggregator.results()[None]['data.nps']['count'], 5)
+        self.assertAlmostEqual(aggregator.results()[None]['data.nps']['mean'], 7.2)
+        self.assertAlmostEqual(aggregator.results()[None]['data.nps']['nps'], 0.0)
+
+    def test_means_of_fractional_scores(self):
+        aggregator = ub.FeedbackAggregator(values=['data.mood'], scale=5)
+        aggregator.update([{'data': {'mood': 3.5}}, {'data': {'mood': 4.5}}, {'data': {'mood': 'n/a'}}])
+
+        result = aggregator.results()[None]['data.mood']
+        self.assertEqual((result['count'], result['mean'], result['p50'], result['p90']), (2, 4.0, 3.0, 4.0))
+
+
+class TestBoundaryFilter(TestCase):
+
+    @staticmethod
+    def _item(item_id, second):
+        return {'id': item_id, 'date': '2015-01-01T00:00:0%d.000Z' % second}
+
+    def _page(self, boundary, items, cursor):
+        accepted = [item['id'] for item in items if boundary.accept(item)]
+        boundary.end_page(cursor)
+        return accepted
+
+    def test_drops_items_repeated_at_the_boundary(self):
+        boundary = ub.BoundaryFilter()
+        cursor = 1420070402000
+        self.assertEqual(self._page(boundary, [self._item('a', 1), self._item('b', 2), self._item('c', 2)], cursor),
+                         ['a', 'b', 'c'])
+        self.assertEqual(boundary.seen, {'b', 'c'})
+        self.assertEqual(self._page(boundary, [self._item('b', 2), self._item('c', 2), self._item('d', 3)],
+                                    cursor + 1000), ['d'])
+        self.assertEqual((boundary.seen, boundary.dropped), ({'d'}, 2))
+
+    def test_pages_of_a_single_timestamp(self):
+        boundary = ub.BoundaryFilter()
+        cursor = 1420070405000
+        self._page(boundary, [self._item('a', 5), self._item('b', 5)], cursor)
+        self.assertEqual(self._page(boundary, [self._item('a', 5), self._item('b', 5), self._item('c', 5)], cursor),
+                         ['c'])
+        self.assertEqual(self._page(boundary, [self._item(i, 5) for i in 'abc'] + [self._item('d', 6)], cursor + 1000),
+                         ['d'])
+        self.assertEqual(boundary.dropped, 5)
+
+    def test_keeps_items_without_id(self):
+        boundary = ub.BoundaryFilter()
+        self.assertTrue(boundary.accept(1))
+        self.assertTrue(boundary.accept({'date': 'x'}))
+        boundary.end_page(1)
+        self.assertTrue(boundary.accept({'date': 'x'}))
+
+
+class TestPageSizeTuner(TestCase):
+
+    def test_climbs_while_throughput_improves(self):
+        tuner = ub.PageSizeTuner(minimum=100, maximum=1000, factor=2)
+        self.assertEqual(tuner.observe(100, 0.2), 200)
+        self.assertEqual(tuner.observe(200, 0.2), 400)
+        # Slower per item, turn around.
+        self.assertEqual(tuner.observe(400, 0.8), 200)
+        self.assertEqual(tuner.observe(200, 0.25), 100)
+        self.assertEqual(tuner.observe(100, 0.2), 200)
+        self.assertEqual([limit for limit, _, _, _ in tuner.history], [100, 200, 400, 200, 100])
+
+    def test_bounds(self):
+        tuner = ub.PageSizeTuner(minimum=100, maximum=300, factor=2, max_page_bytes=10000)
+        self.assertEqual(tuner.observe(100, 0.1), 200)
+        self.assertEqual(tuner.observe(200, 0.1), 300)
+        # Responses of 50 bytes per item, at most 200 items fit.
+        self.assertEqual(tuner.observe(300, 0.1, 15000), 200)
+        # A short last page does not change the direction.
+        self.assertEqual(tuner.observe(10, 10.0), 200)
+
+    def test_invalid_bounds(self):
+        with self.assertRaises(ub.GeneralError):
+            ub.PageSizeTuner(minimum=100, maximum=50)
+        with self.assertRaises(ub.GeneralError):
+            ub.PageSizeTuner(factor=1)
+
+
+class TestSingleFlight(TestCase):
+
+    def _run_concurrently(self, threads, result=None, error=None):
+        """Call `do` on `threads` threads, the call runs until all of them joined it."""
+        single_flight = ub.SingleFlight()
+        calls, results = [], []
+        deadline = time.time() + 5
+
+        def function():
+            calls.append(1)
+            while single_flight.shared < threads - 1 and time.time() < deadline:
+                time.sleep(0.001)
+            if error is not None:
+                raise error
+            return result
+
+        def call():
+            try:
+                results.append(single_flight.do('key', function))
+            except Exception as e:
+                results.append(e)
+
+        workers = [threading.Thread(target=call) for _ in range(threads)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        return single_flight, calls, results
+
+    def test_shares_the_result(self):
+        single_flight, calls, results = self._run_concurrently(4, result={'items': []})
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [{'items': []}] * 4)
+        self.assertEqual(single_flight.shared, 3)
+        self.assertEqual(single_flight._calls, {})
+
+    def test_shares_the_error(self):
+        error = requests.exceptions.HTTPError('mocked error')
+        _, calls, results = self._run_concurrently(3, error=error)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [error] * 3)
+
+    def test_does_not_keep_results(self):
+        single_flight = ub.SingleFlight()
+        self.assertEqual(single_flight.do('key', lambda: 1), 1)
+        self.assertEqual(single_flight.do('key', lambda: 2), 2)
+
+
+class CacheBackendTests(object):
+
+    def test_get_and_set(self):
+        backend = self.create_backend(max_entries=10)
+        self.assertIsNone(backend.get('/live/websites/button?'))
+        self.assertEqual(backend.set('/live/websites/button?', (1.5, '{}')), 0)
+        self.assertEqual(tuple(backend.get('/live/websites/button?')), (1.5, '{}'))
+        self.assertEqual(backend.keys(), ['/live/websites/button?'])
+        backend.delete('/live/websites/button?')
+        self.assertIsNone(backend.get('/live/websites/button?'))
+
+    def test_evicts_least_recently_used(self):
+        backend = self.create_backend(max_entries=2)
+        backend.set('a', (1, '1'))
+        time.sleep(0.01)
+        backend.set('b', (1, '2'))
+        time.sleep(0.01)
+        backend.get('a')
+        time.sleep(0.01)
+        self.assertEqual(backend.set('c', (1, '3')), 1)
+        self.assertEqual(sorted(backend.keys()), ['a', 'c'])
+
+
+class TestMemoryCacheBackend(CacheBackendTests, TestCase):
+
+    def create_backend(self, max_entries):
+        return ub.MemoryCacheBackend(max_entries)
+
+
+class TestDiskCacheBackend(CacheBackendTests, TestCase):
+
+    def create_backend(self, max_entries):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        return ub.DiskCacheBackend(os.path.join(directory, 'cache'), max_entries)
+
+
+class TestResponseCache(TestCase):
+
+    def setUp(self):
+        self.cache = ub.ResponseCache(ttls={'button': 60}, default_ttl=None)
+
+    def test_get_ttl(self):
+        self.assertEqual(self.cache.get_ttl('button'), 60)
+        self.assertIsNone(self.cache.get_ttl('feedback'))
+        self.assertEqual(ub.ResponseCache().get_ttl('campaign_result_schema'), 300)
+
+    def test_expiry_and_stats(self):
+        self.assertIsNone(self.cache.get('key'))
+        self.cache.set('key', {'items': [1]}, 60)
+        self.assertEqual(self.cache.get('key'), {'items': [1]})
+        self.cache.set('expired', {'items': [2]}, -1)
+        self.assertIsNone(self.cache.get('expired'))
+        self.assertEqual(self.cache.stats(), {'hits': 1, 'misses': 2, 'evictions': 0, 'entries': 1})
+
+    def test_returns_copies(self):
+        self.cache.set('key', {'items': [1]}, 60)
+        self.cache.get('key')['items'].append(2)
+        self.assertEqual(self.cache.get('key'), {'items': [1]})
+
+    def test_invalidate(self):
+        self.cache.set('/live/websites/button?', {}, 60)
+        self.cache.set('/live/websites/button?limit=1', {}, 60)
+        self.cache.set('/live/websites/campaign?', {}, 60)
+        self.assertEqual(self.cache.invalidate('/live/websites/button?'), 2)
+        self.assertEqual(self.cache.backend.keys(), ['/live/websites/campaign?'])
+        self.assertEqual(self.cache.invalidate(), 1)
+
+
+class TestMetricsAggregator(TestCase):
+
+    def setUp(self):
+        self.metrics = ub.MetricsAggregator(buckets=(0.01, 0.1))
+
+    def request_event(self, attempt=0, status=200, error=None):
+        return {
+            'type': 'request', 'url': '/live/websites/button', 'query': '', 'attempt': attempt,
+            'status': status, 'error': error, 'bytes': 100,
+            'timings': {'sign': 0.001, 'response': 0.05, 'download': 0.004, 'decode': 0.5},
+        }
+
+    def test_aggregates_events(self):
+        self.metrics(self.request_event(status=503, error='HTTPError'))
+        self.metrics(self.request_event(attempt=1))
+        self.metrics({'type': 'page', 'url': '/live/websites/button', 'items': 10, 'has_more': True, 'cursor': 5,
+                      'duplicates': 2})
+
+        snapshot = self.metrics.snapshot()
+        self.assertEqual(dict(snapshot['counters']), {
+            'requests': 2, 'errors': 1, 'retries': 1, 'response_bytes': 200, 'pages': 1, 'items': 10,
+            'duplicates': 2})
+        self.assertEqual(snapshot['statuses'], {200: 1, 503: 1})
+        self.assertEqual(snapshot['cursors'], {'/live/websites/button': 5})
+        self.assertEqual(list(snapshot['histograms']['response']['buckets'].values()), [0, 2, 2])
+        self.assertEqual(list(snapshot['histograms']['decode']['buckets'].values()), [0, 0, 2])
+        self.assertEqual(snapshot['histograms']['total']['count'], 2)
+
+        self.metrics.reset()
+        self.assertEqual(self.metrics.snapshot()['counters']['requests'], 0)
+
+    def test_render_prometheus(self):
+        self.metrics(self.request_event())
+        text = self.metrics.render_prometheus()
+        self.assertIn('usabilla_client_requests_total 1\n', text)
+        self.assertIn('usabilla_client_responses_total{status="200"} 1\n', text)
+        self.assertIn('usabilla_client_request_seconds_bucket{phase="sign",le="0.01"} 1\n', text)
+        self.assertIn('usabilla_client_request_seconds_bucket{phase="decode",le="+Inf"} 1\n', text)
+
+
+class TestStreamItems(TestCase):
+
+    def test_stream_items(self):
+        document = {
+            'count': 3, 'items': [{'comment': 'caf\u00e9 "quoted"', 'rating': 12345}, [1, 2.5e3], 'text', None],
+            'hasMore': True, 'lastTimestamp': 1400000000001,
+        }
+        body = json.dumps(document, ensure_ascii=False).encode('utf-8')
+        for size in (1, 2, 7, len(body)):
+            page = {}
+            items = list(ub.stream_items([body[i:i + size] for i in range(0, len(body), size)], page))
+            self.assertEqual(items, document['items'])
+            self.assertEqual(page, {'count': 3, 'hasMore': True, 'lastTimestamp': 1400000000001})
+
+    def test_numbers_split_between_chunks(self):
+        body = b'{"items": [12, -3.5e2, 7], "count": 2.25, "lastTimestamp": 1e3}'
+        for split in range(1, len(body)):
+            page = {}
+            self.assertEqual(list(ub.stream_items([body[:split], body[split:]], page)), [12, -350.0, 7])
+            self.assertEqual(page, {'count': 2.25, 'lastTimestamp': 1000.0})
+
+    def test_yields_items_before_the_page_is_complete(self):
+        page = {}
+        items = ub.stream_items(iter([b'{"hasMore": false, "items": [{"id": 1}, ', b'{"id"']), page)
+        self.assertEqual(next(items), {'id': 1})
+        self.assertEqual(page, {'hasMore': False})
+        with self.assertRaises(ValueError):
+            next(items)
+
+    def test_empty_pages(self):
+        page = {}
+        self.assertEqual(list(ub.stream_items([b' {"items": [], "hasMore": false} '], page)), [])
+        self.assertEqual(page, {'hasMore': False})
+        self.assertEqual(list(ub.stream_items([b'{}'], {})), [])
+
+    def test_invalid_json(self):
+        for body in [b'[]', b'{"items": [1 2]}', b'{"items": [1]} x', b'']:
+            with self.assertRaises(ValueError):
+                list(ub.stream_items([body], {}))
+
+
+class TestCopyPage(TestCase):
+
+    def test_copy_page(self):
+        body = json.dumps({'items': [{'comment': 'hasMore'}] * 3, 'count': 3, 'hasMore': True,
+                           'lastTimestamp': 1400000000123}).encode('utf-8')
+        for size in range(1, len(body) + 1):
+            target, page = io.BytesIO(), {}
+            chunks = [body[i:i + size] for i in range(0, len(body), size)]
+            self.assertEqual(ub.copy_page(chunks, target, page), len(body))
+            self.assertEqual(target.getvalue(), body)
+            self.assertEqual(page, {'count': 3, 'hasMore': True, 'lastTimestamp': 1400000000123})
+
+
+class TestExportWriters(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.items = [{'id': i, 'browser': {'name': 'Chrome'}, 'labels': ['a']} for i in range(5)]
+
+    def test_flatten_item(self):
+        self.assertEqual(ub.flatten_item(self.items[0]), {'id': 0, 'browser.name': 'Chrome', 'labels': '["a"]'})
+
+    def test_ndjson_rotates_and_compresses(self):
+        with ub.NDJSONWriter(os.path.join(self.directory, 'feedback.ndjson'), compression='gzip',
+                             batch_size=2, max_items=2) as writer:
+            for item in self.items:
+                writer.write(item)
+            self.assertEqual(len(writer.files), 2)
+        self.assertEqual([os.path.basename(path) for path in writer.files],
+                         ['feedback-00001.ndjson.gz', 'feedback-00002.ndjson.gz', 'feedback-00003.ndjson.gz'])
+        lines = []
+        for path in writer.files:
+            with gzip.open(path, 'rt') as f:
+                lines.extend(json.loads(line) for line in f)
+        self.assertEqual(lines, self.items)
+        self.assertEqual(writer.items, 5)
+        self.assertEqual(writer.bytes, sum(len(json.dumps(item)) + 1 for item in self.items))
+
+    def test_rotates_after_max_items_across_batches(self):
+        with ub.NDJSONWriter(os.path.join(self.directory, 'feedback.ndjson'), batch_size=3, max_items=10) as writer:
+            for i in range(20):
+                writer.write({'id': i})
+        counts = []
+        for path in writer.files:
+            with open(path) as f:
+                counts.append(len(f.readlines()))
+        self.assertEqual(counts, [10, 10])
+
+    def test_csv_writes_a_header_per_file(self):
+        path = os.path.join(self.directory, 'feedback-{part}.csv')
+        with ub.CSVWriter(path, max_items=3) as writer:
+            for item in self.items:
+                writer.write(item)
+        rows = []
+        for path in writer.files:
+            with open(path, newline='') as f:
+                rows.extend(csv.DictReader(f))
+        self.assertEqual([os.path.basename(path) for path in writer.files], ['feedback-1.csv', 'feedback-2.csv'])
+        self.assertEqual(rows[4], {'id': '4', 'browser.name': 'Chrome', 'labels': '["a"]'})
+
+    @skipIf(ub.pyarrow is None, 'pyarrow is not installed')
+    def test_parquet(self):
+        with ub.ParquetWriter(os.path.join(self.directory, 'feedback.parquet'), batch_size=2) as writer:
+            for item in self.items:
+                writer.write(item)
+        table = ub.pyarrow.parquet.read_table(writer.files[0])
+        self.assertEqual(table.column('browser.name').to_pylist(), ['Chrome'] * 5)
+
+        # The tables of batches are sliced where the files rotate.
+        with ub.ParquetWriter(os.path.join(self.directory, 'feedback-{part}.parquet'), batch_size=3,
+                              max_items=4) as writer:
+            for i in range(10):
+                writer.write({'id': i})
+        self.assertEqual([ub.pyarrow.parquet.read_table(path).column('id').to_pylist() for path in writer.files],
+                         [[0, 1, 2, 3], [4, 5, 6, 7], [8, 9]])
+
+    def test_invalid_options(self):
+        path = os.path.join(self.directory, 'feedback.ndjson')
+        with self.assertRaises(ub.GeneralError):
+            ub.NDJSONWriter(path, compression='zip')
+        with self.assertRaises(ub.GeneralError):
+            ub.NDJSONWriter(path, batch_size=0)
+
+
 class TestClient(TestCase):
 
     def setUp(self):
@@ -134,7 +1186,7 @@ class TestClient(TestCase):
         items = ['one', 'two', 'three', 'four']
         has_more = {'hasMore': True, 'items': items[:2], 'lastTimestamp': 1400000000001}
         no_more = {'hasMore': False, 'items': items[2:], 'lastTimestamp': 1400000000002}
-        expected_set_query_parameters_calls = [ call({'since': 1400000000001}), call({'since': 1400000000002}), call({}) ]
+        expected_send_signed_request_calls = [call('/some/url', {}), call('/some/url', {'since': 1400000000001})]
 
         self.client.set_query_parameters = Mock()
         self.client.send_signed_request = Mock(side_effect=[has_more, no_more])
@@ -144,39 +1196,771 @@ class TestClient(TestCase):
             self.assertEqual(item, items[index])
             index += 1
 
-        self.assertEqual(self.client.set_query_parameters.call_args_list, expected_set_query_parameters_calls)
-        self.assertEqual(self.client.send_signed_request.call_count, 2)
+        self.assertEqual(self.client.send_signed_request.call_args_list, expected_send_signed_request_calls)
+        self.assertEqual(self.client.set_query_parameters.call_count, 0)
 
         self.client.send_signed_request.side_effect = requests.exceptions.HTTPError('mocked error')
         with self.assertRaises(requests.exceptions.HTTPError):
             list(self.client.item_iterator('/some/url'))
 
-    def test_item_iterator_resets_query_parameters_after_returning_all_items(self):
+    def test_item_iterator_keeps_query_parameters_per_iteration(self):
         first_response = {'hasMore': True, 'items': [1], 'lastTimestamp': 1400000000001}
         second_response = {'hasMore': False, 'items': [2], 'lastTimestamp': 1400000000002}
         third_response = {'hasMore': False, 'items': [3], 'lastTimestamp': 1400000000003}
 
         self.client.send_signed_request = Mock(side_effect=[first_response, second_response, third_response])
+        self.client.set_query_parameters({'limit': 1})
 
-        expected_query_parameters = ['', 'since=1400000000001', '']
-
-        index = 0
         for response in [self.client.item_iterator('/some/url'), self.client.item_iterator('/some/url')]:
             for _ in response:
-                self.assertEqual(expected_query_parameters[index], self.client.get_query_parameters())
-                index+=1
+                self.assertEqual('limit=1', self.client.get_query_parameters())
 
-        self.assertEqual(self.client.send_signed_request.call_count, 3)
+        self.assertEqual(self.client.send_signed_request.call_args_list, [
+            call('/some/url', {'limit': '1'}),
+            call('/some/url', {'limit': '1', 'since': 1400000000001}),
+            call('/some/url', {'limit': '1'}),
+        ])
+
+    def test_item_iterator_with_query_parameters(self):
+        self.client.send_signed_request = Mock(
+            return_value={'hasMore': False, 'items': [1], 'lastTimestamp': 1400000000001})
+        self.client.set_query_parameters({'limit': 1})
+        self.assertEqual(list(self.client.item_iterator('/some/url', query_parameters={'limit': 5})), [1])
+        self.client.send_signed_request.assert_called_once_with('/some/url', {'limit': 5})
+
+    def test_send_signed_request(self):
+        response = Mock()
+        response.json.return_value = {'items': []}
+        self.client = ub.APIClient('ACCESS-KEY', 'SECRET-KEY', timeout=5, keep_alive=False)
+        self.client.session = Mock()
+        self.client.session.get.return_value = response
+        self.client.set_query_parameters({'limit': 1})
+
+        self.assertEqual(self.client.send_signed_request('/live/websites/button'), {'items': []})
+        self.client.send_signed_request('/live/websites/button', {'since': 2, 'limit': 5})
+
+        first, second = self.client.session.get.call_args_list
+        self.assertEqual(first[0][0], 'https://data.usabilla.com/live/websites/button?limit=1')
+        self.assertEqual(second[0][0], 'https://data.usabilla.com/live/websites/button?limit=5&since=2')
+        self.assertEqual(second[1]['timeout'], 5)
+        self.assertEqual(second[1]['headers']['Connection'], 'close')
+
+    def test_session_per_client(self):
+        client = ub.APIClient('ACCESS-KEY', 'SECRET-KEY', pool_maxsize=32)
+        self.assertIsNot(client.session, ub.APIClient('ACCESS-KEY', 'SECRET-KEY').session)
+        self.assertEqual(client.session.get_adapter('https://data.usabilla.com')._pool_maxsize, 32)
+        session = requests.Session()
+        self.assertIs(ub.APIClient('ACCESS-KEY', 'SECRET-KEY', session=session).session, session)
+
+    def test_concurrent_iterations(self):
+        def send_signed_request(url, query_parameters):
+            since = query_parameters.get('since', 0)
+            time.sleep(0.001)
+            return {'hasMore': since < 20, 'items': [(url, since)], 'lastTimestamp': since + 1}
+
+        self.client.send_signed_request = Mock(side_effect=send_signed_request)
+        results = {}
+
+        def iterate(url):
+            results[url] = list(self.client.item_iterator(url))
+
+        threads = [threading.Thread(target=iterate, args=('/url/%d' % i,)) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for i in range(8):
+            self.assertEqual(results['/url/%d' % i], [('/url/%d' % i, since) for since in range(21)])
+
+    def test_item_iterator_prefetch(self):
+        pages = [{'hasMore': True, 'items': [i], 'lastTimestamp': i} for i in range(5)]
+        pages[-1]['hasMore'] = False
+        self.client.send_signed_request = Mock(side_effect=pages)
+
+        self.assertEqual(list(self.client.item_iterator('/some/url', prefetch=2)), [0, 1, 2, 3, 4])
+        self.assertEqual(self.client.send_signed_request.call_count, 5)
+        self.assertEqual(self.client.get_query_parameters(), '')
+
+    def test_item_iterator_prefetch_raises_in_order(self):
+        first_response = {'hasMore': True, 'items': [1, 2], 'lastTimestamp': 1400000000001}
+        self.client.send_signed_request = Mock(
+            side_effect=[first_response, requests.exceptions.HTTPError('mocked error')])
+
+        items = []
+        with self.assertRaises(requests.exceptions.HTTPError):
+            for item in self.client.item_iterator('/some/url', prefetch=3):
+                items.append(item)
+        self.assertEqual(items, [1, 2])
+
+    def _paged_responses(self, pages_per_url, fail_url=None):
+        """Mock send_signed_request with `pages_per_url` pages of two items for every url."""
+        calls = {}
+
+        def send_signed_request(url, query_parameters):
+            if url == fail_url:
+                raise requests.exceptions.HTTPError('mocked error')
+            page = calls[url] = calls.get(url, 0) + 1
+            return {'hasMore': page < pages_per_url, 'items': ['%s-%d' % (url, page)] * 2, 'lastTimestamp': page}
+
+        self.client.send_signed_request = Mock(side_effect=send_signed_request)
+
+    def test_get_resources_for_ids(self):
+        self._paged_responses(3)
+        results = list(self.client.get_resources_for_ids('live', 'websites', 'feedback', [1, 2, 3], max_workers=2))
+        self.assertEqual(len(results), 18)
+        for resource_id in [1, 2, 3]:
+            items = [item for rid, item in results if rid == resource_id]
+            url = '/live/websites/button/%d/feedback' % resource_id
+            self.assertEqual(items, ['%s-%d' % (url, page) for page in [1, 1, 2, 2, 3, 3]])
+        self.assertEqual(self.client.get_query_parameters(), '')
+
+    def test_get_resources_for_ids_preserve_order(self):
+        self._paged_responses(2)
+        results = list(self.client.get_resources_for_ids(
+            'live', 'websites', 'feedback', [3, 1, 2], max_workers=3, preserve_order=True))
+        self.assertEqual([rid for rid, _ in results], [3] * 4 + [1] * 4 + [2] * 4)
+
+    def test_get_resources_for_ids_without_iterating(self):
+        self._paged_responses(1)
+        results = dict(self.client.get_resources_for_ids('live', 'websites', 'campaign_stats', [1, 2], iterate=False))
+        self.assertEqual(results[1]['items'], ['/live/websites/campaign/1/stats-1'] * 2)
+        self.assertEqual(len(results), 2)
+
+    def test_get_resources_for_ids_isolates_failures(self):
+        self._paged_responses(2, fail_url='/live/websites/button/2/feedback')
+        results = []
+        with self.assertRaises(ub.BulkRequestError) as context:
+            for result in self.client.get_resources_for_ids('live', 'websites', 'feedback', [1, 2, 3]):
+                results.append(result)
+        self.assertEqual(sorted(set(rid for rid, _ in results)), [1, 3])
+        self.assertEqual(list(context.exception.errors), [2])
+        self.assertIsInstance(context.exception.errors[2], requests.exceptions.HTTPError)
+
+    def test_get_resources_for_ids_validates_input(self):
+        with self.assertRaises(ub.GeneralError):
+            self.client.get_resources_for_ids('live', 'websites', 'feedback', [1, ''])
+        with self.assertRaises(ub.GeneralError):
+            self.client.get_resources_for_ids('live', 'websites', 'feedback', [1], max_workers=0)
+
+    def _fake_feed(self, timestamps, limit=3, inclusive=False):
+        """Patch send_signed_request to page through items with the given timestamps.
+
+        With `inclusive`, `lastTimestamp` is the timestamp of the last item, like the API,
+        so the next page starts with the items at that timestamp again.
+        """
+        def send_signed_request(url, query_parameters):
+            since = int(query_parameters.get('since', 0))
+            page = [(i, ts) for i, ts in enumerate(timestamps) if ts >= since][:limit]
+            return {
+                'hasMore': bool(page) and page[-1][0] < len(timestamps) - 1,
+                'items': [{'id': i if inclusive else ts, 'date': self._iso_date(ts)} for i, ts in page],
+                'lastTimestamp': page[-1][1] + (0 if inclusive else 1) if page else since,
+            }
+
+        self.client.send_signed_request = Mock(side_effect=send_signed_request)
+        return self.client.send_signed_request
+
+    @staticmethod
+    def _iso_date(ts):
+        t = datetime.datetime(1970, 1, 1) + datetime.timedelta(milliseconds=ts)
+        return t.strftime('%Y-%m-%dT%H:%M:%S.') + '%03dZ' % (ts % 1000)
+
+    def test_get_item_timestamp(self):
+        self.assertEqual(ub.get_item_timestamp({'date': '2013-05-10T13:17:44.123Z'}), 1368191864123)
+        self.assertEqual(ub.get_item_timestamp({'date': self._iso_date(1500)}), 1500)
+        self.assertIsNone(ub.get_item_timestamp({'date': 'yesterday'}))
+        self.assertEqual(ub.get_item_timestamp({}, 42), 42)
+
+    def test_backfill(self):
+        timestamps = list(range(0, 10000, 250))
+        send_signed_request = self._fake_feed(timestamps)
+
+        items = list(self.client.backfill('live', 'websites', 'feedback', 42, since=1000, until=9000, windows=4))
+        self.assertEqual([item['id'] for item in items], [ts for ts in timestamps if 1000 <= ts < 9000])
+        # Four windows of two thousand milliseconds, three items per page.
+        self.assertEqual(send_signed_request.call_count, 4 * 3)
+        self.assertEqual(self.client.get_query_parameters(), '')
+
+    def test_backfill_keeps_query_parameters(self):
+        queries = []
+        self.client.send_signed_request = Mock(side_effect=lambda url, query_parameters: queries.append(
+            self.client.encode_query_parameters(query_parameters)) or {'hasMore': False, 'items': [], 'lastTimestamp': 0})
+
+        self.client.set_query_parameters({'limit': 5})
+        list(self.client.backfill('live', 'websites', 'feedback', 42, since=0, until=20, windows=2))
+        self.assertEqual(sorted(queries), ['limit=5&since=0', 'limit=5&since=10'])
+        self.assertEqual(self.client.get_query_parameters(), 'limit=5')
+
+    def test_backfill_raises_at_failed_window(self):
+        fake = self._fake_feed(list(range(0, 100, 10)))
+        send_signed_request = fake.side_effect
+
+        def fail_second_window(url, query_parameters):
+            if query_parameters == {'since': 50}:
+                raise requests.exceptions.HTTPError('mocked error')
+            return send_signed_request(url, query_parameters)
+
+        fake.side_effect = fail_second_window
+        items = []
+        with self.assertRaises(requests.exceptions.HTTPError):
+            for item in self.client.backfill('live', 'websites', 'feedback', 42, since=0, until=100, windows=2):
+                items.append(item['id'])
+        self.assertEqual(items, [0, 10, 20, 30, 40])
+
+    def test_backfill_windows_read_ahead(self):
+        fake = self._fake_feed(list(range(0, 6000, 100)), limit=3)
+        send_signed_request = fake.side_effect
+        later_pages = []
+        ahead = threading.Event()
+        pages_ahead = []
+
+        def hold_first_window(url, query_parameters):
+            if query_parameters['since'] >= 3000:
+                later_pages.append(query_parameters['since'])
+                if len(later_pages) >= 8:
+                    ahead.set()
+            elif query_parameters['since'] == 0:
+                ahead.wait(5)
+                pages_ahead.append(len(later_pages))
+            return send_signed_request(url, query_parameters)
+
+        fake.side_effect = hold_first_window
+        items = list(self.client.backfill('live', 'websites', 'feedback', 42, since=0, until=6000, windows=2,
+                                          buffer_pages=10))
+        self.assertEqual(len(items), 60)
+        self.assertGreaterEqual(pages_ahead[0], 8)
+
+        with self.assertRaises(ub.GeneralError):
+            self.client.backfill('live', 'websites', 'feedback', 42, since=0, until=10, buffer_pages=0)
+
+    def test_backfill_validates_range(self):
+        with self.assertRaises(ub.GeneralError):
+            self.client.backfill('live', 'websites', 'feedback', 42, since=10, until=10)
+        with self.assertRaises(ub.GeneralError):
+            self.client.backfill('live', 'websites', 'feedback', 42, since=0, until=10, windows=0)
+
+    def test_sync(self):
+        store = ub.FileCheckpointStore(os.path.join(tempfile.mkdtemp(), 'checkpoints.json'))
+        self.addCleanup(shutil.rmtree, os.path.dirname(store.path))
+        first_response = {'hasMore': True, 'items': [1, 2], 'lastTimestamp': 1400000000001}
+        second_response = {'hasMore': False, 'items': [3], 'lastTimestamp': 1400000000002}
+        self.client.send_signed_request = Mock(side_effect=[first_response, second_response, first_response])
+
+        batches = self.client.sync('live', 'websites', 'feedback', 42, store)
+        batch = next(batches)
+        self.assertEqual(list(batch), [1, 2])
+        batch.commit()
+        # The second batch is fetched but not committed.
+        self.assertEqual(len(next(batches)), 1)
+        self.assertEqual(store.get_cursor(('live', 'websites', 'feedback', 42)), 1400000000001)
+
+        next(self.client.sync('live', 'websites', 'feedback', 42, store, query_parameters={'limit': 2}))
+        self.assertEqual(self.client.send_signed_request.call_args_list[-1],
+                         call('/live/websites/button/42/feedback', {'limit': 2, 'since': 1400000000001}))
+
+    def test_export(self):
+        self._paged_responses(3)
+        writer = ub.NDJSONWriter(os.path.join(tempfile.mkdtemp(), 'feedback.ndjson'), batch_size=4)
+        self.addCleanup(shutil.rmtree, os.path.dirname(writer.path))
+        events = []
+        self.client.add_hook(events.append)
+
+        event = self.client.export(writer, 'live', 'websites', 'feedback', 42, report_interval=0)
+        self.assertEqual((event['items'], event['files'], event['done']), (6, 1, True))
+        self.assertEqual([e for e in events if e['type'] == 'export'], [event])
+        with open(writer.path) as f:
+            self.assertEqual(len(f.readlines()), 6)
+
+    def test_export_shards(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        store = ub.LeaseStore(os.path.join(directory, 'leases.db'))
+        store.add_shards('live', 'websites', 'feedback', [1, 2])
+        store.add_shards('live', 'websites', 'feedback', [3], since=1000, until=5000, windows=2)
+        self._fake_feed([1000, 2000, 3000, 4000], limit=3)
+        path = os.path.join(directory, 'feedback-{shard}.ndjson')
+
+        self.assertEqual(self.client.export_shards(store, path, owner='first', max_shards=1),
+                         {'done': 1, 'failed': 0, 'lost': 0, 'items': 4})
+        self.assertEqual(self.client.export_shards(store, path, owner='second'),
+                         {'done': 3, 'failed': 0, 'lost': 0, 'items': 8})
+        self.assertEqual(store.stats()['done'], 4)
+        self.assertEqual(sorted(os.listdir(directory))[:2], ['feedback-live-websites-feedback-1.ndjson',
+                                                             'feedback-live-websites-feedback-2.ndjson'])
+        with open(os.path.join(directory, 'feedback-live-websites-feedback-3-1000-3000.ndjson')) as f:
+            self.assertEqual([json.loads(line)['id'] for line in f], [1000, 2000])
+
+        self.assertEqual(store.get_results()['live-websites-feedback-1']['files'],
+                         [os.path.join(directory, 'feedback-live-websites-feedback-1.ndjson')])
+        self.assertFalse([name for name in os.listdir(directory) if '.tmp-' in name])
+
+        store.add_shards('live', 'websites', 'feedback', [4])
+        self.client.send_signed_request = Mock(side_effect=requests.exceptions.HTTPError('mocked error'))
+        self.assertEqual(self.client.export_shards(store, path, max_shards=1)['failed'], 1)
+        self.assertEqual(store.stats()['pending'], 1)
+
+        with self.assertRaises(ub.GeneralError):
+            self.client.export_shards(store, os.path.join(directory, 'feedback.ndjson'))
+
+    def test_export_shards_drops_the_output_of_a_lost_lease(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        store = ub.LeaseStore(os.path.join(directory, 'leases.db'))
+        store.add_shards('live', 'websites', 'feedback', [1, 2])
+        self._fake_feed([1000, 2000, 3000, 4000], limit=1)
+        path = os.path.join(directory, '{shard}', 'feedback.ndjson')
+
+        # Renew after every page.
+        store.lease_seconds = -1
+        with patch.object(store, 'renew', return_value=False):
+            summary = self.client.export_shards(store, path, owner='first', max_shards=1)
+        self.assertEqual(summary, {'done': 0, 'failed': 0, 'lost': 1, 'items': 0})
+        with patch.object(store, 'renew', return_value=True), patch.object(store, 'complete', return_value=False):
+            summary = self.client.export_shards(store, path, owner='first', max_shards=1)
+        self.assertEqual(summary['lost'], 1)
+        self.assertEqual(os.listdir(directory), ['leases.db'])
+
+    def test_export_shards_gives_the_shard_back_on_any_error(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        store = ub.LeaseStore(os.path.join(directory, 'leases.db'))
+        store.add_shards('live', 'websites', 'feedback', [1], since=1000, until=3000)
+        self._fake_feed([1000, 2000, 3000, 4000], limit=1)
+        path = os.path.join(directory, 'feedback-{shard}.ndjson')
+
+        class FailingWriter(ub.NDJSONWriter):
+            def write(self, item):
+                super(FailingWriter, self).write(item)
+                raise OSError('disk full')
+
+        summary = self.client.export_shards(store, path, writer_class=FailingWriter, writer_options={'batch_size': 1},
+                                            max_shards=1)
+        self.assertEqual(summary['failed'], 1)
+        send_signed_request = self.client.send_signed_request
+        self.client.send_signed_request = Mock(side_effect=ValueError('invalid body'))
+        self.assertEqual(self.client.export_shards(store, path, max_shards=1)['failed'], 1)
+        self.assertEqual(store.stats()['pending'], 1)
+        self.assertEqual(os.listdir(directory), ['leases.db'])
+
+        # A single window ends at `until` too.
+        self.client.send_signed_request = send_signed_request
+        self.assertEqual(self.client.export_shards(store, path)['items'], 2)
+        with open(os.path.join(directory, 'feedback-live-websites-feedback-1-1000-3000.ndjson')) as f:
+            self.assertEqual([json.loads(line)['id'] for line in f], [1000, 2000])
+
+    def test_export_command(self):
+        with patch.object(ub.APIClient, 'export') as export:
+            ub.main(['live', 'websites', 'feedback', '*', '-o', 'out.csv', '-f', 'csv', '--since', '5',
+                     '--client-key', 'ACCESS-KEY', '--secret-key', 'SECRET-KEY'])
+        writer = export.call_args[0][0]
+        self.assertIsInstance(writer, ub.CSVWriter)
+        self.assertEqual(export.call_args[0][1:], ('live', 'websites', 'feedback', '*'))
+        self.assertEqual(export.call_args[1]['query_parameters'], {'since': 5})
+
+        with patch.object(ub.APIClient, 'export_raw', return_value={'pages': 1, 'bytes': 2}) as export_raw:
+            ub.main(['live', 'websites', 'feedback', '*', '-o', 'out.ndjson', '-f', 'raw',
+                     '--client-key', 'ACCESS-KEY', '--secret-key', 'SECRET-KEY'])
+        export_raw.assert_called_once_with('out.ndjson', 'live', 'websites', 'feedback', '*', query_parameters={})
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        shards = os.path.join(directory, 'leases.db')
+        with patch.object(ub.APIClient, 'export_shards', return_value={
+                'done': 3, 'failed': 0, 'lost': 0, 'items': 9}) as export_shards:
+            ub.main(['live', 'websites', 'feedback', '1,2', '-o', 'out-{shard}.ndjson', '--shards', shards,
+                     '--windows', '2', '--since', '0', '--until', '10', '--client-key', 'ACCESS-KEY',
+                     '--secret-key', 'SECRET-KEY'])
+        self.assertEqual(export_shards.call_args[0][1], 'out-{shard}.ndjson')
+        self.assertEqual(export_shards.call_args[1]['writer_class'], ub.NDJSONWriter)
+        self.assertEqual(ub.LeaseStore(shards).stats()['pending'], 4)
+
+        with self.assertRaises(SystemExit):
+            with patch('sys.stderr'):
+                ub.main(['live', 'websites', 'feedback', '1,2', '-o', 'out.ndjson',
+                         '--client-key', 'ACCESS-KEY', '--secret-key', 'SECRET-KEY'])
+
+        with self.assertRaises(SystemExit):
+            ub.main(['live', 'websites', 'feedback', '-o', 'out.csv', '-f', 'csv', '--compression', 'zip',
+                     '--client-key', 'ACCESS-KEY', '--secret-key', 'SECRET-KEY'])
+
+    def test_mirror(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        mirror = ub.SQLiteMirror(os.path.join(directory, 'mirror.db'))
+        send_signed_request = self._fake_feed([1000, 2000, 3000, 4000], limit=3)
+
+        self.assertEqual(self.client.mirror(mirror, 'live', 'websites', 'feedback', 42, batch_size=2), 4)
+        self._fake_feed([1000, 2000, 3000, 4000, 5000], limit=3)
+        self.assertEqual(self.client.mirror(mirror, 'live', 'websites', 'feedback', 42), 2)
+        self.assertEqual(self.client.send_signed_request.call_args_list[0],
+                         call('/live/websites/button/42/feedback', {'since': 4000}))
+        self.assertEqual([item['id'] for item in mirror.query(('live', 'websites', 'feedback', 42))],
+                         [1000, 2000, 3000, 4000, 5000])
+        self.assertEqual(send_signed_request.call_count, 2)
+
+    def test_get_campaign_result_batches(self):
+        schema = {'fields': [{'name': 'nps', 'type': 'nps'}, {'name': 'comment', 'type': 'text'}]}
+        items = [{'id': i, 'date': 'd%d' % i, 'data': {'nps': i, 'comment': 'c%d' % i}} for i in range(5)]
+        self.client.send_signed_request = Mock(return_value=schema)
+        self.client.item_iterator = Mock(return_value=iter(items))
+
+        batches = list(self.client.get_campaign_result_batches(
+            'live', 'apps', 42, ['id', 'data.nps'], batch_size=2))
+        self.client.send_signed_request.assert_called_once_with('/live/apps/campaign/42/results/schema', None)
+        self.client.item_iterator.assert_called_once_with(
+            '/live/apps/campaign/42/results', query_parameters=None, stream=True)
+        self.assertEqual([len(batch) for batch in batches], [2, 2, 1])
+        self.assertEqual(list(batches[0].columns), ['id', 'data.nps'])
+        self.assertEqual(list(batches[2].columns['data.nps']), [4.0])
+
+        # Websites campaigns have no schema resource, so the columns are not typed.
+        self.client.send_signed_request.reset_mock()
+        self.client.item_iterator = Mock(return_value=iter(items))
+        batch, = self.client.get_campaign_result_batches('live', 'websites', 42, ['data.nps'])
+        self.assertFalse(self.client.send_signed_request.called)
+        self.assertEqual(batch.columns['data.nps'], [0, 1, 2, 3, 4])
+
+        with self.assertRaises(ub.GeneralError):
+            self.client.get_campaign_result_batches('live', 'apps', 42, ['id'], batch_size=0, schema=schema)
+
+    def test_item_iterator_drops_boundary_duplicates(self):
+        timestamps = [1000, 2000, 2000, 3000, 3000, 4000]
+        for prefetch in [0, 2]:
+            self._fake_feed(timestamps, limit=3, inclusive=True)
+            self.client.dropped_duplicates = 0
+            items = list(self.client.item_iterator('/live/websites/button/42/feedback', prefetch=prefetch))
+            self.assertEqual([item['id'] for item in items], list(range(6)))
+            self.assertEqual(self.client.dropped_duplicates, 3)
+
+        self._fake_feed(timestamps, limit=3, inclusive=True)
+        items = list(self.client.item_iterator('/live/websites/button/42/feedback', deduplicate=False))
+        self.assertEqual(len(items), 9)
+
+    def test_get_resources_for_ids_drops_boundary_duplicates(self):
+        self._fake_feed([1000, 2000, 2000, 3000], limit=3, inclusive=True)
+        results = list(self.client.get_resources_for_ids('live', 'websites', 'feedback', [1, 2]))
+        self.assertEqual(sorted((rid, item['id']) for rid, item in results), [(rid, i) for rid in [1, 2] for i in range(4)])
+
+    def test_sync_requires_store(self):
+        with self.assertRaises(ub.GeneralError):
+            self.client.sync('live', 'websites', 'feedback', 42)
+
+    def test_get_resource_name(self):
+        self.assertEqual(self.client.get_resource_name('/live/websites/button'), 'button')
+        self.assertEqual(self.client.get_resource_name('/live/websites/button/%2A/feedback'), 'feedback')
+        self.assertEqual(self.client.get_resource_name('/live/apps'), 'app')
+        self.assertEqual(self.client.get_resource_name('/live/apps/campaign/42/results/schema'), 'campaign_result_schema')
+        self.assertIsNone(self.client.get_resource_name('/live/websites/unknown'))
+
+    def test_send_signed_request_cache(self):
+        client = ub.APIClient('ACCESS-KEY', 'SECRET-KEY', cache=ub.ResponseCache())
+        client._send = Mock(side_effect=lambda scope, query: {'url': scope + '?' + query})
+
+        client.send_signed_request('/live/websites/button')
+        client.send_signed_request('/live/websites/button')
+        client.send_signed_request('/live/websites/button', {'limit': 1})
+        client.send_signed_request('/live/websites/button/42/feedback')
+        client.send_signed_request('/live/websites/button/42/feedback')
+        self.assertEqual(client._send.call_count, 4)
+        self.assertEqual(client.cache.stats(), {'hits': 1, 'misses': 2, 'evictions': 0, 'entries': 2})
+
+        self.assertEqual(client.invalidate_cache('live', 'websites', 'button'), 2)
+        client.send_signed_request('/live/websites/button')
+        self.assertEqual(client._send.call_count, 5)
 
     def test_get_resource(self):
         self.client.item_iterator = Mock()
         self.client.send_signed_request = Mock()
         self.client.get_resource('live', 'websites', 'feedback', 42)
-        self.client.send_signed_request.assert_called_with('/live/websites/button/42/feedback')
+        self.client.send_signed_request.assert_called_with('/live/websites/button/42/feedback', None)
         self.client.get_resource('live', 'websites', 'button', None, True)
-        self.client.item_iterator.assert_called_with('/live/websites/button')
+        self.client.item_iterator.assert_called_with('/live/websites/button', prefetch=0, query_parameters=None,
+                                                   stream=False, tuner=None)
+        self.client.get_resource('live', 'websites', 'button', None, True, prefetch=2)
+        self.client.item_iterator.assert_called_with('/live/websites/button', prefetch=2, query_parameters=None,
+                                                   stream=False, tuner=None)
+        self.client.get_resource('live', 'websites', 'button', query_parameters={'limit': 1})
+        self.client.send_signed_request.assert_called_with('/live/websites/button', {'limit': 1})
         self.client.get_resource('live', 'apps', 'campaign_result_schema', 42)
-        self.client.send_signed_request.assert_called_with('/live/apps/campaign/42/results/schema')
+        self.client.send_signed_request.assert_called_with('/live/apps/campaign/42/results/schema', None)
+
+
+class TestWatcher(TestCase):
+
+    def setUp(self):
+        self.client = ub.APIClient('ACCESS-KEY', 'SECRET-KEY')
+        self.addCleanup(self.client.close)
+        self.feeds = {'/live/websites/button/1/feedback': [], '/live/websites/button/2/feedback': []}
+        self.growing = set()
+        self.client.send_signed_request = Mock(side_effect=self._send_signed_request)
+        self.watcher = ub.Watcher(self.client, minimum=10, maximum=80, jitter=0)
+        self.now = 0.0
+        self.watcher.clock = lambda: self.now
+        self.watcher.wait = self._wait
+
+    def _wait(self, seconds):
+        self.now += seconds
+
+    def _send_signed_request(self, url, query_parameters):
+        feed = self.feeds[url]
+        if feed is None:
+            raise requests.exceptions.HTTPError('mocked error')
+        if url in self.growing:
+            feed.append((len(feed), len(feed) * 1000))
+        page = [(i, ts) for i, ts in feed if ts >= query_parameters['since']]
+        return {
+            'items': [{'id': i, 'date': TestClient._iso_date(ts)} for i, ts in page],
+            'hasMore': False,
+            'lastTimestamp': page[-1][1] if page else query_parameters['since'],
+        }
+
+    def test_yields_new_items_once(self):
+        busy = self.watcher.follow('live', 'websites', 'feedback', 1, since=0)
+        self.feeds['/live/websites/button/1/feedback'] = [(1, 1000), (2, 2000)]
+        self.assertEqual([(key, item['id']) for key, item in self.watcher.watch(polls=2)], [(busy, 1), (busy, 2)])
+
+        self.feeds['/live/websites/button/1/feedback'].append((3, 2000))
+        self.assertEqual([item['id'] for _, item in self.watcher.watch(polls=1)], [3])
+        self.assertEqual(self.watcher.feeds[busy]['cursor'], 2000)
+        self.assertEqual(self.client.send_signed_request.call_args[0][1]['since'], 2000)
+
+    def test_adapts_the_interval(self):
+        busy = self.watcher.follow('live', 'websites', 'feedback', 1, since=0)
+        quiet = self.watcher.follow('live', 'websites', 'feedback', 2, since=0)
+        self.growing.add('/live/websites/button/1/feedback')
+
+        items = []
+        self.watcher.run(lambda key, item: items.append(key), polls=12)
+        polled = [call_args[0][0] for call_args in self.client.send_signed_request.call_args_list]
+        self.assertEqual(self.watcher.feeds[busy]['interval'], 10)
+        self.assertEqual(self.watcher.feeds[quiet]['interval'], 80)
+        self.assertEqual(polled.count('/live/websites/button/2/feedback'), 3)
+        self.assertEqual(items, [busy] * 9)
+
+        self.growing.clear()
+        list(self.watcher.watch(polls=4))
+        self.assertEqual(self.watcher.feeds[busy]['interval'], 80)
+
+    def test_errors_do_not_stop_the_watch(self):
+        failing = self.watcher.follow('live', 'websites', 'feedback', 1, since=0)
+        self.watcher.follow('live', 'websites', 'feedback', 2, since=0)
+        self.feeds['/live/websites/button/1/feedback'] = None
+        self.feeds['/live/websites/button/2/feedback'] = [(1, 1000)]
+        events = []
+        self.client.add_hook(events.append)
+
+        self.assertEqual([item['id'] for _, item in self.watcher.watch(polls=2)], [1])
+        self.assertEqual(self.watcher.feeds[failing]['errors'], 1)
+        self.assertEqual(self.watcher.feeds[failing]['interval'], 20)
+        errors = dict((e['key'], e['error']) for e in events if e['type'] == 'watch')
+        self.assertEqual(errors.pop(failing), 'HTTPError')
+        self.assertEqual(list(errors.values()), [None])
+
+    def test_follows_a_feed_once(self):
+        with patch('usabilla.random.uniform', side_effect=lambda low, high: high):
+            key = self.watcher.follow('live', 'websites', 'feedback', 1, since=0)
+            self.watcher.follow('live', 'websites', 'feedback', 1, since=0)
+            self.watcher.unfollow(key)
+            self.watcher.follow('live', 'websites', 'feedback', 1, since=0)
+            self.watcher.run(lambda key, item: None, polls=3)
+        # The first poll is after 10 seconds, every poll of the quiet feed doubles the interval.
+        self.assertEqual(self.now, 10 + 20 + 40)
+        self.assertEqual(len(self.watcher._schedule), 1)
+
+        self.watcher.unfollow(key)
+        self.assertEqual(list(self.watcher.watch()), [])
+        self.assertEqual(self.client.send_signed_request.call_count, 3)
+
+    def test_resumes_from_the_store(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        store = ub.FileCheckpointStore(os.path.join(directory, 'cursors.json'))
+        self.feeds['/live/websites/button/1/feedback'] = [(1, 1000), (2, 2000)]
+
+        watcher = ub.Watcher(self.client, store=store, minimum=10, jitter=0)
+        key = watcher.follow('live', 'websites', 'feedback', 1, since=0)
+        watcher.wait = lambda seconds: None
+        watcher.clock = lambda: float('inf')
+        list(watcher.watch(polls=1))
+        self.assertEqual(store.get_cursor(key), 2000)
+
+        watcher = ub.Watcher(self.client, store=store)
+        watcher.follow('live', 'websites', 'feedback', 1, since=0)
+        self.assertEqual(watcher.feeds[key]['cursor'], 2000)
+
+    def test_stop(self):
+        self.watcher.follow('live', 'websites', 'feedback', 1, since=0)
+        self.watcher.wait = lambda seconds: self.watcher.stop()
+        self.assertEqual(list(self.watcher.watch()), [])
+
+
+class TestClientPool(TestCase):
+
+    def setUp(self):
+        self.pool = ub.ClientPool(OrderedDict([
+            ('big', ub.Credentials('BIG-KEY', 'SECRET')), ('small', ('SMALL-KEY', 'SECRET'))]), max_workers=1, rate=100)
+        self.addCleanup(self.pool.close)
+        self.requests = []
+
+        for name, client in self.pool.clients.items():
+            client.send_signed_request = Mock(side_effect=self._fake_feed(name, pages=3))
+
+    def _fake_feed(self, name, pages):
+        def send_signed_request(url, query_parameters):
+            self.requests.append(name)
+            page = query_parameters.get('since', 0) + 1
+            if name == 'small' and url.endswith('/fail/feedback'):
+                raise requests.exceptions.HTTPError('mocked error')
+            return {'hasMore': page < pages, 'items': ['%s-%d' % (name, page)], 'lastTimestamp': page}
+        return send_signed_request
+
+    def test_shares_the_session(self):
+        big, small = self.pool.clients.values()
+        self.assertIs(big.session, small.session)
+        self.assertIsNot(big.rate_limiter, small.rate_limiter)
+        self.assertEqual(small.credentials.client_key, 'SMALL-KEY')
+
+    def test_interleaves_accounts(self):
+        for button in range(3):
+            self.pool.submit('big', 'live', 'websites', 'feedback', button)
+        self.pool.submit('small', 'live', 'websites', 'feedback', 0)
+
+        results = list(self.pool.run())
+        self.assertEqual(len(results), 12)
+        self.assertEqual(self.requests[:6], ['big', 'small'] * 3)
+        self.assertEqual(results[1], (('small', 'live', 'websites', 'feedback', 0), 'small-1'))
+
+        stats = self.pool.stats()
+        self.assertEqual(stats['accounts']['big']['items'], 9)
+        self.assertEqual(stats['accounts']['small']['pages'], 3)
+        self.assertEqual(stats['total']['items'], 12)
+        self.assertGreater(stats['total']['items_per_second'], 0)
+
+    def test_isolates_failures(self):
+        self.pool.submit('big', 'live', 'websites', 'feedback', 0)
+        key = self.pool.submit('small', 'live', 'websites', 'feedback', 'fail')
+        results = []
+        with self.assertRaises(ub.BulkRequestError) as context:
+            for result in self.pool.run():
+                results.append(result)
+        self.assertEqual(len(results), 3)
+        self.assertEqual(list(context.exception.errors), [key])
+        self.assertEqual(self.pool.stats()['accounts']['small']['errors'], 1)
+
+    def test_invalid_account(self):
+        with self.assertRaises(ub.GeneralError):
+            self.pool.submit('unknown', 'live', 'websites', 'feedback', 0)
+
+    def test_throttled_account_does_not_hold_the_workers(self):
+        pool = ub.ClientPool(OrderedDict([('slow', ('SLOW-KEY', 'SECRET')), ('fast', ('FAST-KEY', 'SECRET'))]),
+                             max_workers=4, rate={'slow': 2})
+        self.addCleanup(pool.close)
+        self.assertIsNone(pool.clients['fast'].rate_limiter)
+        for name, client in pool.clients.items():
+            fake = self._fake_feed(name, pages=3 if name == 'slow' else 30)
+
+            def send_signed_request(url, query_parameters, client=client, fake=fake):
+                if client.rate_limiter is not None:
+                    client.rate_limiter.acquire()
+                return fake(url, query_parameters)
+            client.send_signed_request = Mock(side_effect=send_signed_request)
+        for button in range(8):
+            pool.submit('slow', 'live', 'websites', 'feedback', button)
+        pool.submit('fast', 'live', 'websites', 'feedback', 0)
+
+        start = time.monotonic()
+        fast = 0
+        results = pool.run()
+        for key, _ in results:
+            fast += key[0] == 'fast'
+            if fast == 30:
+                break
+        results.close()
+        self.assertLess(time.monotonic() - start, 1.5)
+
+
+@skipIf(web is None, 'aiohttp is not installed')
+class TestAsyncClient(IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.requests = []
+
+        async def handler(request):
+            self.requests.append(request)
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            await asyncio.sleep(0.01)
+            self.in_flight -= 1
+            since = int(request.query.get('since', 0))
+            return web.json_response({'hasMore': since < 2, 'items': [since], 'lastTimestamp': since + 1})
+
+        app = web.Application()
+        app.router.add_get('/{tail:.*}', handler)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, '127.0.0.1', 0)
+        await site.start()
+        port = self.runner.addresses[0][1]
+
+        self.client = ub.AsyncAPIClient('ACCESS-KEY', 'SECRET-KEY', max_concurrency=2)
+        self.client.host = '127.0.0.1:%d' % port
+        self.client.host_protocol = 'http://'
+
+    async def asyncTearDown(self):
+        await self.client.close()
+        await self.runner.cleanup()
+
+    async def test_invalid_concurrency(self):
+        with self.assertRaises(ub.GeneralError):
+            ub.AsyncAPIClient('ACCESS-KEY', 'SECRET-KEY', max_concurrency=0)
+
+    async def test_has_none_of_the_blocking_methods(self):
+        self.assertNotIsInstance(self.client, ub.APIClient)
+        self.assertIsInstance(self.client, ub.BaseAPIClient)
+        for name in ('backfill', 'get_resources_for_ids', 'get_campaign_result_batches', 'export', 'sync'):
+            self.assertFalse(hasattr(self.client, name), name)
+        self.assertEqual(self.client.resources, ub.APIClient.resources)
+
+    async def test_send_signed_request(self):
+        result = await self.client.get_resource('live', 'websites', 'button')
+        self.assertEqual(result, {'hasMore': True, 'items': [0], 'lastTimestamp': 1})
+        request = self.requests[0]
+        self.assertEqual(request.path, '/live/websites/button')
+        self.assertTrue(request.headers['Authorization'].startswith('USBL1-HMAC-SHA256 Credential=ACCESS-KEY/'))
+
+    async def test_decode_executor(self):
+        with concurrent.futures.ThreadPoolExecutor(1) as executor:
+            self.client.decode_executor = executor
+            result = await self.client.get_resource('live', 'websites', 'button')
+        self.assertEqual(result, {'hasMore': True, 'items': [0], 'lastTimestamp': 1})
+
+    async def test_hooks(self):
+        events = []
+        self.client.add_hook(events.append)
+        await self.client.get_resource('live', 'websites', 'button')
+        self.assertEqual([(event['type'], event['status'], event['error']) for event in events],
+                         [('request', 200, None)])
+        self.assertEqual(sorted(events[0]['timings']), ['decode', 'download', 'response', 'sign'])
+        self.assertEqual(events[0]['bytes'], len(b'{"hasMore": true, "items": [0], "lastTimestamp": 1}'))
+
+    async def test_item_iterator(self):
+        items = [item async for item in self.client.get_resource('live', 'websites', 'feedback', '*', True)]
+        self.assertEqual(items, [0, 1, 2])
+        self.assertEqual([r.query_string for r in self.requests], ['', 'since=1', 'since=2'])
+        self.assertEqual(self.requests[0].raw_path, '/live/websites/button/%2A/feedback')
+        self.assertEqual(self.client.get_query_parameters(), '')
+
+    async def test_bounded_concurrency(self):
+        await asyncio.gather(*[self.client.get_resource('live', 'websites', 'button') for _ in range(6)])
+        self.assertEqual(len(self.requests), 6)
+        self.assertEqual(self.max_in_flight, 2)
+
+    async def test_item_iterator_raises(self):
+        self.client.send_signed_request = AsyncMock(side_effect=ub.GeneralError('type', 'message'))
+        with self.assertRaises(ub.GeneralError):
+            [item async for item in self.client.item_iterator('/some/url')]
 
 
 if __name__ == '__main__':
@@ -18,13 +18,363 @@
 # WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
 
+import argparse
+import array
+import asyncio
+import bisect
+import bz2
+import calendar
+import codecs
+import concurrent.futures
+import contextlib
+import csv
 import datetime
+import email.utils
+import gzip
 import hashlib
+import heapq
 import hmac
+import importlib
+import io
+import json
+import lzma
+import os
+import queue
+import re
+import socket
+import random
 import requests
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
 import urllib.parse
+import warnings
 
-from collections import OrderedDict
+from collections import OrderedDict, deque
+
+try:
+    import aiohttp
+    import yarl
+except ImportError:  # pragma: no cover
+    aiohttp = None
+
+try:
+    import numpy
+except ImportError:  # pragma: no cover
+    numpy = None
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:  # pragma: no cover
+    pyarrow = None
+
+
+def get_json_decoder(name='auto'):
+    """Get the function of a JSON backend that decodes a response body.
+
+    :param name: The module of the backend: `orjson`, `ujson`, `simplejson` or `json`, or
+        `auto` for the fastest one that is installed.
+    :type name: str
+
+    :returns: A function that takes the `bytes` of a body and returns the decoded data.
+    :rtype: callable
+    """
+    names = ('orjson', 'ujson', 'simplejson', 'json') if name == 'auto' else (name,)
+    for candidate in names:
+        try:
+            return importlib.import_module(candidate).loads
+        except ImportError:
+            continue
+    raise GeneralError('missing dependency', 'The JSON backend %s is not installed.' % name)
+
+
+def flatten_item(item, separator='.'):
+    """Flatten the nested objects of an item into a single level of columns.
+
+    The keys of nested objects are joined with `separator`, lists are kept as JSON text.
+
+    :param item: The item to flatten.
+    :param separator: The text between the keys of a nested column.
+
+    :type item: dict
+    :type separator: str
+
+    :returns: The columns of the item.
+    :rtype: OrderedDict
+    """
+    columns = OrderedDict()
+
+    def add(prefix, value):
+        if isinstance(value, dict):
+            for key, nested in value.items():
+                add(prefix + separator + key if prefix else key, nested)
+        elif isinstance(value, list):
+            columns[prefix] = json.dumps(value)
+        else:
+            columns[prefix] = value
+
+    add('', item)
+    return columns
+
+
+NUMERIC_FIELD_TYPES = frozenset(['rating', 'nps', 'mood', 'star', 'slider', 'number', 'integer', 'float'])
+
+
+def get_schema_field_types(schema):
+    """Get the column types of the fields of a campaign result schema.
+
+    The fields are read from the `fields` or `items` of the schema, every field with its
+    `name` (or `id`) and `type`. They are the answers in the `data` of a result, so the
+    columns are named `data.<name>`. A column is `number` for the numeric field types,
+    see `NUMERIC_FIELD_TYPES`, and `object` otherwise.
+
+    :param schema: The response of the campaign result schema resource.
+    :type schema: dict
+
+    :returns: The type per column.
+    :rtype: dict
+    """
+    fields = schema.get('fields', schema.get('items', [])) if isinstance(schema, dict) else schema
+    types = {}
+    for field in fields or []:
+        name = field.get('name', field.get('id'))
+        if name is not None:
+            types['data.%s' % name] = 'number' if field.get('type') in NUMERIC_FIELD_TYPES else 'object'
+    return types
+
+
+def get_item_timestamp(item, default=None):
+    """Get the timestamp of an item from its ISO 8601 `date` field.
+
+    :param item: A `dict` of a feedback item or campaign result.
+    :param default: The value returned when the item has no valid date.
+
+    :type item: dict
+
+    :returns: An `int` timestamp in milliseconds, like `lastTimestamp` and `since`.
+    :rtype: int
+    """
+    date = item.get('date') if isinstance(item, dict) else None
+    if not isinstance(date, str):
+        return default
+    try:
+        t = datetime.datetime.fromisoformat(date.replace('Z', '+00:00'))
+    except ValueError:
+        return default
+    if t.tzinfo is None:
+        t = t.replace(tzinfo=datetime.timezone.utc)
+    return int(round(t.timestamp() * 1000))
+
+
+class _TextStream(object):
+
+    """A text buffer over byte chunks that drops the text that was parsed."""
+
+    whitespace = re.compile(r'[ \t\n\r]*')
+    number_characters = re.compile(r'[0-9.eE+-]*')
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.decoder = codecs.getincrementaldecoder('utf-8')()
+        self.text = ''
+        self.pos = 0
+        self.exhausted = False
+
+    def read_more(self):
+        """Append the next chunk to the buffer, `False` at the end of the stream."""
+        if self.exhausted:
+            return False
+        chunk = next(self.chunks, None)
+        if chunk is None:
+            self.exhausted = True
+            self.text += self.decoder.decode(b'', final=True)
+            return True
+        if self.pos > 65536:
+            self.text = self.text[self.pos:]
+            self.pos = 0
+        self.text += self.decoder.decode(chunk)
+        return True
+
+    def peek(self):
+        """Skip whitespace and get the next character, `''` at the end of the stream."""
+        while True:
+            self.pos = self.whitespace.match(self.text, self.pos).end()
+            if self.pos < len(self.text):
+                return self.text[self.pos]
+            if not self.read_more():
+                return ''
+
+    def expect(self, characters):
+        character = self.peek()
+        if character == '' or character not in characters:
+            raise ValueError('Expected one of %r at position %d of the response' % (characters, self.pos))
+        self.pos += 1
+        return character
+
+    def decode_value(self, decoder):
+        """Decode the JSON value at the current position, reading more chunks until it is complete."""
+        self.peek()
+        while True:
+            try:
+                value, end = decoder.raw_decode(self.text, self.pos)
+            except ValueError:
+                if not self.read_more():
+                    raise
+                continue
+            # A number may continue in the next chunk until a character that cannot be part of it.
+            if (not self.exhausted and isinstance(value, (int, float))
+                    and self.number_characters.match(self.text, end).end() == len(self.text)):
+                self.read_more()
+                continue
+            self.pos = end
+            return value
+
+
+def stream_items(chunks, page, decoder=None):
+    """Decode the items of a JSON page while its bytes arrive.
+
+    The `items` of the page are yielded one by one as soon as they are decoded, the other
+    keys of the page (`hasMore`, `lastTimestamp`, ...) are stored in `page`. They are
+    complete once the generator is exhausted.
+
+    :param chunks: An iterable of the `bytes` of the response body.
+    :param page: A `dict` that receives the keys of the page other than `items`.
+    :param decoder: A `json.JSONDecoder`, defaults to the standard decoder.
+
+    :type chunks: iterable
+    :type page: dict
+    :type decoder: json.JSONDecoder
+
+    :returns: A `generator` that yields the items of the page.
+    :rtype: generator
+    :raises ValueError: if the response is not a valid JSON object
+    """
+    decoder = decoder or json.JSONDecoder()
+    stream = _TextStream(chunks)
+
+    stream.expect('{')
+    if stream.peek() == '}':
+        stream.pos += 1
+        return
+    while True:
+        key = stream.decode_value(decoder)
+        stream.expect(':')
+        if key == 'items' and stream.peek() == '[':
+            stream.pos += 1
+            if stream.peek() == ']':
+                stream.pos += 1
+            else:
+                while True:
+                    yield stream.decode_value(decoder)
+                    if stream.expect(',]') == ']':
+                        break
+        else:
+            page[key] = stream.decode_value(decoder)
+        if stream.expect(',}') == '}':
+            break
+    if stream.peek() != '':
+        raise ValueError('Unexpected data after the end of the response')
+
+
+PAGE_FIELD_PATTERN = re.compile(rb'"(hasMore|lastTimestamp|count)"\s*:\s*(true|false|null|-?[0-9][0-9.eE+-]*)')
+PAGE_FIELD_OVERLAP = 64
+
+
+def copy_page(chunks, target, page):
+    """Copy the bytes of a JSON page to `target` without decoding it.
+
+    Only the scalar `hasMore`, `lastTimestamp` and `count` fields are picked out of the
+    bytes, with a pattern search rather than a parser: the last occurrence of a field
+    wins, so the items must not contain fields with these names.
+
+    :param chunks: An iterable of the `bytes` of the response body.
+    :param target: A binary file-like object with a `write` method.
+    :param page: A `dict` that receives the fields found.
+
+    :type chunks: iterable
+    :type target: file
+    :type page: dict
+
+    :returns: The number of bytes copied.
+    :rtype: int
+    """
+    size = 0
+    pending = b''
+    for chunk in chunks:
+        target.write(chunk)
+        size += len(chunk)
+        window = pending + chunk
+        for match in PAGE_FIELD_PATTERN.finditer(window):
+            # A number at the end of the window may continue in the next chunk.
+            if match.end() < len(window):
+                page[match.group(1).decode('ascii')] = json.loads(match.group(2))
+        pending = window[-PAGE_FIELD_OVERLAP:]
+    for match in PAGE_FIELD_PATTERN.finditer(pending):
+        page[match.group(1).decode('ascii')] = json.loads(match.group(2))
+    return size
+
+
+def put_until_stopped(buffer, entry, stopped):
+    """Put an entry in a bounded queue unless `stopped` is set while waiting for room.
+
+    :returns: A `boolean` that is `False` if the entry was dropped.
+    :rtype: bool
+    """
+    while not stopped.is_set():
+        try:
+            buffer.put(entry, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def read_ahead(iterable, size):
+    """Consume an iterable in a background thread, at most `size` values ahead.
+
+    An exception raised by the iterable is re-raised after the values produced before it.
+    Closing the returned generator stops the background thread.
+
+    :param iterable: The iterable to consume.
+    :param size: The maximum number of values buffered.
+
+    :type iterable: iterable
+    :type size: int
+
+    :returns: A `generator` that yields the values of the iterable.
+    :rtype: generator
+    """
+    if size < 1:
+        raise GeneralError('invalid size', 'The read ahead size must be at least 1.')
+
+    buffer = queue.Queue(maxsize=size)
+    stopped = threading.Event()
+
+    def produce():
+        try:
+            for value in iterable:
+                if not put_until_stopped(buffer, (True, value), stopped):
+                    return
+        except BaseException as e:
+            put_until_stopped(buffer, (False, e), stopped)
+        else:
+            put_until_stopped(buffer, (False, None), stopped)
+
+    thread = threading.Thread(target=produce, name='usabilla-read-ahead', daemon=True)
+    thread.start()
+    try:
+        while True:
+            is_value, value = buffer.get()
+            if not is_value:
+                if value is not None:
+                    raise value
+                return
+            yield value
+    finally:
+        stopped.set()
 
 
 class Credentials(object):
@@ -62,280 +412,3937 @@ class GeneralError(Exception):
         return "%s(type=%s)" % (self.__class__.__name__, self.type)
 
 
-class APIClient(object):
+class RequestSigner(object):
 
-    """APIClient object.
+    """RequestSigner object.
 
-    For the key derivation functions see:
-        http://docs.aws.amazon.com/general/latest/gr/signature-v4-examples.html#signature-v4-examples-python
+    Computes the USBL1 signature headers of a request. The derived signing key only
+    changes once per UTC day and is cached per datestamp, the date strings are cached
+    per second. A signer can be used standalone to pre-sign a batch of requests.
 
     """
 
-    resources = {
-        'scopes': {
-            'live': {
-                'products': {
-                    'websites': {
-                        'resources': {
-                            'button': '/button',
-                            'feedback': '/button/:id/feedback',
-                            'campaign': '/campaign',
-                            'campaign_result': '/campaign/:id/results',
-                            'campaign_stats': '/campaign/:id/stats',
-                            'inpage': '/inpage',
-                            'inpage_result': '/inpage/:id/feedback'
-                        }
-                    },
-                    'email': {
-                        'resources': {
-                            'button': '/button',
-                            'feedback': '/button/:id/feedback'
-                        }
-                    },
-                    'apps': {
-                        'resources': {
-                            'app': '',
-                            'feedback': '/:id/feedback',
-                            'campaign': '/campaign',
-                            'campaign_result': '/campaign/:id/results',
-                            'campaign_result_schema': '/campaign/:id/results/schema'
-                        }
-                    }
-                }
-            }
-        }
-    }
-
-    """ Scope constants """
-    SCOPE_LIVE = 'live'
+    algorithm = 'USBL1-HMAC-SHA256'
+    signed_headers = 'date;host'
+    payload_hash = hashlib.sha256(''.encode('utf-8')).hexdigest()
 
-    """ Product contants """
-    PRODUCT_WEBSITES = 'websites'
-    PRODUCT_EMAIL = 'email'
-    PRODUCT_APPS = 'apps'
+    weekdays = ('Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun')
+    months = ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec')
 
-    """ Resource contants """
-    RESOURCE_FEEDBACK = 'feedback'
-    RESOURCE_APP = 'app'
-    RESOURCE_BUTTON = 'button'
-    RESOURCE_CAMPAIGN = 'campaign'
-    RESOURCE_CAMPAIGN_RESULT = 'campaign_result'
-    RESOURCE_CAMPAIGN_STATS = 'campaign_stats'
-    RESOURCE_CAMPAIGN_RESULT_SCHEMA = 'campaign_result_schema'
-    RESOURCE_INPAGE = 'inpage'
-    RESOURCE_INPAGE_RESULT = 'inpage_result'
+    def __init__(self, credentials):
+        """Initialize a RequestSigner object.
 
-    method = 'GET'
-    host = 'data.usabilla.com'
-    host_protocol = 'https://'
+        :param credentials: The `Credentials` used to sign the requests.
+        :type credentials: Credentials
+        """
+        self.credentials = credentials
+        self._signing_key = (None, None)
+        self._dates = (None, None)
 
-    session = requests.Session()
+    def get_signing_key(self, datestamp):
+        """Get the signing key for the datestamp, deriving it only once per day.
 
-    def __init__(self, client_key, secret_key):
-        """Initialize an APIClient object."""
-        self.query_parameters = ''
-        self.credentials = Credentials(client_key=client_key, secret_key=secret_key)
+        :param datestamp: A `string` in the `%Y%m%d` format.
+        :type datestamp: str
 
-    def sign(self, key, msg):
-        """Get the digest of the message using the specified key."""
-        return hmac.new(key, msg, hashlib.sha256).digest()
+        :returns: The derived signing key.
+        :rtype: bytes
+        """
+        cached_datestamp, signing_key = self._signing_key
+        if cached_datestamp != datestamp:
+            k_date = hmac.new(
+                ('USBL1' + self.credentials.secret_key).encode('utf-8'),
+                datestamp.encode('utf-8'),
+                hashlib.sha256
+            ).digest()
+            signing_key = hmac.new(k_date, b'usbl1_request', hashlib.sha256).digest()
+            self._signing_key = (datestamp, signing_key)
+        return signing_key
 
-    def get_signature_key(self, key, long_date):
-        """Get the signature key."""
-        k_date = self.sign(('USBL1' + key).encode('utf-8'), long_date.encode('utf-8'))
-        k_signing = self.sign(k_date, 'usbl1_request'.encode('utf-8'))
-        return k_signing
+    def get_dates(self, t=None):
+        """Get the date strings used in the headers and the credential scope.
 
-    def set_query_parameters(self, parameters):
-        """Set the query parameters.
+        :param t: A `datetime` (naive ones are taken as UTC), defaults to the current time.
+        :type t: datetime.datetime
 
-        :param parameters: A `dict` representing the query parameters to be used for the request.
-        :type parameters: dict
+        :returns: A `tuple` of the date header, the datestamp and the long date.
+        :rtype: tuple
         """
+        seconds = int(time.time()) if t is None else calendar.timegm(t.utctimetuple())
+        cached_seconds, dates = self._dates
+        if cached_seconds != seconds:
+            tm = time.gmtime(seconds)
+            datestamp = '%04d%02d%02d' % (tm.tm_year, tm.tm_mon, tm.tm_mday)
+            usbldate = '%s, %02d %s %04d %02d:%02d:%02d GMT' % (
+                self.weekdays[tm.tm_wday], tm.tm_mday, self.months[tm.tm_mon - 1], tm.tm_year,
+                tm.tm_hour, tm.tm_min, tm.tm_sec
+            )
+            long_date = '%sT%02d%02d%02dZ' % (datestamp, tm.tm_hour, tm.tm_min, tm.tm_sec)
+            dates = (usbldate, datestamp, long_date)
+            self._dates = (seconds, dates)
+        return dates
 
-        self.query_parameters = urllib.parse.urlencode(OrderedDict(sorted(parameters.items())))
-
-    def get_query_parameters(self):
-        """Get the query parameters."""
-        return self.query_parameters
-
-    def send_signed_request(self, scope):
-        """Send the signed request to the API.
+    def sign_request(self, canonical_uri, canonical_querystring, host, method='GET', t=None):
+        """Get the signed headers of a request.
 
         The process is the following:
             1) Create a canonical request
             2) Create a string to sign
             3) Calculate the signature
-            4) Sign the request
-            5) Send the request
+            4) Construct the authorization header
 
-        :param scope: The resource relative url to query for data.
-        :type scope: str
+        :param canonical_uri: The part of the URI from domain to query.
+        :param canonical_querystring: The sorted and encoded query string.
+        :param host: The host the request is sent to.
+        :param method: The HTTP method of the request.
+        :param t: A `datetime` (naive ones are taken as UTC), defaults to the current time.
 
-        :returns: A `dict` of the data.
+        :type canonical_uri: str
+        :type canonical_querystring: str
+        :type host: str
+        :type method: str
+        :type t: datetime.datetime
+
+        :returns: A `dict` of the headers to send.
         :rtype: dict
         """
-        if self.credentials.client_key is None or self.credentials.secret_key is None:
-            raise GeneralError('Invalid Access Key.', 'The Access Key supplied is invalid.')
+        usbldate, datestamp, long_date = self.get_dates(t)
+
+        canonical_request = '%s\n%s\n%s\ndate:%s\nhost:%s\n\n%s\n%s' % (
+            method, canonical_uri, canonical_querystring, usbldate, host, self.signed_headers, self.payload_hash
+        )
+        credential_scope = datestamp + '/usbl1_request'
+        string_to_sign = '%s\n%s\n%s\n%s' % (
+            self.algorithm, long_date, credential_scope,
+            hashlib.sha256(canonical_request.encode('utf-8')).hexdigest()
+        )
+        signature = hmac.new(
+            self.get_signing_key(datestamp), string_to_sign.encode('utf-8'), hashlib.sha256
+        ).hexdigest()
 
-        # Create a date for headers and the credential string.
-        t = datetime.datetime.utcnow()
-        usbldate = t.strftime('%a, %d %b %Y %H:%M:%S GMT')
-        datestamp = t.strftime('%Y%m%d')  # Date w/o time, used in credential scope
-        long_date = t.strftime('%Y%m%dT%H%M%SZ')
+        authorization_header = '%s Credential=%s/%s, SignedHeaders=%s, Signature=%s' % (
+            self.algorithm, self.credentials.client_key, credential_scope, self.signed_headers, signature
+        )
 
-        # Create canonical URI--the part of the URI from domain to query.
-        canonical_uri = scope
+        return {'date': usbldate, 'Authorization': authorization_header}
 
-        # Create the canonical query string.
-        canonical_querystring = self.get_query_parameters()
+    def sign_batch(self, requests, host, method='GET', t=None):
+        """Pre-sign a batch of requests with the same timestamp.
 
-        # Create the canonical headers and signed headers.
-        canonical_headers = 'date:' + usbldate + '\n' + 'host:' + self.host + '\n'
+        :param requests: An iterable of `(canonical_uri, canonical_querystring)` pairs.
+        :param host: The host the requests are sent to.
+        :param method: The HTTP method of the requests.
+        :param t: A `datetime` (naive ones are taken as UTC), defaults to the current time.
 
-        # Create the list of signed headers.
-        signed_headers = 'date;host'
+        :type requests: iterable
+        :type host: str
+        :type method: str
+        :type t: datetime.datetime
 
-        # Create payload hash (hash of the request body content).
-        payload_hash = hashlib.sha256(''.encode('utf-8')).hexdigest()
+        :returns: A `list` of header `dict`s, in the order of the requests.
+        :rtype: list
+        """
+        if t is None:
+            t = datetime.datetime.now(datetime.timezone.utc)
+        return [self.sign_request(uri, query, host, method, t) for uri, query in requests]
 
-        # Combine elements to create canonical request.
-        canonical_request = '{method}\n{uri}\n{query}\n{can_headers}\n{signed_headers}\n{hash}'.format(
-            method=self.method,
-            uri=canonical_uri,
-            query=canonical_querystring,
-            can_headers=canonical_headers,
-            signed_headers=signed_headers,
-            hash=payload_hash
-        )
 
-        # Match the algorithm to the hashing algorithm you use
-        algorithm = 'USBL1-HMAC-SHA256'
-        credential_scope = datestamp + '/' + 'usbl1_request'
+class BulkRequestError(GeneralError):
 
-        string_to_sign = '{algorithm}\n{long_date}\n{credential_scope}\n{digest}'.format(
-            algorithm=algorithm,
-            long_date=long_date,
-            credential_scope=credential_scope,
-            digest=hashlib.sha256(canonical_request.encode('utf-8')).hexdigest(),
-        )
+    """BulkRequestError API exception.
 
-        # Create the signing key.
-        signing_key = self.get_signature_key(self.credentials.secret_key, datestamp)
-
-        # Sign the string_to_sign using the signing_key.
-        signature = hmac.new(signing_key, (string_to_sign).encode('utf-8'), hashlib.sha256).hexdigest()
-
-        # Constrcut the authorization header.
-        authorization_header = (
-            '{algorithm} Credential={cred}/{cred_scope}, SignedHeaders={signed_headers}, Signature={signature}'
-        ).format(
-            algorithm=algorithm,
-            cred=self.credentials.client_key,
-            cred_scope=credential_scope,
-            signed_headers=signed_headers,
-            signature=signature,
-        )
+    Raised at the end of a bulk request when the requests of some resource IDs failed.
+    The exceptions are available per resource ID in `errors`.
 
-        headers = {'date': usbldate, 'Authorization': authorization_header}
+    """
 
-        # Send the request.
-        request_url = self.host + scope + '?' + canonical_querystring
-        r = self.session.get(self.host_protocol + request_url, headers=headers)
-        r.raise_for_status()
+    def __init__(self, errors):
+        """Initialize a BulkRequestError exception."""
+        super(BulkRequestError, self).__init__(
+            'bulk request failed', 'The requests of %d resource IDs failed.' % len(errors))
+        self.errors = errors
 
-        return r.json()
 
-    def check_resource_validity(self, scope, product, resource):
-        """Checks whether the resource exists
+class RetryPolicy(object):
 
-        :param scope: A `string` that specifies the resource scope
-        :param product: A `string` that specifies the product type
-        :param resource: A `string` that specifies the resource type
+    """RetryPolicy object.
 
-        :type scope: str
-        :type product: str
-        :type resource: str
+    Decides which failed requests are retried and how long to wait before retrying.
+    The wait is the `Retry-After` of the response when it has one, and otherwise an
+    exponential backoff with full jitter.
 
-        :returns: An `string` that represents the resource request url
-        :rtype: string
+    """
+
+    def __init__(self, max_retries=5, backoff_factor=0.5, max_backoff=60.0,
+                 status_codes=(429, 500, 502, 503, 504), retry_connection_errors=True):
+        """Initialize a RetryPolicy object.
+
+        :param max_retries: The maximum number of retries of a request.
+        :param backoff_factor: The backoff in seconds before the first retry, doubled for every retry.
+        :param max_backoff: The maximum backoff in seconds before a retry, a `Retry-After` is waited in full.
+        :param status_codes: The HTTP status codes that are retried.
+        :param retry_connection_errors: A `boolean` that specifies whether connection errors and timeouts are retried.
+
+        :type max_retries: int
+        :type backoff_factor: float
+        :type max_backoff: float
+        :type status_codes: tuple
+        :type retry_connection_errors: bool
         """
-        if scope not in self.resources['scopes'].keys():
-            raise GeneralError('invalid scope', 'Invalid scope name')
-        found_scope = self.resources['scopes'][scope]
-        if product not in found_scope['products'].keys():
-            raise GeneralError('invalid product', 'Invalid product name')
-        found_product = found_scope['products'][product]
-        if resource not in found_product['resources'].keys():
-            raise GeneralError('invalid resource', 'Invalid resource name')
-        found_resource = found_product['resources'][resource]
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.max_backoff = max_backoff
+        self.status_codes = frozenset(status_codes)
+        self.retry_connection_errors = retry_connection_errors
 
-        return '/%s/%s%s' % (scope, product, found_resource)
+    def should_retry(self, attempt, status_code=None):
+        """Check whether a failed attempt is retried.
 
-    def handle_id(self, url, resource_id):
-        """Replaces the :id pattern in the url
+        :param attempt: The number of the failed attempt, starting at 0.
+        :param status_code: The HTTP status code of the response, or `None` for a connection error.
 
-        :param url: A `string` that specifies the resource request url
-        :param resource_id: A `string` that specifies the resource id
+        :type attempt: int
+        :type status_code: int
 
-        :type url: str
-        :type resource_id: str
+        :rtype: bool
+        """
+        if attempt >= self.max_retries:
+            return False
+        if status_code is None:
+            return self.retry_connection_errors
+        return status_code in self.status_codes
 
-        :returns: An `string` that represents the resource request url
-        :rtype: string
+    def get_backoff(self, attempt, retry_after=None):
+        """Get the number of seconds to wait before retrying.
+
+        :param attempt: The number of the failed attempt, starting at 0.
+        :param retry_after: The `Retry-After` header of the response, in seconds or as an HTTP date.
+
+        :type attempt: int
+        :type retry_after: str
+
+        :rtype: float
         """
-        if resource_id is not None:
-            if resource_id == '':
-                raise GeneralError('invalid id', 'Invalid resource ID')
-            if resource_id == '*':
-                resource_id = '%2A'
+        delay = self.parse_retry_after(retry_after)
+        if delay is not None:
+            # Retrying sooner than the server allows would only be throttled again.
+            return delay
+        return min(random.uniform(0, self.backoff_factor * 2 ** attempt), self.max_backoff)
 
-            url = url.replace(':id', str(resource_id))
+    @staticmethod
+    def parse_retry_after(retry_after):
+        """Parse a `Retry-After` header into seconds, `None` if it is missing or invalid."""
+        if not retry_after:
+            return None
+        try:
+            return max(0.0, float(retry_after))
+        except ValueError:
+            pass
+        try:
+            t = email.utils.parsedate_to_datetime(retry_after)
+        except (TypeError, ValueError):
+            return None
+        if t is None:
+            return None
+        return max(0.0, t.timestamp() - time.time())
 
-        return url
 
-    def item_iterator(self, url):
-        """Get items using an iterator.
+class RateLimiter(object):
 
-        :param url: A `string` that specifies the resource request url
+    """RateLimiter object.
 
-        :type url: str
+    A token bucket that allows `rate` requests per second with bursts of `burst` requests.
+    A limiter is thread-safe and can be shared by the threads and clients that use the same
+    account, to keep them under the API quota together.
 
-        :returns: A `generator` that yields the requested data.
-        :rtype: generator
-        :raises requests.exceptions.HTTPError: if an HTTP error occurred
+    """
+
+    def __init__(self, rate, burst=None):
+        """Initialize a RateLimiter object.
+
+        :param rate: The number of requests per second.
+        :param burst: The maximum number of requests at once, defaults to `rate`.
+
+        :type rate: float
+        :type burst: float
         """
-        has_more = True
-        while has_more:
-            results = self.send_signed_request(url)
-            has_more = results['hasMore']
-            for item in results['items']:
-                yield item
-            self.set_query_parameters({'since': results['lastTimestamp']})
+        if rate <= 0:
+            raise GeneralError('invalid rate', 'The rate must be positive.')
 
-        self.set_query_parameters({})
+        self.rate = float(rate)
+        self.burst = float(burst) if burst is not None else max(1.0, self.rate)
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
 
-    def get_resource(self, scope, product, resource, resource_id=None, iterate=False):
-        """Retrieves resources of the specified type
+    def reserve(self, tokens=1):
+        """Take tokens from the bucket.
 
-        :param scope: A `string` that specifies the resource scope
-        :param product: A `string` that specifies the product type
-        :param resource: A `string` that specifies the resource type
-        :param resource_id: A `string` that specifies the resource id
-        :param iterate: A `boolean` that specifies whether the you want to use an iterator
+        :param tokens: The number of tokens to take.
+        :type tokens: float
 
-        :type scope: str
-        :type product: str
-        :type resource: str
-        :type resource_id: str
-        :type iterate: bool
+        :returns: The number of seconds to wait before the tokens are available.
+        :rtype: float
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= tokens
+            return 0.0 if self._tokens >= 0 else -self._tokens / self.rate
 
-        :returns: A `generator` that yields the requested data or a single resource
-        :rtype: generator or single resource
+    def get_delay(self, tokens=1):
+        """Get the number of seconds until tokens are available, without taking them.
+
+        :param tokens: The number of tokens.
+        :type tokens: float
+
+        :rtype: float
         """
-        url = self.handle_id(self.check_resource_validity(scope, product, resource), resource_id)
+        with self._lock:
+            available = min(self.burst, self._tokens + (time.monotonic() - self._updated) * self.rate)
+            return 0.0 if available >= tokens else (tokens - available) / self.rate
 
-        if iterate:
-            return self.item_iterator(url)
-        else:
-            return self.send_signed_request(url)
+    def acquire(self, tokens=1):
+        """Take tokens from the bucket, waiting until they are available.
+
+        :param tokens: The number of tokens to take.
+        :type tokens: float
+        """
+        delay = self.reserve(tokens)
+        if delay > 0:
+            time.sleep(delay)
+
+    def pause(self, seconds):
+        """Make all requests wait for at least `seconds`, after the API asked to slow down.
+
+        :param seconds: The number of seconds to wait.
+        :type seconds: float
+        """
+        with self._lock:
+            # Refill up to now first, or the next reserve would add the time of the pause back.
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens = min(self._tokens, -seconds * self.rate)
+
+
+class CheckpointStore(object):
+
+    """CheckpointStore object.
+
+    Base class of the stores that persist the committed cursor of a synced resource.
+    A key is a `(scope, product, resource, resource_id)` tuple, a cursor is the
+    `lastTimestamp` of the last committed page.
+
+    """
+
+    def get_cursor(self, key):
+        """Get the committed cursor of a key, `None` if nothing was committed."""
+        raise NotImplementedError
+
+    def set_cursor(self, key, cursor):
+        """Commit the cursor of a key."""
+        raise NotImplementedError
+
+    def delete_cursor(self, key):
+        """Remove the cursor of a key, the next sync starts from the beginning."""
+        raise NotImplementedError
+
+    @staticmethod
+    def format_key(key):
+        """Get the string representation of a key."""
+        return '/'.join('' if part is None else str(part) for part in key)
+
+
+class FileCheckpointStore(CheckpointStore):
+
+    """FileCheckpointStore object.
+
+    Keeps the cursors in a JSON file, which is replaced atomically on every commit.
+
+    """
+
+    def __init__(self, path):
+        """Initialize a FileCheckpointStore object.
+
+        :param path: The path of the JSON file.
+        :type path: str
+        """
+        self.path = path
+        self._lock = threading.Lock()
+
+    def _read(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    def _write(self, cursors):
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, temporary_path = tempfile.mkstemp(dir=directory, prefix='.checkpoints-')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(cursors, f, sort_keys=True)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temporary_path, self.path)
+        except BaseException:
+            os.unlink(temporary_path)
+            raise
+
+    def get_cursor(self, key):
+        with self._lock:
+            return self._read().get(self.format_key(key))
+
+    def set_cursor(self, key, cursor):
+        with self._lock:
+            cursors = self._read()
+            cursors[self.format_key(key)] = cursor
+            self._write(cursors)
+
+    def delete_cursor(self, key):
+        with self._lock:
+            cursors = self._read()
+            if cursors.pop(self.format_key(key), None) is not None:
+                self._write(cursors)
+
+
+class SQLiteCheckpointStore(CheckpointStore):
+
+    """SQLiteCheckpointStore object.
+
+    Keeps the cursors in a table of an SQLite database, which can be shared by processes.
+
+    """
+
+    def __init__(self, path, table='usabilla_checkpoints'):
+        """Initialize a SQLiteCheckpointStore object.
+
+        :param path: The path of the database file.
+        :param table: The name of the table of the cursors.
+
+        :type path: str
+        :type table: str
+        """
+        self.path = path
+        self.table = table
+        self._lock = threading.Lock()
+        with self._connect() as connection:
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS %s (key TEXT PRIMARY KEY, cursor INTEGER NOT NULL, updated REAL NOT NULL)'
+                % self.table)
+
+    @contextlib.contextmanager
+    def _connect(self):
+        connection = sqlite3.connect(self.path, timeout=30)
+        try:
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+    def get_cursor(self, key):
+        with self._lock, self._connect() as connection:
+            row = connection.execute(
+                'SELECT cursor FROM %s WHERE key = ?' % self.table, (self.format_key(key),)).fetchone()
+        return row[0] if row is not None else None
+
+    def set_cursor(self, key, cursor):
+        with self._lock, self._connect() as connection:
+            connection.execute(
+                'INSERT OR REPLACE INTO %s (key, cursor, updated) VALUES (?, ?, ?)' % self.table,
+                (self.format_key(key), cursor, time.time()))
+
+    def delete_cursor(self, key):
+        with self._lock, self._connect() as connection:
+            connection.execute('DELETE FROM %s WHERE key = ?' % self.table, (self.format_key(key),))
+
+
+class LeaseStore(object):
+
+    """LeaseStore object.
+
+    Keeps the shards of a job and their leases in a table of an SQLite database, so any
+    number of worker processes sharing the file can split the job. A shard is a resource
+    ID, or a time window of one, and is leased to one worker at a time. A lease that is
+    not renewed within `lease_seconds` expires and the shard can be claimed again, a
+    shard that failed `max_attempts` times is not claimed anymore.
+
+    """
+
+    def __init__(self, path, table='usabilla_leases', lease_seconds=600.0, max_attempts=3):
+        """Initialize a LeaseStore object.
+
+        :param path: The path of the database file.
+        :param table: The name of the table of the shards.
+        :param lease_seconds: The seconds after which a lease that is not renewed expires.
+        :param max_attempts: The number of claims after which a failing shard is given up.
+
+        :type path: str
+        :type table: str
+        :type lease_seconds: float
+        :type max_attempts: int
+        """
+        self.path = path
+        self.table = table
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self._lock = threading.Lock()
+        with self._connect() as connection:
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS %s (shard TEXT PRIMARY KEY, job TEXT NOT NULL, state TEXT NOT NULL, '
+                'owner TEXT, expires REAL, attempts INTEGER NOT NULL DEFAULT 0, result TEXT)' % self.table)
+
+    @contextlib.contextmanager
+    def _connect(self):
+        connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        try:
+            # Taking the write lock up front makes a claim atomic across processes.
+            connection.execute('BEGIN IMMEDIATE')
+            yield connection
+            connection.execute('COMMIT')
+        except BaseException:
+            if connection.in_transaction:
+                connection.execute('ROLLBACK')
+            raise
+        finally:
+            connection.close()
+
+    def add_shards(self, scope, product, resource, resource_ids, since=None, until=None, windows=1):
+        """Add the shards of a resource for every ID, the shards that exist already are kept.
+
+        :param scope: A `string` that specifies the resource scope
+        :param product: A `string` that specifies the product type
+        :param resource: A `string` that specifies the resource type
+        :param resource_ids: A `list` of the resource IDs
+        :param since: An `int` timestamp in milliseconds, the start of the windows (inclusive)
+        :param until: An `int` timestamp in milliseconds, the end of the windows (exclusive), defaults to now
+        :param windows: The number of time windows of every ID, or a `dict` of it per ID, 1 by default
+
+        :type scope: str
+        :type product: str
+        :type resource: str
+        :type resource_ids: list
+        :type since: int
+        :type until: int
+        :type windows: int or dict
+
+        :returns: The number of shards added.
+        :rtype: int
+        """
+        jobs = []
+        for resource_id in resource_ids:
+            count = windows.get(resource_id, 1) if isinstance(windows, dict) else windows
+            job = {'scope': scope, 'product': product, 'resource': resource, 'resource_id': resource_id}
+            if count <= 1:
+                jobs.append(dict(job, since=since, until=until))
+                continue
+            start = since or 0
+            end = until if until is not None else int(time.time() * 1000)
+            bounds = [start + (end - start) * i // count for i in range(count + 1)]
+            jobs.extend(dict(job, since=low, until=high) for low, high in zip(bounds, bounds[1:]) if low < high)
+
+        with self._lock, self._connect() as connection:
+            added = 0
+            for job in jobs:
+                added += connection.execute(
+                    'INSERT OR IGNORE INTO %s (shard, job, state) VALUES (?, ?, ?)' % self.table,
+                    (self.get_shard_name(job), json.dumps(job), 'pending')).rowcount
+        return added
+
+    @staticmethod
+    def get_shard_name(job):
+        """Get the name of the shard of a job, which can be used in file names."""
+        parts = [job['scope'], job['product'], job['resource'], job['resource_id']]
+        if job.get('until') is not None:
+            parts += [job['since'], job['until']]
+        return re.sub(r'[^A-Za-z0-9_.-]+', '_', '-'.join('' if part is None else str(part) for part in parts))
+
+    def claim(self, owner):
+        """Lease the next pending or expired shard to `owner`.
+
+        :param owner: The name of the worker.
+        :type owner: str
+
+        :returns: The job `dict` of the shard with its `shard` name, or `None` if no shard is left.
+        :rtype: dict
+        """
+        now = time.time()
+        with self._lock, self._connect() as connection:
+            # A shard whose workers keep dying is given up like one that keeps failing.
+            connection.execute(
+                "UPDATE %s SET state = 'failed', owner = NULL, expires = NULL "
+                "WHERE state = 'leased' AND expires < ? AND attempts >= ?" % self.table, (now, self.max_attempts))
+            row = connection.execute(
+                "SELECT shard, job FROM %s WHERE state = 'pending' OR (state = 'leased' AND expires < ?) "
+                "ORDER BY rowid LIMIT 1" % self.table, (now,)).fetchone()
+            if row is None:
+                return None
+            connection.execute(
+                "UPDATE %s SET state = 'leased', owner = ?, expires = ?, attempts = attempts + 1 WHERE shard = ?"
+                % self.table, (owner, now + self.lease_seconds, row[0]))
+        return dict(json.loads(row[1]), shard=row[0])
+
+    def renew(self, shard, owner):
+        """Extend the lease of a shard, `False` if `owner` does not hold it anymore."""
+        return self._update_lease(shard, owner, "state = 'leased', expires = ?", (time.time() + self.lease_seconds,))
+
+    def complete(self, shard, owner, result=None):
+        """Mark a leased shard done with a result that can be encoded as JSON, `False` if the lease was lost."""
+        return self._update_lease(shard, owner, "state = 'done', expires = NULL, result = ?", (json.dumps(result),))
+
+    def release(self, shard, owner, error=None):
+        """Give a leased shard back after a failure, so it can be claimed again until `max_attempts`."""
+        return self._update_lease(
+            shard, owner, "state = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, owner = NULL, "
+            "expires = NULL, result = ?", (self.max_attempts, json.dumps(error)))
+
+    def _update_lease(self, shard, owner, assignments, parameters):
+        with self._lock, self._connect() as connection:
+            cursor = connection.execute(
+                "UPDATE %s SET %s WHERE shard = ? AND owner = ? AND state = 'leased' AND expires >= ?"
+                % (self.table, assignments), tuple(parameters) + (shard, owner, time.time()))
+        return cursor.rowcount == 1
+
+    def stats(self):
+        """Get the number of shards per state: `pending`, `leased`, `done` and `failed`."""
+        counts = OrderedDict((state, 0) for state in ['pending', 'leased', 'done', 'failed'])
+        with self._lock, self._connect() as connection:
+            for state, count in connection.execute('SELECT state, COUNT(*) FROM %s GROUP BY state' % self.table):
+                counts[state] = count
+        return counts
+
+    def get_results(self):
+        """Get the results of the shards that are done, by shard name."""
+        with self._lock, self._connect() as connection:
+            rows = connection.execute(
+                "SELECT shard, result FROM %s WHERE state = 'done' ORDER BY rowid" % self.table).fetchall()
+        return OrderedDict((shard, json.loads(result)) for shard, result in rows)
+
+
+class SQLiteMirror(object):
+
+    """SQLiteMirror object.
+
+    A local copy of resource feeds in an SQLite database. An item is stored once per
+    resource key and item id, with its timestamp and the common `fields` in indexed
+    columns and the whole item as JSON. `APIClient.mirror` refreshes a resource from the
+    newest timestamp stored for it, and `query` reads the items back without requests.
+    A key is a `(scope, product, resource, resource_id)` tuple, like the checkpoint keys.
+
+    """
+
+    default_fields = ('buttonId', 'campaignId', 'appId', 'rating', 'nps', 'location')
+
+    def __init__(self, path, table='usabilla_items', fields=None):
+        """Initialize a SQLiteMirror object.
+
+        :param path: The path of the database file.
+        :param table: The name of the table of the items.
+        :param fields: The item fields with an indexed column, `default_fields` by default.
+
+        :type path: str
+        :type table: str
+        :type fields: tuple
+        """
+        self.path = path
+        self.table = table
+        self.fields = tuple(fields if fields is not None else self.default_fields)
+        self._lock = threading.Lock()
+        columns = ''.join(', "%s"' % field for field in self.fields)
+        with self._connect() as connection:
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS %s (resource TEXT NOT NULL, id TEXT NOT NULL, timestamp INTEGER%s, '
+                'data TEXT NOT NULL, PRIMARY KEY (resource, id))' % (self.table, columns))
+            connection.execute(
+                'CREATE INDEX IF NOT EXISTS %s_timestamp ON %s (resource, timestamp)' % (self.table, self.table))
+            for field in self.fields:
+                connection.execute('CREATE INDEX IF NOT EXISTS "%s_%s" ON %s ("%s", timestamp)' % (
+                    self.table, field, self.table, field))
+
+    @contextlib.contextmanager
+    def _connect(self):
+        connection = sqlite3.connect(self.path, timeout=30)
+        try:
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+    def get_row(self, resource, item):
+        """Get the row of an item of the resource with key text `resource`."""
+        if not isinstance(item, dict) or item.get('id') is None:
+            raise GeneralError('invalid item', 'Only items with an id can be mirrored.')
+        values = [item.get(field) for field in self.fields]
+        values = [json.dumps(value) if isinstance(value, (dict, list)) else value for value in values]
+        return [resource, str(item['id']), get_item_timestamp(item)] + values + [json.dumps(item)]
+
+    def store(self, key, items):
+        """Store items of a resource, replacing the stored items with the same id.
+
+        :param key: The key of the resource.
+        :param items: The items to store.
+
+        :type key: tuple
+        :type items: list
+
+        :returns: The number of items stored.
+        :rtype: int
+        """
+        resource = CheckpointStore.format_key(key)
+        rows = [self.get_row(resource, item) for item in items]
+        with self._lock, self._connect() as connection:
+            connection.executemany('INSERT OR REPLACE INTO %s VALUES (%s)' % (
+                self.table, ', '.join('?' * (len(self.fields) + 4))), rows)
+        return len(rows)
+
+    def get_newest_timestamp(self, key):
+        """Get the newest timestamp stored for a resource, `None` if it has no items."""
+        with self._lock, self._connect() as connection:
+            row = connection.execute('SELECT MAX(timestamp) FROM %s WHERE resource = ?' % self.table,
+                                     (CheckpointStore.format_key(key),)).fetchone()
+        return row[0]
+
+    def query(self, key=None, since=None, until=None, where=None, parameters=(), order_by='timestamp',
+              limit=None):
+        """Get stored items.
+
+        :param key: The key of the resource, all resources if `None`.
+        :param since: The first timestamp in milliseconds (inclusive).
+        :param until: The last timestamp in milliseconds (exclusive).
+        :param where: An SQL condition on the columns: `resource`, `id`, `timestamp`, the
+            indexed fields, or `json_extract(data, '$.path')` for other fields of the item.
+        :param parameters: The values of the `?` placeholders in `where`.
+        :param order_by: The SQL order of the items.
+        :param limit: The maximum number of items.
+
+        :type key: tuple
+        :type since: int
+        :type until: int
+        :type where: str
+        :type parameters: tuple
+        :type order_by: str
+        :type limit: int
+
+        :returns: The items.
+        :rtype: list
+        """
+        conditions, values = [], []
+        if key is not None:
+            conditions.append('resource = ?')
+            values.append(CheckpointStore.format_key(key))
+        if since is not None:
+            conditions.append('timestamp >= ?')
+            values.append(since)
+        if until is not None:
+            conditions.append('timestamp < ?')
+            values.append(until)
+        if where:
+            conditions.append('(%s)' % where)
+            values.extend(parameters)
+        sql = 'SELECT data FROM %s' % self.table
+        if conditions:
+            sql += ' WHERE ' + ' AND '.join(conditions)
+        if order_by:
+            sql += ' ORDER BY ' + order_by
+        if limit is not None:
+            sql += ' LIMIT %d' % limit
+        with self._lock, self._connect() as connection:
+            rows = connection.execute(sql, values).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+
+class SyncBatch(object):
+
+    """SyncBatch object.
+
+    The items of one page of a sync. The cursor of the batch is only persisted once the
+    consumer calls `commit`, after it has processed the items.
+
+    """
+
+    def __init__(self, store, key, items, cursor):
+        """Initialize a SyncBatch object."""
+        self.store = store
+        self.key = key
+        self.items = items
+        self.cursor = cursor
+        self.committed = False
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+    def commit(self):
+        """Persist the cursor of the batch, the next sync resumes after these items."""
+        self.store.set_cursor(self.key, self.cursor)
+        self.committed = True
+
+
+class BoundaryFilter(object):
+
+    """BoundaryFilter object.
+
+    Drops the items a page repeats from the end of the page before it. A page ends at
+    `lastTimestamp` and the next page starts at that timestamp, so the items sharing it
+    can be returned twice. Only the ids of the items at the last timestamp of a page
+    are remembered, so memory does not grow with the number of pages. Items without
+    an `id` are always kept.
+
+    """
+
+    def __init__(self):
+        """Initialize a BoundaryFilter object."""
+        self.seen = set()
+        self.cursor = None
+        self.dropped = 0
+        self._date = None
+        self._ids = set()
+
+    def accept(self, item):
+        """Check whether an item of the current page is new, and remember it if it may repeat.
+
+        :param item: An item of the page, in the order of the page.
+
+        :returns: `False` if the item was already returned at the end of the previous page.
+        :rtype: bool
+        """
+        item_id = item.get('id') if isinstance(item, dict) else None
+        if item_id is None:
+            return True
+        if item_id in self.seen:
+            self.dropped += 1
+            return False
+        # The items are in timestamp order, so comparing the dates as text finds the last group.
+        date = item.get('date')
+        if date != self._date:
+            self._date, self._ids = date, set()
+        self._ids.add(item_id)
+        return True
+
+    def end_page(self, cursor):
+        """Finish the current page, whose `lastTimestamp` is `cursor`."""
+        timestamp = get_item_timestamp({'date': self._date}) if self._date is not None else None
+        ids = self._ids if timestamp is not None and timestamp >= cursor else set()
+        if cursor == self.cursor:
+            # A page of one timestamp only, the next one may repeat the items of both.
+            ids = self.seen | ids
+        self.seen, self.cursor = ids, cursor
+        self._date, self._ids = None, set()
+
+
+class PageSizeTuner(object):
+
+    """PageSizeTuner object.
+
+    Tunes the `limit` of the pages of an iterator from the items per second of the pages
+    before. The limit grows by `factor` while the throughput improves and turns around
+    when it drops, within `minimum` and `maximum`. With `max_page_bytes`, the limit stays
+    below the number of items that would make a response larger. `limit` is the size of
+    the next page, `history` the `(limit, items, seconds, bytes)` of the last pages.
+
+    """
+
+    def __init__(self, minimum=50, maximum=1000, start=None, factor=1.5, max_page_bytes=None, history=100):
+        """Initialize a PageSizeTuner object.
+
+        :param minimum: The smallest page size.
+        :param maximum: The largest page size.
+        :param start: The size of the first page, defaults to `minimum`.
+        :param factor: The factor by which the size grows or shrinks per page.
+        :param max_page_bytes: The largest response size in bytes.
+        :param history: The number of pages kept in `history`.
+
+        :type minimum: int
+        :type maximum: int
+        :type start: int
+        :type factor: float
+        :type max_page_bytes: int
+        :type history: int
+        """
+        if minimum < 1 or maximum < minimum or factor <= 1:
+            raise GeneralError('invalid page sizes', 'The page sizes must be 1 <= minimum <= maximum, factor > 1.')
+        self.minimum = minimum
+        self.maximum = maximum
+        self.factor = factor
+        self.max_page_bytes = max_page_bytes
+        self.history = deque(maxlen=history)
+        self.limit = min(maximum, max(minimum, start or minimum))
+        self._item_bytes = None
+        self._rate = None
+        self._direction = 1
+        self._lock = threading.Lock()
+
+    def observe(self, items, seconds, size=None):
+        """Record a page and choose the size of the next one.
+
+        :param items: The number of items of the page.
+        :param seconds: The time the request of the page took.
+        :param size: The size in bytes of the response, if known.
+
+        :type items: int
+        :type seconds: float
+        :type size: int
+
+        :returns: The size of the next page.
+        :rtype: int
+        """
+        with self._lock:
+            self.history.append((self.limit, items, seconds, size))
+            if size and items:
+                self._item_bytes = float(size) / items
+            # A short page is the last one, its throughput says nothing about its size.
+            if items >= self.limit and seconds > 0:
+                rate = items / seconds
+                if self._rate is not None and rate < self._rate:
+                    self._direction = -self._direction
+                self._rate = rate
+                self.limit = self.limit * self.factor if self._direction > 0 else self.limit / self.factor
+            maximum = self.maximum
+            if self.max_page_bytes and self._item_bytes:
+                maximum = min(maximum, int(self.max_page_bytes / self._item_bytes))
+            self.limit = int(max(self.minimum, min(maximum, round(self.limit))))
+            return self.limit
+
+
+class SingleFlight(object):
+
+    """SingleFlight object.
+
+    Shares one call between the threads that make it with the same key at the same
+    time. The first thread runs the call and the others wait for it, then all of them
+    receive its result or raise its error. Nothing is kept once the call is done.
+
+    """
+
+    def __init__(self):
+        """Initialize a SingleFlight object."""
+        self.shared = 0
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, function):
+        """Call `function`, or wait for the call with the same key in progress.
+
+        :param key: The key of the call.
+        :param function: A function without arguments.
+
+        :type key: str
+        :type function: callable
+
+        :returns: The result of the call.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = concurrent.futures.Future()
+            else:
+                self.shared += 1
+        if not leader:
+            return call.result()
+
+        try:
+            result = function()
+        except BaseException as error:
+            self._finish(key)
+            call.set_exception(error)
+            raise
+        self._finish(key)
+        call.set_result(result)
+        return result
+
+    def _finish(self, key):
+        with self._lock:
+            del self._calls[key]
+
+
+class ColumnBatch(object):
+
+    """ColumnBatch object.
+
+    A batch of items kept as columns of the requested fields only. A field is a path of
+    keys joined by dots, such as `data.nps`. The `number` columns are `array.array('d')`
+    buffers with NaN for missing values, the other columns are lists with `None`.
+
+    """
+
+    def __init__(self, fields, types=None):
+        """Initialize a ColumnBatch object.
+
+        :param fields: The field paths of the columns.
+        :param types: The type per field path, `number` or `object`, `object` by default.
+
+        :type fields: list
+        :type types: dict
+        """
+        types = types or {}
+        self.types = OrderedDict((field, types.get(field, 'object')) for field in fields)
+        self.columns = OrderedDict(
+            (field, array.array('d') if kind == 'number' else []) for field, kind in self.types.items())
+        self._paths = [(tuple(field.split('.')), self.columns[field], kind == 'number')
+                       for field, kind in self.types.items()]
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def append(self, item):
+        """Add the requested fields of an item, the rest of it is not kept."""
+        for path, column, numeric in self._paths:
+            value = item
+            for key in path:
+                value = value.get(key) if isinstance(value, dict) else None
+            if numeric:
+                try:
+                    value = float(value)
+                except (TypeError, ValueError):
+                    value = float('nan')
+            column.append(value)
+        self._size += 1
+
+    def rows(self):
+        """Get the items of the batch as tuples in the order of the columns."""
+        return list(zip(*self.columns.values()))
+
+
+class RecordBatch(object):
+
+    """RecordBatch object.
+
+    Holds many items of a resource in a compact form, as one list per field instead of a
+    `dict` per item. Equal strings and nested values, such as urls, browsers and locations,
+    are stored once per batch, the nested values as JSON text. The fields that are unique
+    per item, see `unique_fields`, are stored as they are. Fields of an item that are not
+    in the fields of the resource are kept apart. An item is turned back into a `dict`
+    when it is accessed.
+
+    """
+
+    resource_fields = {
+        'feedback': ['id', 'userAgent', 'comment', 'location', 'browser', 'date', 'custom', 'email', 'image',
+                     'labels', 'nps', 'publicUrl', 'rating', 'buttonId', 'tags', 'url'],
+        'campaign_result': ['id', 'userAgent', 'location', 'date', 'campaignId', 'customData', 'data', 'url', 'time'],
+        'inpage_result': ['id', 'date', 'timestamp', 'url', 'userAgent', 'customData', 'data'],
+    }
+    unique_fields = frozenset(['id', 'date', 'comment', 'time', 'timestamp'])
+
+    _missing = object()
+
+    def __init__(self, resource='feedback', fields=None):
+        """Initialize a RecordBatch object.
+
+        :param resource: The resource of the items, which sets the fields, see `resource_fields`.
+        :param fields: The fields of the items, instead of those of the resource.
+
+        :type resource: str
+        :type fields: list
+        """
+        if fields is None:
+            if resource not in self.resource_fields:
+                raise GeneralError('invalid resource', 'There are no record fields for %s.' % resource)
+            fields = self.resource_fields[resource]
+        self.resource = resource
+        self.fields = list(fields)
+        self.columns = OrderedDict((field, []) for field in self.fields)
+        self.extra = {}
+        self._strings = {}
+        self._packed = {}
+        self._size = 0
+
+    @classmethod
+    def from_items(cls, items, resource='feedback', fields=None):
+        """Create a RecordBatch of items, such as those of `item_iterator`."""
+        batch = cls(resource, fields)
+        batch.extend(items)
+        return batch
+
+    def __len__(self):
+        return self._size
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(self._size))]
+        if index < 0:
+            index += self._size
+        if not 0 <= index < self._size:
+            raise IndexError('record index out of range')
+        item = {}
+        for field, column in self.columns.items():
+            value = self.unpack(column[index])
+            if value is not self._missing:
+                item[field] = value
+        if index in self.extra:
+            item.update(json.loads(self.extra[index]))
+        return item
+
+    def __iter__(self):
+        for index in range(self._size):
+            yield self[index]
+
+    def append(self, item):
+        """Add an item."""
+        for field, column in self.columns.items():
+            column.append(self.pack(field, item.get(field, self._missing)))
+        extra = dict((field, value) for field, value in item.items() if field not in self.columns)
+        if extra:
+            self.extra[self._size] = json.dumps(extra)
+        self._size += 1
+
+    def extend(self, items):
+        """Add items."""
+        for item in items:
+            self.append(item)
+
+    def pack(self, field, value):
+        """Get the stored form of the value of a field."""
+        if isinstance(value, (dict, list)):
+            value = _PackedValue(json.dumps(value))
+            return self._packed.setdefault(value, value)
+        if not isinstance(value, str) or field in self.unique_fields:
+            return value
+        # Equal values share one object, like `sys.intern` but released with the batch.
+        return self._strings.setdefault(value, value)
+
+    def unpack(self, value):
+        """Get the value of a field from its stored form."""
+        return json.loads(value) if isinstance(value, _PackedValue) else value
+
+    def column(self, field):
+        """Get the values of a field of all items, `None` where an item has no value."""
+        return [None if value is self._missing else self.unpack(value) for value in self.columns[field]]
+
+
+class _PackedValue(str):
+
+    """The JSON text of a nested value in a `RecordBatch`."""
+
+    __slots__ = ()
+
+
+class FeedbackAggregator(object):
+
+    """FeedbackAggregator object.
+
+    Folds feedback items or campaign results into counts and score histograms per group,
+    with NumPy. A group is the value of the `group_by` field and, with an `interval`, the
+    start of the time bucket of the item's date. The scores, such as ratings, NPS and
+    mood, are summed per group for the means, and counted per integer from 0 up to `scale`
+    for the percentiles and NPS, so new items only add to them. It requires `numpy`.
+
+    """
+
+    def __init__(self, values=('rating',), group_by=None, interval=None, scale=11, percentiles=(50, 90),
+                 batch_size=10000):
+        """Initialize a FeedbackAggregator object.
+
+        :param values: The field paths of the scores, such as `rating` or `data.mood`.
+        :param group_by: The field path to group by, such as `url`, or `None`.
+        :param interval: The length of the time buckets in seconds, such as 86400 for days, or `None`.
+        :param scale: The number of histogram bins, 11 for the scores 0 to 10. The percentiles and NPS
+            count the scores in the bins, the means and counts every number.
+        :param percentiles: The percentiles of the scores in the results.
+        :param batch_size: The number of items converted to arrays at a time.
+
+        :type values: list
+        :type group_by: str
+        :type interval: int
+        :type scale: int
+        :type percentiles: list
+        :type batch_size: int
+        """
+        if numpy is None:
+            raise GeneralError('missing dependency', 'Aggregating requires numpy.')
+        self.values = list(values)
+        self.group_by = group_by
+        self.interval = interval
+        self.scale = scale
+        self.percentiles = list(percentiles)
+        self.batch_size = batch_size
+        self.fields = self.values + [field for field in [group_by, 'date' if interval else None] if field]
+        self.groups = OrderedDict()
+        self.counts = numpy.zeros(0, dtype=numpy.int64)
+        self.sums = OrderedDict((field, numpy.zeros(0, dtype=numpy.float64)) for field in self.values)
+        self.totals = OrderedDict((field, numpy.zeros(0, dtype=numpy.int64)) for field in self.values)
+        self.histograms = OrderedDict(
+            (field, numpy.zeros((0, scale), dtype=numpy.int64)) for field in self.values)
+
+    def update(self, items):
+        """Add items, such as the `items` of a page, to the aggregates.
+
+        :param items: The items.
+        :type items: iterable
+
+        :returns: The number of items added.
+        :rtype: int
+        """
+        added = 0
+        batch = self.new_batch()
+        for item in items:
+            batch.append(item)
+            if len(batch) >= self.batch_size:
+                added += self.add_batch(batch)
+                batch = self.new_batch()
+        return added + self.add_batch(batch)
+
+    def new_batch(self):
+        return ColumnBatch(self.fields, dict((field, 'number') for field in self.values))
+
+    def add_batch(self, batch):
+        """Add a `ColumnBatch` with columns for the fields of the aggregator.
+
+        :param batch: The batch.
+        :type batch: ColumnBatch
+
+        :returns: The number of items added.
+        :rtype: int
+        """
+        if not len(batch):
+            return 0
+        rows = self.get_rows(batch)
+        size = len(self.groups)
+        self.counts += numpy.bincount(rows, minlength=size)
+        for field, histogram in self.histograms.items():
+            scores = numpy.asarray(batch.columns[field], dtype=numpy.float64)
+            numbers = numpy.isfinite(scores)
+            self.sums[field] += numpy.bincount(rows[numbers], weights=scores[numbers], minlength=size)
+            self.totals[field] += numpy.bincount(rows[numbers], minlength=size)
+            valid = numbers & (scores >= 0) & (scores < self.scale)
+            bins = rows[valid] * self.scale + scores[valid].astype(numpy.int64)
+            histogram += numpy.bincount(bins, minlength=size * self.scale).reshape(size, self.scale)
+        return len(batch)
+
+    def get_rows(self, batch):
+        """Get the row of the group of every item of a batch, adding rows for new groups."""
+        columns = []
+        if self.group_by:
+            columns.append(self.get_group_column(batch.columns[self.group_by]))
+        if self.interval:
+            length = int(self.interval * 1000)
+            columns.append(self.get_timestamp_column(batch.columns['date']) // length * length)
+
+        codes = numpy.zeros(len(batch), dtype=numpy.int64)
+        uniques = []
+        for column in columns:
+            unique, inverse = numpy.unique(column, return_inverse=True)
+            codes = codes * len(unique) + inverse.reshape(-1)
+            uniques.append(unique)
+        codes, inverse = numpy.unique(codes, return_inverse=True)
+
+        rows = numpy.empty(len(codes), dtype=numpy.int64)
+        for index, code in enumerate(codes.tolist()):
+            key = []
+            for unique in reversed(uniques):
+                code, position = divmod(code, len(unique))
+                key.insert(0, unique[position].item())
+            key = tuple(key) if len(key) > 1 else (key[0] if key else None)
+            rows[index] = self.groups.setdefault(key, len(self.groups))
+
+        grow = len(self.groups) - len(self.counts)
+        if grow:
+            self.counts = numpy.concatenate([self.counts, numpy.zeros(grow, dtype=numpy.int64)])
+            for field in self.values:
+                self.sums[field] = numpy.concatenate([self.sums[field], numpy.zeros(grow, dtype=numpy.float64)])
+                self.totals[field] = numpy.concatenate([self.totals[field], numpy.zeros(grow, dtype=numpy.int64)])
+            for field, histogram in self.histograms.items():
+                self.histograms[field] = numpy.vstack([histogram, numpy.zeros((grow, self.scale), dtype=numpy.int64)])
+        return rows[inverse.reshape(-1)]
+
+    @staticmethod
+    def get_group_column(values):
+        """Get the `group_by` values of a batch as an array of strings, `''` for missing values."""
+        column = numpy.array(values)
+        # Strings and integers convert at once, mixed and missing values one by one.
+        if column.ndim != 1 or column.dtype.kind not in 'Uib':
+            column = numpy.array(['' if value is None else str(value) for value in values])
+        return column.astype(str)
+
+    @staticmethod
+    def get_timestamp_column(dates):
+        """Get the timestamps in milliseconds of the ISO 8601 dates of a batch, 0 for missing dates."""
+        try:
+            with warnings.catch_warnings():
+                # NumPy only warns about dates with an offset, with a warning class that depends on
+                # its version, they are converted one by one.
+                warnings.simplefilter('error')
+                column = numpy.array([date.rstrip('Z') if isinstance(date, str) else 'NaT' for date in dates],
+                                     dtype='datetime64[ms]')
+        except (ValueError, Warning):
+            return numpy.fromiter((get_item_timestamp({'date': date}, 0) for date in dates), numpy.int64, len(dates))
+        return numpy.where(numpy.isnat(column), 0, column.astype(numpy.int64))
+
+    def results(self):
+        """Get the aggregates of every group, sorted by group.
+
+        Every group has the `count` of its items and per score field the `count` of the
+        numeric scores, their `mean`, the percentiles of the scores in the histogram as
+        `p50` and so on, and for NPS fields the `nps` score.
+
+        :returns: An `OrderedDict` with the aggregates per group.
+        :rtype: OrderedDict
+        """
+        fields = OrderedDict()
+        for field, histogram in self.histograms.items():
+            count = histogram.sum(axis=1)
+            cumulative = histogram.cumsum(axis=1)
+            with numpy.errstate(invalid='ignore', divide='ignore'):
+                columns = OrderedDict([
+                    ('count', self.totals[field]), ('mean', self.sums[field] / self.totals[field])])
+                for percentile in self.percentiles:
+                    rank = numpy.maximum(numpy.ceil(count * percentile / 100.0), 1)
+                    values = numpy.argmax(cumulative >= rank[:, None], axis=1).astype(numpy.float64)
+                    columns['p%g' % percentile] = numpy.where(count > 0, values, numpy.nan)
+                if field.split('.')[-1] == 'nps':
+                    columns['nps'] = (histogram[:, 9:].sum(axis=1) - histogram[:, :7].sum(axis=1)) * 100.0 / count
+            fields[field] = OrderedDict((name, column.tolist()) for name, column in columns.items())
+
+        results = OrderedDict()
+        for key, row in sorted(self.groups.items(), key=lambda group: group[0]):
+            result = OrderedDict([('count', int(self.counts[row]))])
+            for field, columns in fields.items():
+                result[field] = OrderedDict((name, column[row]) for name, column in columns.items())
+            results[key] = result
+        return results
+
+
+class MemoryCacheBackend(object):
+
+    """MemoryCacheBackend object.
+
+    Keeps cache entries in memory and evicts the least recently used one when full.
+
+    """
+
+    def __init__(self, max_entries=1024):
+        """Initialize a MemoryCacheBackend object.
+
+        :param max_entries: The maximum number of entries kept.
+        :type max_entries: int
+        """
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Get the `(expires, value)` entry of a key, `None` if it is missing."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def set(self, key, entry):
+        """Store an `(expires, value)` entry.
+
+        :returns: The number of entries evicted.
+        :rtype: int
+        """
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            evicted = 0
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                evicted += 1
+            return evicted
+
+    def delete(self, key):
+        """Remove the entry of a key."""
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def keys(self):
+        """Get the keys of all entries."""
+        with self._lock:
+            return list(self._entries)
+
+
+class DiskCacheBackend(object):
+
+    """DiskCacheBackend object.
+
+    Keeps cache entries as files in a directory, so they survive restarts and can be shared
+    by processes. The modification time of a file is its last use, the least recently used
+    files are removed when the directory holds more than `max_entries` entries.
+
+    """
+
+    suffix = '.usabilla-cache'
+
+    def __init__(self, directory, max_entries=1024):
+        """Initialize a DiskCacheBackend object.
+
+        :param directory: The directory of the cache files, created when missing.
+        :param max_entries: The maximum number of entries kept.
+
+        :type directory: str
+        :type max_entries: int
+        """
+        self.directory = directory
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, hashlib.sha256(key.encode('utf-8')).hexdigest() + self.suffix)
+
+    def _paths(self):
+        return [os.path.join(self.directory, name) for name in os.listdir(self.directory) if name.endswith(self.suffix)]
+
+    def _read(self, path):
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def get(self, key):
+        """Get the `(expires, value)` entry of a key, `None` if it is missing."""
+        path = self._path(key)
+        stored = self._read(path)
+        if stored is None or stored['key'] != key:
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return stored['expires'], stored['value']
+
+    def set(self, key, entry):
+        """Store an `(expires, value)` entry.
+
+        :returns: The number of entries evicted.
+        :rtype: int
+        """
+        expires, value = entry
+        fd, temporary_path = tempfile.mkstemp(dir=self.directory, prefix='.tmp-')
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'key': key, 'expires': expires, 'value': value}, f)
+        os.replace(temporary_path, self._path(key))
+
+        with self._lock:
+            paths = self._paths()
+            if len(paths) <= self.max_entries:
+                return 0
+            paths.sort(key=lambda path: os.stat(path).st_mtime)
+            evicted = paths[:len(paths) - self.max_entries]
+            for path in evicted:
+                self._remove(path)
+            return len(evicted)
+
+    def _remove(self, path):
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+    def delete(self, key):
+        """Remove the entry of a key."""
+        self._remove(self._path(key))
+
+    def keys(self):
+        """Get the keys of all entries."""
+        stored = (self._read(path) for path in self._paths())
+        return [entry['key'] for entry in stored if entry is not None]
+
+
+class ResponseCache(object):
+
+    """ResponseCache object.
+
+    Caches the responses of `send_signed_request` per canonical URI and sorted query string.
+    Every resource has its own time to live, the resources without one are not cached. By
+    default only the metadata resources, which rarely change, are cached.
+
+    """
+
+    default_ttls = {
+        'button': 300,
+        'app': 300,
+        'campaign': 300,
+        'campaign_result_schema': 300,
+        'inpage': 300,
+    }
+
+    def __init__(self, backend=None, ttls=None, default_ttl=None):
+        """Initialize a ResponseCache object.
+
+        :param backend: A `MemoryCacheBackend` or `DiskCacheBackend`, defaults to a memory backend.
+        :param ttls: A `dict` of the time to live in seconds per resource, defaults to `default_ttls`.
+        :param default_ttl: The time to live of the resources not in `ttls`, `None` to not cache them.
+
+        :type backend: MemoryCacheBackend
+        :type ttls: dict
+        :type default_ttl: float
+        """
+        self.backend = backend if backend is not None else MemoryCacheBackend()
+        self.ttls = dict(self.default_ttls if ttls is None else ttls)
+        self.default_ttl = default_ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+
+    def get_ttl(self, resource):
+        """Get the time to live of a resource, `None` if it is not cached."""
+        return self.ttls.get(resource, self.default_ttl)
+
+    def get(self, key):
+        """Get the cached data of a key, `None` on a miss."""
+        entry = self.backend.get(key)
+        if entry is not None and entry[0] <= time.time():
+            self.backend.delete(key)
+            entry = None
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return json.loads(entry[1])
+
+    def set(self, key, data, ttl):
+        """Cache the data of a key for `ttl` seconds."""
+        evicted = self.backend.set(key, (time.time() + ttl, json.dumps(data)))
+        if evicted:
+            with self._lock:
+                self.evictions += evicted
+
+    def invalidate(self, prefix=''):
+        """Remove the entries whose key starts with `prefix`, by default all entries.
+
+        :param prefix: A canonical URI, optionally followed by a query string.
+        :type prefix: str
+
+        :returns: The number of entries removed.
+        :rtype: int
+        """
+        keys = [key for key in self.backend.keys() if key.startswith(prefix)]
+        for key in keys:
+            self.backend.delete(key)
+        return len(keys)
+
+    def stats(self):
+        """Get the hit, miss and eviction counts and the number of entries.
+
+        :rtype: dict
+        """
+        with self._lock:
+            stats = {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+        stats['entries'] = len(self.backend.keys())
+        return stats
+
+
+class MetricsAggregator(object):
+
+    """MetricsAggregator object.
+
+    A hook that aggregates the events of one or more clients into counters and latency
+    histograms per request phase. Register it with `APIClient.add_hook`, then read it
+    with `snapshot` or in the Prometheus text format with `render_prometheus`.
+
+    """
+
+    default_buckets = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+    phases = ('sign', 'response', 'download', 'decode', 'total')
+
+    def __init__(self, buckets=None):
+        """Initialize a MetricsAggregator object.
+
+        :param buckets: The upper bounds in seconds of the histogram buckets.
+        :type buckets: tuple
+        """
+        self.buckets = tuple(sorted(buckets if buckets is not None else self.default_buckets))
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Set all counters and histograms to zero."""
+        with self._lock:
+            self.counters = OrderedDict(
+                (name, 0) for name in ('requests', 'errors', 'retries', 'response_bytes', 'pages', 'items', 'duplicates'))
+            self.statuses = {}
+            self.histograms = OrderedDict(
+                (phase, {'buckets': [0] * (len(self.buckets) + 1), 'sum': 0.0, 'count': 0}) for phase in self.phases)
+            self.cursors = {}
+
+    def __call__(self, event):
+        with self._lock:
+            if event['type'] == 'request':
+                self.counters['requests'] += 1
+                self.counters['response_bytes'] += event['bytes']
+                if event['error'] is not None:
+                    self.counters['errors'] += 1
+                if event['attempt']:
+                    self.counters['retries'] += 1
+                if event['status'] is not None:
+                    self.statuses[event['status']] = self.statuses.get(event['status'], 0) + 1
+                timings = event['timings']
+                for phase, seconds in timings.items():
+                    self._observe(phase, seconds)
+                self._observe('total', sum(timings.values()))
+            elif event['type'] == 'page':
+                self.counters['pages'] += 1
+                self.counters['items'] += event['items']
+                self.counters['duplicates'] += event.get('duplicates', 0)
+                self.cursors[event['url']] = event['cursor']
+
+    def _observe(self, phase, seconds):
+        histogram = self.histograms.get(phase)
+        if histogram is None:
+            return
+        histogram['buckets'][bisect.bisect_left(self.buckets, seconds)] += 1
+        histogram['sum'] += seconds
+        histogram['count'] += 1
+
+    def snapshot(self):
+        """Get a copy of the counters, the response statuses, the histograms and the last cursor per url.
+
+        The histogram buckets are cumulative counts per upper bound, like Prometheus.
+
+        :rtype: dict
+        """
+        with self._lock:
+            histograms = OrderedDict()
+            for phase, histogram in self.histograms.items():
+                cumulative, total = OrderedDict(), 0
+                for bound, count in zip(self.buckets + (float('inf'),), histogram['buckets']):
+                    total += count
+                    cumulative[bound] = total
+                histograms[phase] = {'buckets': cumulative, 'sum': histogram['sum'], 'count': histogram['count']}
+            return {
+                'counters': OrderedDict(self.counters),
+                'statuses': dict(self.statuses),
+                'histograms': histograms,
+                'cursors': dict(self.cursors),
+            }
+
+    def render_prometheus(self, prefix='usabilla_client'):
+        """Get the metrics in the Prometheus text exposition format.
+
+        :param prefix: The prefix of the metric names.
+        :type prefix: str
+
+        :rtype: str
+        """
+        snapshot = self.snapshot()
+        lines = []
+        for name, value in snapshot['counters'].items():
+            lines.append('# TYPE %s_%s_total counter' % (prefix, name))
+            lines.append('%s_%s_total %d' % (prefix, name, value))
+        lines.append('# TYPE %s_responses_total counter' % prefix)
+        for status, count in sorted(snapshot['statuses'].items()):
+            lines.append('%s_responses_total{status="%d"} %d' % (prefix, status, count))
+        lines.append('# TYPE %s_request_seconds histogram' % prefix)
+        for phase, histogram in snapshot['histograms'].items():
+            for bound, count in histogram['buckets'].items():
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append('%s_request_seconds_bucket{phase="%s",le="%s"} %d' % (prefix, phase, le, count))
+            lines.append('%s_request_seconds_sum{phase="%s"} %r' % (prefix, phase, histogram['sum']))
+            lines.append('%s_request_seconds_count{phase="%s"} %d' % (prefix, phase, histogram['count']))
+        return '\n'.join(lines) + '\n'
+
+
+class ExportWriter(object):
+
+    """ExportWriter object.
+
+    The base of the export writers. Items are buffered and written in batches of
+    `batch_size`, and the output moves on to a new file once a file holds `max_items`
+    items or `max_bytes` bytes. The path may contain `{part}`, which is replaced by the
+    number of the file; without it the number is added before the extension when the
+    output rotates. `files`, `items` and `bytes` keep track of what has been written.
+
+    """
+
+    compressions = {'gzip': '.gz', 'bz2': '.bz2', 'xz': '.xz'}
+    openers = {None: open, 'gzip': gzip.open, 'bz2': bz2.open, 'xz': lzma.open}
+
+    def __init__(self, path, compression=None, batch_size=1000, max_items=None, max_bytes=None):
+        """Initialize an ExportWriter object.
+
+        :param path: The path of the output file.
+        :param compression: The compression of the files, one of `compressions`.
+        :param batch_size: The number of items buffered before they are written.
+        :param max_items: The number of items after which a new file is started.
+        :param max_bytes: The size in bytes after which a new file is started.
+
+        :type path: str
+        :type compression: str
+        :type batch_size: int
+        :type max_items: int
+        :type max_bytes: int
+        """
+        if compression is not None and compression not in self.compressions:
+            raise GeneralError('invalid compression', 'The compression must be one of %s.' % ', '.join(
+                sorted(self.compressions)))
+        if batch_size < 1:
+            raise GeneralError('invalid batch size', 'The batch size must be at least 1.')
+        self.path = path
+        self.compression = compression
+        self.batch_size = batch_size
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.files = []
+        self.items = 0
+        self.bytes = 0
+        self._batch = []
+        self._file = None
+        self._file_items = 0
+        self._file_bytes = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def get_path(self, part):
+        """Get the path of the file with number `part`, starting at 1."""
+        if '{part' in self.path:
+            path = self.path.format(part=part)
+        elif self.max_items or self.max_bytes:
+            root, extension = os.path.splitext(self.path)
+            path = '%s-%05d%s' % (root, part, extension)
+        else:
+            path = self.path
+        return path + self.compressions.get(self.compression, '')
+
+    def open_file(self, path):
+        """Open a file of the output for writing bytes."""
+        return self.openers[self.compression](path, 'wb')
+
+    def close_file(self):
+        """Close the current file of the output."""
+        self._file.close()
+
+    def prepare(self, rows):
+        """Prepare a batch of items for `write_rows`."""
+        return rows
+
+    def write_rows(self, rows):
+        """Write a batch of rows to the current file and return the number of bytes written."""
+        raise NotImplementedError
+
+    def write(self, item):
+        """Add an item to the output, it is written with the rest of its batch."""
+        self._batch.append(item)
+        self.items += 1
+        if len(self._batch) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """Write the buffered items."""
+        if not self._batch:
+            return
+        rows, self._batch = self.prepare(self._batch), []
+        while rows:
+            if self._file is None:
+                path = self.get_path(len(self.files) + 1)
+                self._file = self.open_file(path)
+                self.files.append(path)
+                self._file_items = self._file_bytes = 0
+            count = min(self.max_items - self._file_items, len(rows)) if self.max_items else len(rows)
+            size = self.write_rows(rows[:count])
+            rows = rows[count:]
+            self._file_items += count
+            self._file_bytes += size
+            self.bytes += size
+            if ((self.max_items and self._file_items >= self.max_items) or
+                    (self.max_bytes and self._file_bytes >= self.max_bytes)):
+                self.close_file()
+                self._file = None
+
+    def close(self):
+        """Write the buffered items and close the output."""
+        self.flush()
+        if self._file is not None:
+            self.close_file()
+            self._file = None
+
+    def discard(self):
+        """Drop the buffered items and close the output, the files written so far are kept."""
+        self._batch = []
+        self.close()
+
+
+class NDJSONWriter(ExportWriter):
+
+    """NDJSONWriter object.
+
+    Writes every item as a line of JSON.
+
+    """
+
+    def write_rows(self, rows):
+        data = ''.join(json.dumps(row, ensure_ascii=False) + '\n' for row in rows).encode('utf-8')
+        self._file.write(data)
+        return len(data)
+
+
+class CSVWriter(ExportWriter):
+
+    """CSVWriter object.
+
+    Writes the flattened items as rows of a CSV file with a header. The columns are
+    `fields`, or those of the items of the first batch.
+
+    """
+
+    def __init__(self, path, fields=None, **kwargs):
+        """Initialize a CSVWriter object.
+
+        :param path: The path of the output file.
+        :param fields: The columns of the file, by default those of the first batch.
+
+        :type path: str
+        :type fields: list
+        """
+        super(CSVWriter, self).__init__(path, **kwargs)
+        self.fields = list(fields) if fields is not None else None
+
+    def prepare(self, rows):
+        rows = [flatten_item(row) for row in rows]
+        if self.fields is None:
+            self.fields = list(OrderedDict((field, None) for row in rows for field in row))
+        return rows
+
+    def write_rows(self, rows):
+        buffer = io.StringIO()
+        writer = csv.DictWriter(buffer, self.fields, extrasaction='ignore')
+        if not self._file_items:
+            writer.writeheader()
+        writer.writerows(rows)
+        data = buffer.getvalue().encode('utf-8')
+        self._file.write(data)
+        return len(data)
+
+
+class ParquetWriter(ExportWriter):
+
+    """ParquetWriter object.
+
+    Writes the flattened items to columnar Parquet files, a row group per batch. The
+    schema is that of the first batch. It requires `pyarrow`, and compresses the
+    columns itself rather than the whole file.
+
+    """
+
+    compressions = dict.fromkeys(('snappy', 'gzip', 'brotli', 'zstd', 'lz4'), '')
+
+    def __init__(self, path, compression='snappy', batch_size=10000, schema=None, **kwargs):
+        """Initialize a ParquetWriter object.
+
+        :param path: The path of the output file.
+        :param compression: The compression of the columns.
+        :param batch_size: The number of items in a row group.
+        :param schema: The `pyarrow.Schema` of the files, by default that of the first batch.
+
+        :type path: str
+        :type compression: str
+        :type batch_size: int
+        :type schema: pyarrow.Schema
+        """
+        if pyarrow is None:
+            raise GeneralError('missing dependency', 'Writing Parquet files requires pyarrow.')
+        super(ParquetWriter, self).__init__(path, compression=compression, batch_size=batch_size, **kwargs)
+        self.schema = schema
+
+    def open_file(self, path):
+        return pyarrow.parquet.ParquetWriter(path, self.schema, compression=self.compression)
+
+    def prepare(self, rows):
+        table = pyarrow.Table.from_pylist([flatten_item(row) for row in rows], schema=self.schema)
+        self.schema = table.schema
+        return table
+
+    def write_rows(self, table):
+        self._file.write_table(table)
+        return table.nbytes
+
+
+class BaseAPIClient(object):
+
+    """BaseAPIClient object.
+
+    The resources, signing, query parameters and hooks that the `APIClient` and the
+    `AsyncAPIClient` share. It sends no requests itself.
+
+    For the key derivation functions see:
+        http://docs.aws.amazon.com/general/latest/gr/signature-v4-examples.html#signature-v4-examples-python
+
+    """
+
+    resources = {
+        'scopes': {
+            'live': {
+                'products': {
+                    'websites': {
+                        'resources': {
+                            'button': '/button',
+                            'feedback': '/button/:id/feedback',
+                            'campaign': '/campaign',
+                            'campaign_result': '/campaign/:id/results',
+                            'campaign_stats': '/campaign/:id/stats',
+                            'inpage': '/inpage',
+                            'inpage_result': '/inpage/:id/feedback'
+                        }
+                    },
+                    'email': {
+                        'resources': {
+                            'button': '/button',
+                            'feedback': '/button/:id/feedback'
+                        }
+                    },
+                    'apps': {
+                        'resources': {
+                            'app': '',
+                            'feedback': '/:id/feedback',
+                            'campaign': '/campaign',
+                            'campaign_result': '/campaign/:id/results',
+                            'campaign_result_schema': '/campaign/:id/results/schema'
+                        }
+                    }
+                }
+            }
+        }
+    }
+
+    """ Scope constants """
+    SCOPE_LIVE = 'live'
+
+    """ Product contants """
+    PRODUCT_WEBSITES = 'websites'
+    PRODUCT_EMAIL = 'email'
+    PRODUCT_APPS = 'apps'
+
+    """ Resource contants """
+    RESOURCE_FEEDBACK = 'feedback'
+    RESOURCE_APP = 'app'
+    RESOURCE_BUTTON = 'button'
+    RESOURCE_CAMPAIGN = 'campaign'
+    RESOURCE_CAMPAIGN_RESULT = 'campaign_result'
+    RESOURCE_CAMPAIGN_STATS = 'campaign_stats'
+    RESOURCE_CAMPAIGN_RESULT_SCHEMA = 'campaign_result_schema'
+    RESOURCE_INPAGE = 'inpage'
+    RESOURCE_INPAGE_RESULT = 'inpage_result'
+
+    method = 'GET'
+    host = 'data.usabilla.com'
+    host_protocol = 'https://'
+
+    def __init__(self, client_key, secret_key, retry_policy=None, rate_limiter=None, json_decoder=None,
+                 decode_executor=None):
+        """Initialize a BaseAPIClient object.
+
+        :param client_key: The client key of the credentials.
+        :param secret_key: The secret key of the credentials.
+        :param retry_policy: A `RetryPolicy` for failed requests, by default requests are not retried.
+        :param rate_limiter: A `RateLimiter` that every request waits for, it can be shared between clients.
+        :param json_decoder: A function that decodes the `bytes` of a body, or the name of a backend
+            for `get_json_decoder`, by default the standard library.
+        :param decode_executor: A `concurrent.futures.Executor` that decodes the bodies.
+
+        :type client_key: str
+        :type secret_key: str
+        :type retry_policy: RetryPolicy
+        :type rate_limiter: RateLimiter
+        :type json_decoder: callable or str
+        :type decode_executor: concurrent.futures.Executor
+        """
+        self.query_parameters = ''
+        self.credentials = Credentials(client_key=client_key, secret_key=secret_key)
+        self.signer = RequestSigner(self.credentials)
+        self.retry_policy = retry_policy
+        self.rate_limiter = rate_limiter
+        self.hooks = []
+        self.dropped_duplicates = 0
+        self._lock = threading.Lock()
+        if isinstance(json_decoder, str):
+            json_decoder = get_json_decoder(json_decoder)
+        self.json_decoder = json_decoder
+        self.decode_executor = decode_executor
+
+    def add_hook(self, hook):
+        """Register a function that is called with an event `dict` for every request and page.
+
+        Request events have the `url`, `query`, `attempt` (the number of retries before it),
+        `status`, `error`, the response `bytes` and the `timings` in seconds of the phases
+        `sign`, `response` (connecting and waiting for the headers), `download` and `decode`.
+        Page events have the `url`, the number of `items`, `has_more` and the `cursor`.
+
+        :param hook: A function that takes an event `dict`.
+        :type hook: callable
+        """
+        self.hooks = self.hooks + [hook]
+
+    def remove_hook(self, hook):
+        """Unregister a function registered with `add_hook`."""
+        self.hooks = [registered for registered in self.hooks if registered != hook]
+
+    def emit(self, event):
+        """Call the registered hooks with an event `dict`."""
+        for hook in self.hooks:
+            hook(event)
+
+    def sign(self, key, msg):
+        """Get the digest of the message using the specified key."""
+        return hmac.new(key, msg, hashlib.sha256).digest()
+
+    def get_signature_key(self, key, long_date):
+        """Get the signature key."""
+        k_date = self.sign(('USBL1' + key).encode('utf-8'), long_date.encode('utf-8'))
+        k_signing = self.sign(k_date, 'usbl1_request'.encode('utf-8'))
+        return k_signing
+
+    def encode_query_parameters(self, parameters):
+        """Encode query parameters into the canonical query string.
+
+        :param parameters: A `dict` representing the query parameters.
+        :type parameters: dict
+
+        :returns: The query string, sorted by parameter name.
+        :rtype: str
+        """
+        return urllib.parse.urlencode(OrderedDict(sorted(parameters.items())))
+
+    def set_query_parameters(self, parameters):
+        """Set the default query parameters.
+
+        These are used by the requests that are not given their own query parameters.
+
+        :param parameters: A `dict` representing the query parameters to be used for the request.
+        :type parameters: dict
+        """
+
+        self.query_parameters = self.encode_query_parameters(parameters)
+
+    def get_query_parameters(self):
+        """Get the query parameters."""
+        return self.query_parameters
+
+    def get_query_parameters_dict(self, query_parameters=None):
+        """Get the query parameters of a request as a new `dict`.
+
+        :param query_parameters: A `dict` of query parameters, defaults to the client's query parameters.
+        :type query_parameters: dict
+
+        :returns: A copy of the query parameters.
+        :rtype: dict
+        """
+        if query_parameters is None:
+            return OrderedDict(urllib.parse.parse_qsl(self.get_query_parameters()))
+        return OrderedDict(query_parameters)
+
+    def next_page_parameters(self, query_parameters, results):
+        """Get the query parameters of the page after `results`.
+
+        :param query_parameters: A `dict` of the query parameters of the current page.
+        :param results: A `dict` of the current page.
+
+        :type query_parameters: dict
+        :type results: dict
+
+        :returns: A new `dict` of the query parameters.
+        :rtype: dict
+        """
+        query_parameters = OrderedDict(query_parameters)
+        query_parameters['since'] = results['lastTimestamp']
+        return query_parameters
+
+    def get_retry_delay(self, attempt, status_code, retry_after):
+        """Get the wait before retrying a response, and slow down the rate limiter on a 429.
+
+        :param attempt: The number of the failed attempt, starting at 0.
+        :param status_code: The HTTP status code of the response.
+        :param retry_after: The `Retry-After` header of the response.
+
+        :type attempt: int
+        :type status_code: int
+        :type retry_after: str
+
+        :returns: The number of seconds to wait.
+        :rtype: float
+        """
+        delay = self.retry_policy.get_backoff(attempt, retry_after)
+        if status_code == 429 and self.rate_limiter is not None:
+            self.rate_limiter.pause(delay)
+        return delay
+
+    @classmethod
+    def get_resource_name(cls, url):
+        """Get the resource type of a resource request url.
+
+        :param url: A `string` that specifies the resource request url
+        :type url: str
+
+        :returns: The resource type, `None` if the url is not a resource.
+        :rtype: str
+        """
+        patterns = cls.__dict__.get('_resource_patterns')
+        if patterns is None:
+            patterns = []
+            for scope, found_scope in cls.resources['scopes'].items():
+                for product, found_product in found_scope['products'].items():
+                    for resource, found_resource in found_product['resources'].items():
+                        pattern = re.escape('/%s/%s%s' % (scope, product, found_resource))
+                        patterns.append((re.compile(pattern.replace(':id', '[^/]+') + '$'), resource))
+            cls._resource_patterns = patterns
+
+        for pattern, resource in patterns:
+            if pattern.match(url):
+                return resource
+        return None
+
+    def check_resource_validity(self, scope, product, resource):
+        """Checks whether the resource exists
+
+        :param scope: A `string` that specifies the resource scope
+        :param product: A `string` that specifies the product type
+        :param resource: A `string` that specifies the resource type
+
+        :type scope: str
+        :type product: str
+        :type resource: str
+
+        :returns: An `string` that represents the resource request url
+        :rtype: string
+        """
+        if scope not in self.resources['scopes'].keys():
+            raise GeneralError('invalid scope', 'Invalid scope name')
+        found_scope = self.resources['scopes'][scope]
+        if product not in found_scope['products'].keys():
+            raise GeneralError('invalid product', 'Invalid product name')
+        found_product = found_scope['products'][product]
+        if resource not in found_product['resources'].keys():
+            raise GeneralError('invalid resource', 'Invalid resource name')
+        found_resource = found_product['resources'][resource]
+
+        return '/%s/%s%s' % (scope, product, found_resource)
+
+    def handle_id(self, url, resource_id):
+        """Replaces the :id pattern in the url
+
+        :param url: A `string` that specifies the resource request url
+        :param resource_id: A `string` that specifies the resource id
+
+        :type url: str
+        :type resource_id: str
+
+        :returns: An `string` that represents the resource request url
+        :rtype: string
+        """
+        if resource_id is not None:
+            if resource_id == '':
+                raise GeneralError('invalid id', 'Invalid resource ID')
+            if resource_id == '*':
+                resource_id = '%2A'
+
+            url = url.replace(':id', str(resource_id))
+
+        return url
+
+    def count_duplicates(self, dropped):
+        """Add to the number of repeated items removed by the iterators."""
+        with self._lock:
+            self.dropped_duplicates += dropped
+
+    def emit_page(self, url, items, has_more, cursor, duplicates=0):
+        """Emit the event of a page of `items` items, after removing `duplicates` repeated items."""
+        self.emit({
+            'type': 'page', 'url': url, 'items': items, 'has_more': has_more, 'cursor': cursor,
+            'duplicates': duplicates,
+        })
+
+
+class APIClient(BaseAPIClient):
+
+    """APIClient object.
+
+    Sends blocking requests on a `requests.Session` that threads can share.
+
+    """
+
+    def __init__(self, client_key, secret_key, session=None, pool_connections=10, pool_maxsize=10,
+                 timeout=None, keep_alive=True, retry_policy=None, rate_limiter=None, cache=None,
+                 json_decoder=None, decode_executor=None, coalesce=False):
+        """Initialize an APIClient object.
+
+        Every client owns its HTTP session, so its connection pool can be sized for the
+        number of threads using it. Pass `session` to share one between clients instead.
+
+        :param client_key: The client key of the credentials.
+        :param secret_key: The secret key of the credentials.
+        :param session: A `requests.Session` to use instead of creating one.
+        :param pool_connections: The number of connection pools to cache.
+        :param pool_maxsize: The maximum number of connections kept per pool.
+        :param timeout: The timeout in seconds of a request, a `(connect, read)` tuple or `None`.
+        :param keep_alive: A `boolean` that specifies whether connections are reused.
+        :param retry_policy: A `RetryPolicy` for failed requests, by default requests are not retried.
+        :param rate_limiter: A `RateLimiter` that every request waits for, it can be shared between clients.
+        :param cache: A `ResponseCache` for the responses of the resources it has a time to live for.
+        :param json_decoder: A function that decodes the `bytes` of a body, or the name of a backend
+            for `get_json_decoder`, by default the standard library.
+        :param decode_executor: A `concurrent.futures.Executor` that decodes the bodies, so parsing
+            runs on other threads or processes than the requests.
+        :param coalesce: A `boolean` that specifies whether identical requests sent at the same time
+            share one request, see `SingleFlight`.
+
+        :type client_key: str
+        :type secret_key: str
+        :type session: requests.Session
+        :type pool_connections: int
+        :type pool_maxsize: int
+        :type timeout: float or tuple
+        :type keep_alive: bool
+        :type retry_policy: RetryPolicy
+        :type rate_limiter: RateLimiter
+        :type cache: ResponseCache
+        :type json_decoder: callable or str
+        :type decode_executor: concurrent.futures.Executor
+        :type coalesce: bool
+        """
+        super(APIClient, self).__init__(
+            client_key, secret_key, retry_policy=retry_policy, rate_limiter=rate_limiter,
+            json_decoder=json_decoder, decode_executor=decode_executor)
+        self.timeout = timeout
+        self.keep_alive = keep_alive
+        self.cache = cache
+        self.single_flight = SingleFlight() if coalesce else None
+        self._local = threading.local()
+        self.session = session if session is not None else self.create_session(pool_connections, pool_maxsize)
+
+    def create_session(self, pool_connections=10, pool_maxsize=10):
+        """Create the HTTP session of the client.
+
+        :param pool_connections: The number of connection pools to cache.
+        :param pool_maxsize: The maximum number of connections kept per pool.
+
+        :type pool_connections: int
+        :type pool_maxsize: int
+
+        :returns: A `requests.Session` with the configured connection pool.
+        :rtype: requests.Session
+        """
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return session
+
+    def close(self):
+        """Close the HTTP session of the client."""
+        self.session.close()
+
+    def send_signed_request(self, scope, query_parameters=None):
+        """Send the signed request to the API.
+
+        The request is signed by the client's `RequestSigner`, see
+        `RequestSigner.sign_request` for the signing process. Every request waits for the
+        client's `RateLimiter`, failed requests are retried according to its `RetryPolicy`.
+        With `coalesce`, callers of the same url and query at the same time share one request
+        and the nested data of its response.
+
+        :param scope: The resource relative url to query for data.
+        :param query_parameters: A `dict` of query parameters, defaults to the client's query parameters.
+
+        :type scope: str
+        :type query_parameters: dict
+
+        :returns: A `dict` of the data.
+        :rtype: dict
+        :raises requests.exceptions.HTTPError: if an HTTP error occurred
+        """
+        if self.credentials.client_key is None or self.credentials.secret_key is None:
+            raise GeneralError('Invalid Access Key.', 'The Access Key supplied is invalid.')
+
+        if query_parameters is None:
+            canonical_querystring = self.get_query_parameters()
+        else:
+            canonical_querystring = self.encode_query_parameters(query_parameters)
+
+        ttl = None
+        if self.cache is not None:
+            ttl = self.cache.get_ttl(self.get_resource_name(scope))
+        if ttl:
+            cache_key = scope + '?' + canonical_querystring
+            data = self.cache.get(cache_key)
+            if data is None:
+                data = self._send_shared(scope, canonical_querystring)
+                self.cache.set(cache_key, data, ttl)
+            return data
+
+        return self._send_shared(scope, canonical_querystring)
+
+    def _send_shared(self, scope, canonical_querystring):
+        if self.single_flight is None:
+            return self._send(scope, canonical_querystring)
+        data = self.single_flight.do(
+            scope + '?' + canonical_querystring, lambda: self._send(scope, canonical_querystring))
+        # Every caller gets its own top level, so replacing a key does not affect the others.
+        return dict(data) if isinstance(data, dict) else data
+
+    def _send(self, scope, canonical_querystring, stream=False, defer=False):
+        """Sign and send a request, retrying it according to the retry policy.
+
+        With `stream`, the response is returned before its body is read instead of the decoded body.
+        With `defer`, the response is returned after its body is read, undecoded.
+        """
+        request_url = self.host_protocol + self.host + scope + '?' + canonical_querystring
+
+        attempt = 0
+        while True:
+            if self.rate_limiter is not None:
+                self.rate_limiter.acquire()
+
+            # The timings are only taken when there are hooks to report them to. The hooks are read
+            # once, another thread may add one while the request is signed.
+            event = None
+            hooks = self.hooks
+            if hooks:
+                started = time.perf_counter()
+
+            # Sign every attempt, the date header is part of the signature.
+            headers = self.signer.sign_request(scope, canonical_querystring, self.host, self.method)
+            if not self.keep_alive:
+                headers['Connection'] = 'close'
+
+            if hooks:
+                signed = time.perf_counter()
+                event = {
+                    'type': 'request', 'url': scope, 'query': canonical_querystring, 'attempt': attempt,
+                    'status': None, 'error': None, 'bytes': 0, 'timings': {'sign': signed - started},
+                }
+
+            try:
+                r = self.session.get(request_url, headers=headers, timeout=self.timeout, stream=stream)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                if event is not None:
+                    event['error'] = e.__class__.__name__
+                    event['timings']['response'] = time.perf_counter() - signed
+                    self.emit(event)
+                if self.retry_policy is None or not self.retry_policy.should_retry(attempt):
+                    raise
+                delay = self.retry_policy.get_backoff(attempt)
+            else:
+                if event is not None:
+                    received = time.perf_counter()
+                    # The elapsed time runs until the headers are parsed: connecting and the server time.
+                    response_time = r.elapsed.total_seconds()
+                    event['status'] = r.status_code
+                    event['timings']['response'] = response_time
+                    if stream:
+                        event['bytes'] = int(r.headers.get('Content-Length', 0))
+                    else:
+                        event['bytes'] = len(r.content)
+                        event['timings']['download'] = max(0.0, received - signed - response_time)
+
+                if self.retry_policy is None or not self.retry_policy.should_retry(attempt, r.status_code):
+                    # The response size of a page whose size is tuned, see `page_iterator`.
+                    if getattr(self._local, 'measure', False):
+                        self._local.response_bytes = (
+                            int(r.headers.get('Content-Length', 0)) if stream else len(r.content))
+                    if event is None:
+                        r.raise_for_status()
+                        return r if stream or defer else self.decode_response(r)
+                    try:
+                        r.raise_for_status()
+                        data = r if stream or defer else self.decode_response(r)
+                    except Exception as e:
+                        event['error'] = e.__class__.__name__
+                        raise
+                    else:
+                        if not stream and not defer:
+                            event['timings']['decode'] = time.perf_counter() - received
+                        return data
+                    finally:
+                        self.emit(event)
+
+                if event is not None:
+                    event['error'] = 'HTTPError'
+                    self.emit(event)
+                delay = self.get_retry_delay(attempt, r.status_code, r.headers.get('Retry-After'))
+                r.close()
+
+            time.sleep(delay)
+            attempt += 1
+
+    def decode(self, body):
+        """Decode a response body with the client's decoder, on its executor if it has one.
+
+        :param body: The `bytes` of the body.
+        :type body: bytes
+
+        :returns: The decoded data.
+        """
+        decoder = self.json_decoder or json.loads
+        if self.decode_executor is not None:
+            return self.decode_executor.submit(decoder, body).result()
+        return decoder(body)
+
+    def decode_response(self, response):
+        """Decode the body of a `requests` response, with `response.json()` unless a decoder is set."""
+        if self.json_decoder is None and self.decode_executor is None:
+            return response.json()
+        return self.decode(response.content)
+
+    def send_streaming_request(self, scope, page, query_parameters=None, chunk_size=65536):
+        """Send the signed request to the API and decode the items of the response while it arrives.
+
+        :param scope: The resource relative url to query for data.
+        :param page: A `dict` that receives the keys of the response other than `items`.
+        :param query_parameters: A `dict` of query parameters, defaults to the client's query parameters.
+        :param chunk_size: The number of bytes read from the connection at once.
+
+        :type scope: str
+        :type page: dict
+        :type query_parameters: dict
+        :type chunk_size: int
+
+        :returns: A `generator` that yields the items of the response, see `stream_items`.
+        :rtype: generator
+        :raises requests.exceptions.HTTPError: if an HTTP error occurred
+        """
+        if self.credentials.client_key is None or self.credentials.secret_key is None:
+            raise GeneralError('Invalid Access Key.', 'The Access Key supplied is invalid.')
+
+        if query_parameters is None:
+            canonical_querystring = self.get_query_parameters()
+        else:
+            canonical_querystring = self.encode_query_parameters(query_parameters)
+
+        r = self._send(scope, canonical_querystring, stream=True)
+        try:
+            for item in stream_items(r.iter_content(chunk_size), page):
+                yield item
+        finally:
+            r.close()
+
+    def send_raw_request(self, scope, target, page, query_parameters=None, chunk_size=65536):
+        """Send the signed request to the API and copy the response body to `target` undecoded.
+
+        :param scope: The resource relative url to query for data.
+        :param target: A binary file-like object with a `write` method.
+        :param page: A `dict` that receives the `hasMore`, `lastTimestamp` and `count` of the response.
+        :param query_parameters: A `dict` of query parameters, defaults to the client's query parameters.
+        :param chunk_size: The number of bytes read from the connection at once.
+
+        :type scope: str
+        :type target: file
+        :type page: dict
+        :type query_parameters: dict
+        :type chunk_size: int
+
+        :returns: The number of bytes copied, see `copy_page`.
+        :rtype: int
+        :raises requests.exceptions.HTTPError: if an HTTP error occurred
+        """
+        if self.credentials.client_key is None or self.credentials.secret_key is None:
+            raise GeneralError('Invalid Access Key.', 'The Access Key supplied is invalid.')
+
+        if query_parameters is None:
+            canonical_querystring = self.get_query_parameters()
+        else:
+            canonical_querystring = self.encode_query_parameters(query_parameters)
+
+        r = self._send(scope, canonical_querystring, stream=True)
+        try:
+            return copy_page(r.iter_content(chunk_size), target, page)
+        finally:
+            r.close()
+
+    def invalidate_cache(self, scope, product, resource, resource_id=None):
+        """Remove the cached responses of a resource.
+
+        :param scope: A `string` that specifies the resource scope
+        :param product: A `string` that specifies the product type
+        :param resource: A `string` that specifies the resource type
+        :param resource_id: A `string` that specifies the resource id
+
+        :type scope: str
+        :type product: str
+        :type resource: str
+        :type resource_id: str
+
+        :returns: The number of responses removed.
+        :rtype: int
+        """
+        if self.cache is None:
+            return 0
+        url = self.handle_id(self.check_resource_validity(scope, product, resource), resource_id)
+        return self.cache.invalidate(url + '?')
+
+    def page_iterator(self, url, query_parameters=None, deduplicate=True, tuner=None, boundary=None):
+        """Get the result pages of a resource using an iterator.
+
+        The query parameters of the next page are kept by the iterator, so any number of
+        iterations can run on the same client at once.
+
+        With `deduplicate`, the items a page repeats from the end of the page before it are
+        removed, see `BoundaryFilter`, and counted in `dropped_duplicates`.
+
+        With a `tuner`, the `limit` of every page is chosen by the `PageSizeTuner` from the
+        pages before.
+
+        With a `decode_executor`, the next page is requested while a page is decoded, see
+        `_pages_decoded_ahead`, so one page more than is consumed may be requested.
+
+        :param url: A `string` that specifies the resource request url
+        :param query_parameters: A `dict` of query parameters, defaults to the client's query parameters
+        :param deduplicate: A `boolean` that specifies whether repeated items are removed
+        :param tuner: A `PageSizeTuner` that chooses the page sizes
+        :param boundary: A `BoundaryFilter` to continue with, that of an iteration ending at `since`
+
+        :type url: str
+        :type query_parameters: dict
+        :type deduplicate: bool
+        :type tuner: PageSizeTuner
+        :type boundary: BoundaryFilter
+
+        :returns: A `generator` that yields the response of every page.
+        :rtype: generator
+        :raises requests.exceptions.HTTPError: if an HTTP error occurred
+        """
+        query_parameters = self.get_query_parameters_dict(query_parameters)
+        if not deduplicate:
+            boundary = None
+        elif boundary is None:
+            boundary = BoundaryFilter()
+        if tuner is None and self.decode_executor is not None and not self._is_shared(url):
+            pages = self._pages_decoded_ahead(url, query_parameters)
+        else:
+            pages = self._pages_decoded_in_turn(url, query_parameters, tuner)
+        for results in pages:
+            dropped = 0
+            if boundary is not None:
+                items = [item for item in results['items'] if boundary.accept(item)]
+                dropped = len(results['items']) - len(items)
+                results['items'] = items
+                boundary.end_page(results['lastTimestamp'])
+                if dropped:
+                    self.count_duplicates(dropped)
+            if self.hooks:
+                self.emit_page(url, len(results['items']), results['hasMore'], results['lastTimestamp'], dropped)
+            yield results
+
+    def _is_shared(self, url):
+        # Cached and coalesced responses are shared decoded, they cannot be decoded ahead.
+        if self.single_flight is not None:
+            return True
+        return self.cache is not None and bool(self.cache.get_ttl(self.get_resource_name(url)))
+
+    def _pages_decoded_in_turn(self, url, query_parameters, tuner=None):
+        has_more = True
+        while has_more:
+            if tuner is not None:
+                query_parameters['limit'] = tuner.limit
+                self._local.measure, self._local.response_bytes = True, None
+                started = time.perf_counter()
+            results = self.send_signed_request(url, query_parameters)
+            if tuner is not None:
+                self._local.measure = False
+                tuner.observe(len(results['items']), time.perf_counter() - started, self._local.response_bytes)
+            has_more = results['hasMore']
+            yield results
+            query_parameters = self.next_page_parameters(query_parameters, results)
+
+    def _pages_decoded_ahead(self, url, query_parameters):
+        """Request every page while the page before it is decoded on the `decode_executor`.
+
+        The cursor of the next page is picked out of the bytes of a page, see `copy_page`,
+        and checked against the decoded page: when they differ, the page requested ahead
+        is dropped and requested again. A page is only waited for when it is yielded, and
+        an error of the request ahead is raised after the page before it, like `read_ahead`.
+        """
+        pending = self._request_undecoded(url, query_parameters)
+        while pending is not None:
+            decoding, fields, query_parameters = pending
+            next_parameters = None
+            if fields.get('hasMore') and 'lastTimestamp' in fields:
+                next_parameters = self.next_page_parameters(query_parameters, fields)
+            pending, error = self._request_ahead(url, next_parameters)
+            results = decoding.result()
+            if (fields.get('hasMore'), fields.get('lastTimestamp')) != (results['hasMore'], results['lastTimestamp']):
+                next_parameters = None
+                if results['hasMore']:
+                    next_parameters = self.next_page_parameters(query_parameters, results)
+                pending, error = self._request_ahead(url, next_parameters)
+            yield results
+            if error is not None:
+                raise error
+
+    def _request_ahead(self, url, query_parameters):
+        # Returns the request of the next page, or the error it raised, so the page before it is yielded first.
+        if query_parameters is None:
+            return None, None
+        try:
+            return self._request_undecoded(url, query_parameters), None
+        except Exception as e:
+            return None, e
+
+    def _request_undecoded(self, url, query_parameters):
+        # Returns the future of the decoded page, the paging fields in its bytes and its query parameters.
+        if self.credentials.client_key is None or self.credentials.secret_key is None:
+            raise GeneralError('Invalid Access Key.', 'The Access Key supplied is invalid.')
+        r = self._send(url, self.encode_query_parameters(query_parameters), defer=True)
+        body = r.content
+        fields = {}
+        # The paging fields usually follow the items, so the end of the body is searched first.
+        for start in (max(0, len(body) - 256), 0):
+            for match in PAGE_FIELD_PATTERN.finditer(body, start):
+                fields[match.group(1).decode('ascii')] = json.loads(match.group(2))
+            if 'hasMore' in fields and 'lastTimestamp' in fields or not start:
+                break
+        return self.decode_executor.submit(self.json_decoder or json.loads, body), fields, query_parameters
+
+    def raw_page_iterator(self, url, target, query_parameters=None, chunk_size=65536, separator=b'\n'):
+        """Copy the result pages of a resource to `target` without decoding them.
+
+        The response bodies are written one after the other, each followed by `separator`.
+        Only the paging fields are read from them, see `copy_page`.
+
+        :param url: A `string` that specifies the resource request url
+        :param target: A binary file-like object with a `write` method
+        :param query_parameters: A `dict` of query parameters, defaults to the client's query parameters
+        :param chunk_size: An `int` that specifies the number of bytes read from the connection at once
+        :param separator: The `bytes` written after every page
+
+        :type url: str
+        :type target: file
+        :type query_parameters: dict
+        :type chunk_size: int
+        :type separator: bytes
+
+        :returns: A `generator` that yields a `dict` of the paging fields and the `bytes` of every page.
+        :rtype: generator
+        :raises requests.exceptions.HTTPError: if an HTTP error occurred
+        """
+        query_parameters = self.get_query_parameters_dict(query_parameters)
+        has_more = True
+        while has_more:
+            page = {}
+            page['bytes'] = self.send_raw_request(url, target, page, query_parameters, chunk_size)
+            if separator:
+                target.write(separator)
+            if 'hasMore' not in page or 'lastTimestamp' not in page:
+                raise GeneralError('invalid response', 'The response of %s has no paging fields.' % url)
+            has_more = page['hasMore']
+            if self.hooks:
+                self.emit_page(url, page.get('count', 0), has_more, page['lastTimestamp'])
+            yield page
+            query_parameters = self.next_page_parameters(query_parameters, page)
+
+    def item_iterator(self, url, prefetch=0, query_parameters=None, stream=False, deduplicate=True, tuner=None):
+        """Get items using an iterator.
+
+        With `prefetch`, the pages are requested in a background thread up to `prefetch`
+        pages ahead of the page being consumed. An error is raised once all pages fetched
+        before it have been yielded.
+
+        With `stream`, the items of a page are decoded and yielded while the page arrives, so
+        memory use does not grow with the page size. It cannot be combined with `prefetch`.
+
+        With `deduplicate`, items a page repeats from the end of the page before it are
+        skipped, and with a `tuner` the page sizes adapt to the throughput, see `page_iterator`.
+
+        :param url: A `string` that specifies the resource request url
+        :param prefetch: An `int` that specifies the number of pages to read ahead
+        :param query_parameters: A `dict` of query parameters, defaults to the client's query parameters
+        :param stream: A `boolean` that specifies whether pages are decoded while they arrive
+        :param deduplicate: A `boolean` that specifies whether repeated items are skipped
+        :param tuner: A `PageSizeTuner` that chooses the page sizes
+
+        :type url: str
+        :type prefetch: int
+        :type query_parameters: dict
+        :type stream: bool
+        :type deduplicate: bool
+        :type tuner: PageSizeTuner
+
+        :returns: A `generator` that yields the requested data.
+        :rtype: generator
+        :raises requests.exceptions.HTTPError: if an HTTP error occurred
+        """
+        if stream:
+            if prefetch:
+                raise GeneralError('invalid options', 'Streaming cannot be combined with prefetching.')
+            return self._stream_items(url, query_parameters, deduplicate, tuner)
+        return self._iterate_items(url, prefetch, query_parameters, deduplicate, tuner)
+
+    def _stream_items(self, url, query_parameters, deduplicate, tuner):
+        query_parameters = self.get_query_parameters_dict(query_parameters)
+        boundary = BoundaryFilter() if deduplicate else None
+        has_more = True
+        while has_more:
+            page = {}
+            count = dropped = 0
+            if tuner is not None:
+                query_parameters['limit'] = tuner.limit
+                self._local.measure, self._local.response_bytes = True, None
+                started = time.perf_counter()
+            for item in self.send_streaming_request(url, page, query_parameters):
+                if boundary is not None and not boundary.accept(item):
+                    dropped += 1
+                    continue
+                count += 1
+                yield item
+            if tuner is not None:
+                self._local.measure = False
+                # The time of the consumer is included, a slow consumer makes smaller pages.
+                tuner.observe(count + dropped, time.perf_counter() - started, self._local.response_bytes)
+            has_more = page['hasMore']
+            if boundary is not None:
+                boundary.end_page(page['lastTimestamp'])
+                if dropped:
+                    self.count_duplicates(dropped)
+            if self.hooks:
+                self.emit_page(url, count, has_more, page['lastTimestamp'], dropped)
+            query_parameters = self.next_page_parameters(query_parameters, page)
+
+    def _iterate_items(self, url, prefetch, query_parameters, deduplicate, tuner):
+        pages = self.page_iterator(url, query_parameters, deduplicate, tuner)
+        if prefetch:
+            pages = read_ahead(pages, prefetch)
+        for results in pages:
+            for item in results['items']:
+                yield item
+
+    def get_resource(self, scope, product, resource, resource_id=None, iterate=False, prefetch=0,
+                     query_parameters=None, stream=False, tuner=None):
+        """Retrieves resources of the specified type
+
+        :param scope: A `string` that specifies the resource scope
+        :param product: A `string` that specifies the product type
+        :param resource: A `string` that specifies the resource type
+        :param resource_id: A `string` that specifies the resource id
+        :param iterate: A `boolean` that specifies whether the you want to use an iterator
+        :param prefetch: An `int` that specifies the number of pages the iterator reads ahead
+        :param query_parameters: A `dict` of query parameters, defaults to the client's query parameters
+        :param stream: A `boolean` that specifies whether the iterator decodes pages while they arrive
+        :param tuner: A `PageSizeTuner` that chooses the page sizes of the iterator
+
+        :type scope: str
+        :type product: str
+        :type resource: str
+        :type resource_id: str
+        :type iterate: bool
+        :type prefetch: int
+        :type query_parameters: dict
+        :type stream: bool
+        :type tuner: PageSizeTuner
+
+        :returns: A `generator` that yields the requested data or a single resource
+        :rtype: generator or single resource
+        """
+        url = self.handle_id(self.check_resource_validity(scope, product, resource), resource_id)
+
+        if iterate:
+            return self.item_iterator(url, prefetch=prefetch, query_parameters=query_parameters, stream=stream,
+                                      tuner=tuner)
+        else:
+            return self.send_signed_request(url, query_parameters)
+
+    def get_campaign_result_batches(self, scope, product, campaign_id, fields, batch_size=10000,
+                                    query_parameters=None, schema=None):
+        """Retrieves the results of a campaign as batches of columns
+
+        The results are decoded while the pages arrive and only the requested `fields` of
+        every result are kept, in a `ColumnBatch` of up to `batch_size` results. The column
+        types come from the campaign result schema, which is requested once for products
+        that have it, see `get_schema_field_types`.
+
+        :param scope: A `string` that specifies the resource scope
+        :param product: A `string` that specifies the product type
+        :param campaign_id: A `string` that specifies the campaign id
+        :param fields: A `list` of the field paths to keep, such as `date` or `data.nps`
+        :param batch_size: An `int` that specifies the number of results per batch
+        :param query_parameters: A `dict` of query parameters, defaults to the client's query parameters
+        :param schema: The campaign result schema, requested when `None`
+
+        :type scope: str
+        :type product: str
+        :type campaign_id: str
+        :type fields: list
+        :type batch_size: int
+        :type query_parameters: dict
+        :type schema: dict
+
+        :returns: A `generator` that yields a `ColumnBatch` per `batch_size` results.
+        :rtype: generator
+        :raises requests.exceptions.HTTPError: if an HTTP error occurred
+        """
+        if batch_size < 1:
+            raise GeneralError('invalid batch size', 'The batch size must be at least 1.')
+        products = self.resources['scopes'].get(scope, {}).get('products', {})
+        if schema is None and self.RESOURCE_CAMPAIGN_RESULT_SCHEMA in products.get(product, {}).get('resources', {}):
+            schema = self.get_resource(scope, product, self.RESOURCE_CAMPAIGN_RESULT_SCHEMA, campaign_id)
+        types = get_schema_field_types(schema) if schema is not None else {}
+        url = self.handle_id(self.check_resource_validity(scope, product, self.RESOURCE_CAMPAIGN_RESULT), campaign_id)
+
+        return self._column_batches(url, fields, types, batch_size, query_parameters)
+
+    def _column_batches(self, url, fields, types, batch_size, query_parameters):
+        batch = ColumnBatch(fields, types)
+        for item in self.item_iterator(url, query_parameters=query_parameters, stream=True):
+            batch.append(item)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = ColumnBatch(fields, types)
+        if len(batch):
+            yield batch
+
+    def sync(self, scope, product, resource, resource_id=None, store=None, query_parameters=None):
+        """Retrieves the items added since the last committed sync of a resource
+
+        The sync resumes from the cursor committed in `store` for the resource and yields
+        a `SyncBatch` per page. A batch is only committed when its `commit` method is
+        called, so a sync that crashes before that fetches its items again on the next run.
+
+        :param scope: A `string` that specifies the resource scope
+        :param product: A `string` that specifies the product type
+        :param resource: A `string` that specifies the resource type
+        :param resource_id: A `string` that specifies the resource id
+        :param store: A `CheckpointStore` that keeps the committed cursors
+        :param query_parameters: A `dict` of query parameters, defaults to the client's query parameters
+
+        :type scope: str
+        :type product: str
+        :type resource: str
+        :type resource_id: str
+        :type store: CheckpointStore
+        :type query_parameters: dict
+
+        :returns: A `generator` that yields a `SyncBatch` per page.
+        :rtype: generator
+        :raises requests.exceptions.HTTPError: if an HTTP error occurred
+        """
+        if store is None:
+            raise GeneralError('invalid store', 'A checkpoint store is required to sync.')
+        url = self.handle_id(self.check_resource_validity(scope, product, resource), resource_id)
+
+        key = (scope, product, resource, resource_id)
+        query_parameters = self.get_query_parameters_dict(query_parameters)
+        cursor = store.get_cursor(key)
+        if cursor is not None:
+            query_parameters['since'] = cursor
+
+        return (
+            SyncBatch(store, key, results['items'], results['lastTimestamp'])
+            for results in self.page_iterator(url, query_parameters)
+        )
+
+    def mirror(self, mirror, scope, product, resource, resource_id=None, query_parameters=None, prefetch=0,
+               batch_size=1000):
+        """Refreshes the copy of a resource in a `SQLiteMirror`
+
+        The items are requested from the newest timestamp stored for the resource, or from
+        the start when it has none, and stored in batches of `batch_size` while they arrive.
+        An item requested again replaces the stored one.
+
+        :param mirror: A `SQLiteMirror` that stores the items
+        :param scope: A `string` that specifies the resource scope
+        :param product: A `string` that specifies the product type
+        :param resource: A `string` that specifies the resource type
+        :param resource_id: A `string` that specifies the resource id
+        :param query_parameters: A `dict` of query parameters, defaults to the client's query parameters
+        :param prefetch: An `int` that specifies the number of pages to read ahead
+        :param batch_size: An `int` that specifies the number of items stored at once
+
+        :type mirror: SQLiteMirror
+        :type scope: str
+        :type product: str
+        :type resource: str
+        :type resource_id: str
+        :type query_parameters: dict
+        :type prefetch: int
+        :type batch_size: int
+
+        :returns: The number of items stored.
+        :rtype: int
+        :raises requests.exceptions.HTTPError: if an HTTP error occurred
+        """
+        key = (scope, product, resource, resource_id)
+        query_parameters = self.get_query_parameters_dict(query_parameters)
+        newest = mirror.get_newest_timestamp(key)
+        if newest is not None:
+            query_parameters['since'] = newest
+
+        stored, batch = 0, []
+        for item in self.get_resource(scope, product, resource, resource_id, iterate=True, prefetch=prefetch,
+                                      query_parameters=query_parameters):
+            batch.append(item)
+            if len(batch) >= batch_size:
+                stored += mirror.store(key, batch)
+                batch = []
+        return stored + mirror.store(key, batch)
+
+    def get_resources_for_ids(self, scope, product, resource, ids, iterate=True, max_workers=8,
+                              preserve_order=False, query_parameters=None):
+        """Retrieves resources of the specified type for many resource IDs at once
+
+        The requests of every resource ID run on a pool of `max_workers` threads. A failing
+        resource ID does not stop the others, the errors are raised together in a
+        `BulkRequestError` once all other items have been yielded.
+
+        :param scope: A `string` that specifies the resource scope
+        :param product: A `string` that specifies the product type
+        :param resource: A `string` that specifies the resource type
+        :param ids: An iterable of the resource ids
+        :param iterate: A `boolean` that specifies whether to iterate over the items of every resource
+        :param max_workers: An `int` that specifies the number of resource ids requested at once
+        :param preserve_order: A `boolean` that specifies whether all items of a resource id are yielded
+            before those of the next one, in the order of `ids`
+        :param query_parameters: A `dict` of query parameters, defaults to the client's query parameters
+
+        :type scope: str
+        :type product: str
+        :type resource: str
+        :type ids: iterable
+        :type iterate: bool
+        :type max_workers: int
+        :type preserve_order: bool
+        :type query_parameters: dict
+
+        :returns: A `generator` that yields `(resource_id, item)` pairs, or `(resource_id, resource)`
+            pairs when not iterating
+        :rtype: generator
+        :raises BulkRequestError: if the requests of some resource ids failed
+        """
+        if max_workers < 1:
+            raise GeneralError('invalid workers', 'The number of workers must be at least 1.')
+        url = self.check_resource_validity(scope, product, resource)
+        urls = [(resource_id, self.handle_id(url, resource_id)) for resource_id in ids]
+
+        query_parameters = self.get_query_parameters_dict(query_parameters)
+        if iterate:
+            jobs = [(resource_id, self._pages_of(url, query_parameters)) for resource_id, url in urls]
+        else:
+            jobs = [(resource_id, self._resource_of(url, query_parameters)) for resource_id, url in urls]
+
+        return self._fan_out(jobs, max_workers, preserve_order)
+
+    def backfill(self, scope, product, resource, resource_id=None, since=0, until=None, windows=4,
+                 max_workers=None, query_parameters=None, buffer_pages=64):
+        """Retrieves the items of a resource in a time range, paging time windows in parallel
+
+        The range is split into `windows` windows that are paged independently on a pool of
+        `max_workers` threads. Every window only keeps the items with a timestamp inside it
+        and stops paging at its upper bound, so no item is yielded twice at the edges. The
+        windows are yielded one after the other, so the items keep their timestamp order.
+        Every window buffers up to `buffer_pages` pages while the windows before it are
+        consumed, which bounds the memory of a backfill to about `windows * buffer_pages`
+        pages; a window that fills its buffer waits.
+
+        :param scope: A `string` that specifies the resource scope
+        :param product: A `string` that specifies the product type
+        :param resource: A `string` that specifies the resource type
+        :param resource_id: A `string` that specifies the resource id
+        :param since: An `int` timestamp in milliseconds, the start of the range (inclusive)
+        :param until: An `int` timestamp in milliseconds, the end of the range (exclusive), defaults to now
+        :param windows: An `int` that specifies the number of time windows
+        :param max_workers: An `int` that specifies the number of windows paged at once, defaults to `windows`
+        :param query_parameters: A `dict` of query parameters, defaults to the client's query parameters
+        :param buffer_pages: An `int` that specifies the number of pages a window reads ahead
+
+        :type scope: str
+        :type product: str
+        :type resource: str
+        :type resource_id: str
+        :type since: int
+        :type until: int
+        :type windows: int
+        :type max_workers: int
+        :type query_parameters: dict
+        :type buffer_pages: int
+
+        :returns: A `generator` that yields the requested data.
+        :rtype: generator
+        :raises requests.exceptions.HTTPError: if an HTTP error occurred
+        """
+        if until is None:
+            until = int(time.time() * 1000)
+        if windows < 1 or since >= until:
+            raise GeneralError('invalid range', 'The time range must be non-empty and split in at least 1 window.')
+        if buffer_pages < 1:
+            raise GeneralError('invalid buffer', 'The number of buffered pages must be at least 1.')
+        url = self.handle_id(self.check_resource_validity(scope, product, resource), resource_id)
+
+        query_parameters = self.get_query_parameters_dict(query_parameters)
+        bounds = [since + (until - since) * i // windows for i in range(windows + 1)]
+        jobs = [
+            ((start, end), self._pages_of(url, query_parameters, start, end))
+            for start, end in zip(bounds, bounds[1:]) if start < end
+        ]
+
+        results = self._fan_out(jobs, max_workers or windows, preserve_order=True, fail_fast=True,
+                                buffer_pages=buffer_pages)
+        return (item for _, item in results)
+
+    def export(self, writer, scope, product, resource, resource_id=None, query_parameters=None, prefetch=0,
+               stream=False, report_interval=10.0):
+        """Writes the items of a resource to an `ExportWriter`
+
+        The items are written while they are paged, so the output is never held in memory
+        as a whole. Every `report_interval` seconds and at the end, the hooks are called with
+        an `export` event with the items, bytes and files written so far and the items per
+        second. The writer is closed when the export ends.
+
+        :param writer: An `ExportWriter` that writes the items
+        :param scope: A `string` that specifies the resource scope
+        :param product: A `string` that specifies the product type
+        :param resource: A `string` that specifies the resource type
+        :param resource_id: A `string` that specifies the resource id
+        :param query_parameters: A `dict` of query parameters, defaults to the client's query parameters
+        :param prefetch: An `int` that specifies the number of pages to read ahead
+        :param stream: A `boolean` that specifies whether items are decoded while a page arrives
+        :param report_interval: A `float` that specifies the seconds between `export` events
+
+        :type writer: ExportWriter
+        :type scope: str
+        :type product: str
+        :type resource: str
+        :type resource_id: str
+        :type query_parameters: dict
+        :type prefetch: int
+        :type stream: bool
+        :type report_interval: float
+
+        :returns: The last `export` event.
+        :rtype: dict
+        :raises requests.exceptions.HTTPError: if an HTTP error occurred
+        """
+        items = self.get_resource(scope, product, resource, resource_id, iterate=True, prefetch=prefetch,
+                                  query_parameters=query_parameters, stream=stream)
+        start = time.perf_counter()
+        next_report = start + report_interval if report_interval else None
+        with writer:
+            for item in items:
+                writer.write(item)
+                if next_report is not None and time.perf_counter() >= next_report:
+                    self.emit(self.export_event(writer, start, False))
+                    next_report += report_interval
+        event = self.export_event(writer, start, True)
+        self.emit(event)
+        return event
+
+    @staticmethod
+    def export_event(writer, start, done):
+        """Get the `export` event of a writer that started at `start`."""
+        seconds = time.perf_counter() - start
+        return {
+            'type': 'export', 'items': writer.items, 'bytes': writer.bytes, 'files': len(writer.files),
+            'seconds': seconds, 'items_per_second': writer.items / seconds if seconds else 0.0, 'done': done,
+        }
+
+    def export_shards(self, store, path, owner=None, writer_class=None, writer_options=None,
+                      query_parameters=None, max_shards=None):
+        """Exports the shards of a `LeaseStore` until none is left, as one of many workers
+
+        Every claimed shard is written to its own files by a `writer_class` writer, at `path`
+        with `{shard}` replaced by the name of the shard. The files are written under a name
+        unique to the attempt and only renamed into place once the shard is completed in the
+        store. The lease is renewed while the shard is paged; when it is lost to another
+        worker, the files of the attempt are removed and the shard is left to that worker.
+        A shard that fails is given back to the store.
+
+        :param store: A `LeaseStore` with the shards
+        :param path: A `string` path of the files of a shard, with `{shard}` in it
+        :param owner: A `string` name of the worker, defaults to the host name and process ID
+        :param writer_class: An `ExportWriter` class, defaults to `NDJSONWriter`
+        :param writer_options: A `dict` of other arguments of the writers
+        :param query_parameters: A `dict` of query parameters, defaults to the client's query parameters
+        :param max_shards: An `int` that specifies the number of shards after which to stop
+
+        :type store: LeaseStore
+        :type path: str
+        :type owner: str
+        :type writer_class: type
+        :type writer_options: dict
+        :type query_parameters: dict
+        :type max_shards: int
+
+        :returns: The number of shards `done`, `failed` and `lost` by this worker, and the `items` written.
+        :rtype: dict
+        """
+        if '{shard}' not in path:
+            raise GeneralError('invalid path', 'The path must contain {shard}.')
+        owner = owner or '%s:%d' % (socket.gethostname(), os.getpid())
+        writer_class = writer_class or NDJSONWriter
+        query_parameters = self.get_query_parameters_dict(query_parameters)
+        summary = {'done': 0, 'failed': 0, 'lost': 0, 'items': 0}
+
+        while max_shards is None or sum(summary[state] for state in ['done', 'failed', 'lost']) < max_shards:
+            job = store.claim(owner)
+            if job is None:
+                break
+            state, items, error = self._export_shard(
+                store, job, owner, path, writer_class, writer_options or {}, query_parameters)
+            summary[state] += 1
+            if state == 'done':
+                summary['items'] += items
+            self.emit({'type': 'shard', 'shard': job['shard'], 'owner': owner, 'state': state,
+                       'items': items, 'error': error})
+        return summary
+
+    def _export_shard(self, store, job, owner, path, writer_class, writer_options, query_parameters):
+        """Export a leased shard and get its state, the number of items and the error."""
+        url = self.handle_id(
+            self.check_resource_validity(job['scope'], job['product'], job['resource']), job['resource_id'])
+        shard_parameters = OrderedDict(query_parameters)
+        if job['until'] is not None:
+            pages = self._pages_of(url, shard_parameters, job['since'] or 0, job['until'])
+        else:
+            if job['since'] is not None:
+                shard_parameters['since'] = job['since']
+            pages = self._pages_of(url, shard_parameters)
+
+        # Another worker that takes the shard over writes its own files, never these.
+        attempt = '%s.tmp-%s' % (job['shard'], os.urandom(6).hex())
+        directory = os.path.dirname(path.replace('{shard}', attempt))
+        writer = None
+        state, error = 'done', None
+        try:
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+            writer = writer_class(path.replace('{shard}', attempt), **writer_options)
+            renewed = time.monotonic()
+            for items in pages():
+                for item in items:
+                    writer.write(item)
+                if time.monotonic() - renewed > store.lease_seconds / 3:
+                    if not store.renew(job['shard'], owner):
+                        state = 'lost'
+                        break
+                    renewed = time.monotonic()
+            if state == 'done':
+                writer.close()
+        except Exception as e:
+            # Any error, of a request, a response body or the writer, gives the shard back.
+            state, error = 'failed', str(e) or e.__class__.__name__
+
+        if state == 'done':
+            files = [name.replace(attempt, job['shard']) for name in writer.files]
+            result = {'items': writer.items, 'bytes': writer.bytes, 'files': files}
+            if store.complete(job['shard'], owner, result):
+                for name, final in zip(writer.files, files):
+                    if not os.path.isdir(os.path.dirname(final) or '.'):
+                        os.makedirs(os.path.dirname(final))
+                    os.replace(name, final)
+                self._remove_attempt(directory, attempt)
+                return state, writer.items, error
+            state = 'lost'
+        elif writer is not None:
+            try:
+                writer.discard()
+            except Exception:
+                # The writer failed already, its files are removed below.
+                pass
+        if state == 'failed':
+            store.release(job['shard'], owner, error)
+        files = writer.files if writer is not None else []
+        for name in files:
+            if os.path.exists(name):
+                os.remove(name)
+        self._remove_attempt(directory, attempt)
+        return state, writer.items if writer is not None else 0, error
+
+    @staticmethod
+    def _remove_attempt(directory, attempt):
+        """Remove the directory of an attempt when `{shard}` is part of the directories of the path."""
+        while attempt in directory and os.path.isdir(directory) and not os.listdir(directory):
+            os.rmdir(directory)
+            directory = os.path.dirname(directory)
+
+    def export_raw(self, target, scope, product, resource, resource_id=None, query_parameters=None,
+                   chunk_size=65536):
+        """Writes the raw response bodies of all pages of a resource to a file
+
+        The pages are copied as they arrive, without decoding, one page per line. See
+        `raw_page_iterator`.
+
+        :param target: A `string` path of the file, or a binary file-like object
+        :param scope: A `string` that specifies the resource scope
+        :param product: A `string` that specifies the product type
+        :param resource: A `string` that specifies the resource type
+        :param resource_id: A `string` that specifies the resource id
+        :param query_parameters: A `dict` of query parameters, defaults to the client's query parameters
+        :param chunk_size: An `int` that specifies the number of bytes read from the connection at once
+
+        :type target: str or file
+        :type scope: str
+        :type product: str
+        :type resource: str
+        :type resource_id: str
+        :type query_parameters: dict
+        :type chunk_size: int
+
+        :returns: A `dict` with the number of `pages` and `bytes` copied and the last `lastTimestamp`.
+        :rtype: dict
+        :raises requests.exceptions.HTTPError: if an HTTP error occurred
+        """
+        url = self.handle_id(self.check_resource_validity(scope, product, resource), resource_id)
+        result = {'pages': 0, 'bytes': 0, 'lastTimestamp': None}
+        with contextlib.ExitStack() as stack:
+            if isinstance(target, str):
+                target = stack.enter_context(open(target, 'wb'))
+            for page in self.raw_page_iterator(url, target, query_parameters, chunk_size):
+                result['pages'] += 1
+                result['bytes'] += page['bytes']
+                result['lastTimestamp'] = page['lastTimestamp']
+        return result
+
+    def _pages_of(self, url, query_parameters, start=None, end=None):
+        """Get a function that pages `url`, optionally within a time window."""
+        def pages():
+            if start is None:
+                for results in self.page_iterator(url, query_parameters):
+                    yield results['items']
+                return
+
+            window_parameters = OrderedDict(query_parameters)
+            window_parameters['since'] = start
+            for results in self.page_iterator(url, window_parameters):
+                # Items without a date are kept in the window that returned them.
+                yield [
+                    item for item in results['items']
+                    if start <= get_item_timestamp(item, start) < end
+                ]
+                if results['lastTimestamp'] >= end:
+                    break
+
+        return pages
+
+    def _resource_of(self, url, query_parameters):
+        """Get a function that requests the single resource `url`."""
+        def pages():
+            yield [self.send_signed_request(url, query_parameters)]
+
+        return pages
+
+    def _fan_out(self, jobs, max_workers, preserve_order, fail_fast=False, buffer_pages=2):
+        """Run `(key, pages)` jobs on a thread pool and yield `(key, item)` pairs.
+
+        Every `pages` function returns an iterable of item lists. Failed jobs are raised
+        together in a `BulkRequestError` at the end, or right away with `fail_fast`. With
+        `preserve_order`, every job buffers up to `buffer_pages` pages until its turn.
+        """
+        stopped = threading.Event()
+        errors = OrderedDict()
+        shared_buffer = queue.Queue(maxsize=2 * max_workers)
+
+        def fetch(key, pages, buffer):
+            try:
+                for items in pages():
+                    if not put_until_stopped(buffer, (key, items), stopped):
+                        return
+            except Exception as e:
+                errors[key] = e
+            finally:
+                put_until_stopped(buffer, (key, None), stopped)
+
+        def done(key):
+            if fail_fast and key in errors:
+                raise errors[key]
+
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+        futures = []
+        try:
+            buffers = [queue.Queue(maxsize=buffer_pages) if preserve_order else shared_buffer for _ in jobs]
+            for (key, pages), buffer in zip(jobs, buffers):
+                futures.append(executor.submit(fetch, key, pages, buffer))
+
+            if preserve_order:
+                for buffer in buffers:
+                    while True:
+                        key, items = buffer.get()
+                        if items is None:
+                            done(key)
+                            break
+                        for item in items:
+                            yield key, item
+            else:
+                remaining = len(jobs)
+                while remaining:
+                    key, items = shared_buffer.get()
+                    if items is None:
+                        done(key)
+                        remaining -= 1
+                        continue
+                    for item in items:
+                        yield key, item
+        finally:
+            stopped.set()
+            for future in futures:
+                future.cancel()
+            executor.shutdown(wait=False)
+
+        if errors:
+            raise BulkRequestError(errors)
+
+
+class ClientPool(object):
+
+    """ClientPool object.
+
+    Manages the clients of many accounts over one connection pool. Every account has its
+    own `RateLimiter`, and the pagination jobs of all accounts run on one pool of threads,
+    which requests the next page of the accounts in turn, so an account with many pages
+    does not hold up the others. An account is skipped while its limiter has no tokens,
+    and has at most its share of the workers busy, so a throttled account cannot keep all
+    workers waiting.
+
+    """
+
+    def __init__(self, accounts, max_workers=8, rate=None, burst=None, **kwargs):
+        """Initialize a ClientPool object.
+
+        :param accounts: A `dict` of account names and their `Credentials` or `(client_key, secret_key)`.
+        :param max_workers: The number of pages requested at once, and the size of the connection pool.
+        :param rate: The requests per second of every account, or a `dict` of it per account, not limited if `None`.
+        :param burst: The maximum number of requests at once of every account, or a `dict` of it per account,
+            defaults to `rate`.
+        :param kwargs: Other arguments of the `APIClient` of every account.
+
+        :type accounts: dict
+        :type max_workers: int
+        :type rate: float or dict
+        :type burst: float or dict
+        """
+        if max_workers < 1:
+            raise GeneralError('invalid workers', 'The number of workers must be at least 1.')
+        self.max_workers = max_workers
+        self.clients = OrderedDict()
+        self.session = kwargs.pop('session', None)
+        for name, credentials in accounts.items():
+            if isinstance(credentials, Credentials):
+                credentials = (credentials.client_key, credentials.secret_key)
+            account_rate = rate.get(name) if isinstance(rate, dict) else rate
+            account_burst = burst.get(name) if isinstance(burst, dict) else burst
+            rate_limiter = RateLimiter(account_rate, account_burst) if account_rate else None
+            client = APIClient(*credentials, session=self.session, pool_maxsize=max_workers,
+                               rate_limiter=rate_limiter, **kwargs)
+            self.session = client.session
+            self.clients[name] = client
+        self._jobs = OrderedDict((name, deque()) for name in self.clients)
+        self._counters = OrderedDict((name, {'pages': 0, 'items': 0, 'errors': 0}) for name in self.clients)
+        self._started = None
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """Close the shared HTTP session."""
+        if self.session is not None:
+            self.session.close()
+
+    def add_hook(self, hook):
+        """Register a hook on the clients of all accounts, see `APIClient.add_hook`."""
+        for client in self.clients.values():
+            client.add_hook(hook)
+
+    def submit(self, account, scope, product, resource, resource_id=None, query_parameters=None):
+        """Add a job that pages a resource of an account, it runs with the other jobs in `run`.
+
+        :param account: The name of the account.
+        :param scope: A `string` that specifies the resource scope
+        :param product: A `string` that specifies the product type
+        :param resource: A `string` that specifies the resource type
+        :param resource_id: A `string` that specifies the resource id
+        :param query_parameters: A `dict` of query parameters, defaults to the client's query parameters
+
+        :type account: str
+        :type scope: str
+        :type product: str
+        :type resource: str
+        :type resource_id: str
+        :type query_parameters: dict
+
+        :returns: The key of the job, `(account, scope, product, resource, resource_id)`.
+        :rtype: tuple
+        """
+        client = self.clients.get(account)
+        if client is None:
+            raise GeneralError('invalid account', 'The account %s is not in the pool.' % account)
+        url = client.handle_id(client.check_resource_validity(scope, product, resource), resource_id)
+        key = (account, scope, product, resource, resource_id)
+        self._jobs[account].append((key, client.page_iterator(url, query_parameters)))
+        return key
+
+    def run(self):
+        """Run the submitted jobs and yield their items as the pages arrive.
+
+        Up to `max_workers` pages are requested at once. A free worker requests the next
+        page of the next account in turn that has a job waiting, that is not waiting for its
+        rate limiter and that has fewer pages in flight than its share of the workers, so
+        the accounts share the workers evenly. A failing job does not stop the others, the errors are raised
+        together in a `BulkRequestError` once all other items have been yielded.
+
+        :returns: A `generator` that yields `(key, item)` pairs, with the key of the job.
+        :rtype: generator
+        :raises BulkRequestError: if some jobs failed
+        """
+        ready, self._jobs = self._jobs, OrderedDict((name, deque()) for name in self.clients)
+        rotation = deque(ready)
+        in_flight = {}
+        running = dict((name, 0) for name in ready)
+        errors = OrderedDict()
+        if self._started is None:
+            self._started = time.monotonic()
+
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers)
+        try:
+            while True:
+                delay = None
+                while len(in_flight) < self.max_workers:
+                    account, delay = self._next_account(ready, rotation, running)
+                    if account is None:
+                        break
+                    key, pages = ready[account].popleft()
+                    running[account] += 1
+                    in_flight[executor.submit(self._next_page, account, pages)] = (account, key, pages)
+                if not in_flight:
+                    if delay is None:
+                        break
+                    time.sleep(delay)
+                    continue
+                done, _ = concurrent.futures.wait(
+                    in_flight, timeout=delay, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    account, key, pages = in_flight.pop(future)
+                    running[account] -= 1
+                    try:
+                        results = future.result()
+                    except Exception as e:
+                        errors[key] = e
+                        continue
+                    if results is None:
+                        continue
+                    ready[account].append((key, pages))
+                    for item in results['items']:
+                        yield key, item
+        finally:
+            for future in in_flight:
+                future.cancel()
+            executor.shutdown(wait=False)
+
+        if errors:
+            raise BulkRequestError(errors)
+
+    def _next_account(self, ready, rotation, running):
+        """Get the next account that can request a page, or `None` and the seconds until one can."""
+        active = sum(1 for account in rotation if ready[account] or running[account])
+        share = max(1, self.max_workers // max(1, active))
+        delay = None
+        for _ in range(len(rotation)):
+            account = rotation[0]
+            rotation.rotate(-1)
+            if not ready[account] or running[account] >= share:
+                continue
+            rate_limiter = self.clients[account].rate_limiter
+            wait = rate_limiter.get_delay() if rate_limiter is not None else 0.0
+            if wait > 0:
+                delay = wait if delay is None else min(delay, wait)
+                continue
+            return account, None
+        return None, delay
+
+    def _next_page(self, account, pages):
+        try:
+            results = next(pages, None)
+        except Exception:
+            with self._lock:
+                self._counters[account]['errors'] += 1
+            raise
+        if results is not None:
+            with self._lock:
+                self._counters[account]['pages'] += 1
+                self._counters[account]['items'] += len(results['items'])
+        return results
+
+    def stats(self):
+        """Get the pages, items, errors and items per second of every account and of all together.
+
+        The throughput is counted from the start of the first `run`.
+
+        :rtype: dict
+        """
+        seconds = time.monotonic() - self._started if self._started is not None else 0.0
+        with self._lock:
+            accounts = OrderedDict((name, dict(counters)) for name, counters in self._counters.items())
+        total = {'pages': 0, 'items': 0, 'errors': 0}
+        for counters in accounts.values():
+            for name in total:
+                total[name] += counters[name]
+            counters['items_per_second'] = counters['items'] / seconds if seconds else 0.0
+        total['items_per_second'] = total['items'] / seconds if seconds else 0.0
+        total['seconds'] = seconds
+        return {'accounts': accounts, 'total': total}
+
+
+class Watcher(object):
+
+    """Watcher object.
+
+    Follows the feeds of many resources and yields their new items. Every feed is polled
+    from its last `lastTimestamp` on a schedule of its own: the poll interval is divided
+    by `factor` after a poll with new items and multiplied by it after a poll without,
+    within `minimum` and `maximum` seconds, so a quiet feed costs one request every
+    `maximum` seconds. Every delay is spread by a random `jitter` fraction, and the first
+    poll of a feed by a random part of `minimum`, so the polls do not fire together.
+
+    """
+
+    def __init__(self, client, store=None, minimum=30.0, maximum=900.0, factor=2.0, jitter=0.1):
+        """Initialize a Watcher object.
+
+        :param client: The `APIClient` that requests the feeds.
+        :param store: A `CheckpointStore` that keeps the cursor of every feed, or `None`.
+        :param minimum: The shortest poll interval in seconds.
+        :param maximum: The longest poll interval in seconds.
+        :param factor: The factor by which the interval shrinks or grows after a poll.
+        :param jitter: The fraction by which every delay is randomly longer or shorter.
+
+        :type client: APIClient
+        :type store: CheckpointStore
+        :type minimum: float
+        :type maximum: float
+        :type factor: float
+        :type jitter: float
+        """
+        if not 0 < minimum <= maximum:
+            raise GeneralError('invalid interval', 'The minimum interval must be positive and at most the maximum.')
+        self.client = client
+        self.store = store
+        self.minimum = minimum
+        self.maximum = maximum
+        self.factor = factor
+        self.jitter = jitter
+        self.clock = time.monotonic
+        self.feeds = OrderedDict()
+        self._schedule = []
+        self._sequence = 0
+        # The sequence of the heap entry of every key, the entries of other sequences are stale.
+        self._scheduled = {}
+        self._stopped = threading.Event()
+
+    def follow(self, scope, product, resource, resource_id=None, query_parameters=None, since=None):
+        """Add a feed, polled from its committed cursor, from `since` or else from now.
+
+        Following a feed again replaces its settings but keeps its next poll.
+
+        :param scope: A `string` that specifies the resource scope
+        :param product: A `string` that specifies the product type
+        :param resource: A `string` that specifies the resource type
+        :param resource_id: A `string` that specifies the resource id
+        :param query_parameters: A `dict` of query parameters, defaults to the client's query parameters
+        :param since: An `int` timestamp in milliseconds of the first items.
+
+        :type scope: str
+        :type product: str
+        :type resource: str
+        :type resource_id: str
+        :type query_parameters: dict
+        :type since: int
+
+        :returns: The key of the feed, `(scope, product, resource, resource_id)`.
+        :rtype: tuple
+        """
+        url = self.client.handle_id(self.client.check_resource_validity(scope, product, resource), resource_id)
+        key = (scope, product, resource, resource_id)
+        cursor = self.store.get_cursor(key) if self.store is not None else None
+        if cursor is None:
+            cursor = since if since is not None else int(time.time() * 1000)
+        self.feeds[key] = {
+            'url': url, 'query_parameters': query_parameters, 'cursor': cursor, 'interval': self.minimum,
+            'boundary': BoundaryFilter(), 'polls': 0, 'items': 0, 'errors': 0,
+        }
+        if key not in self._scheduled:
+            self.schedule(key, random.uniform(0, self.minimum))
+        return key
+
+    def unfollow(self, key):
+        """Remove the feed of a key."""
+        self.feeds.pop(key, None)
+        self._scheduled.pop(key, None)
+
+    def schedule(self, key, delay):
+        """Poll the feed of a key after `delay` seconds, instead of when it was scheduled before."""
+        heapq.heappush(self._schedule, (self.clock() + delay, self._sequence, key))
+        self._scheduled[key] = self._sequence
+        self._sequence += 1
+
+    def stop(self):
+        """Stop the watch, it returns when the current poll is done."""
+        self._stopped.set()
+
+    def wait(self, seconds):
+        """Wait until the next poll is due, or until the watch is stopped."""
+        self._stopped.wait(seconds)
+
+    def watch(self, polls=None):
+        """Poll the feeds when they are due and yield their new items.
+
+        :param polls: The number of polls after which the watch returns, unlimited if `None`.
+        :type polls: int
+
+        :returns: A `generator` that yields `(key, item)` pairs, with the key of the feed.
+        :rtype: generator
+        """
+        self._stopped.clear()
+        done = 0
+        while self._schedule and not self._stopped.is_set() and (polls is None or done < polls):
+            due, sequence, key = self._schedule[0]
+            if self._scheduled.get(key) != sequence:
+                heapq.heappop(self._schedule)
+                continue
+            delay = due - self.clock()
+            if delay > 0:
+                self.wait(delay)
+                continue
+            heapq.heappop(self._schedule)
+            del self._scheduled[key]
+            done += 1
+            for item in self.poll(key):
+                yield key, item
+
+    def run(self, callback, polls=None):
+        """Call `callback` with the key of the feed and the item for every new item, see `watch`."""
+        for key, item in self.watch(polls):
+            callback(key, item)
+
+    def poll(self, key):
+        """Request the new items of a feed and schedule its next poll.
+
+        The cursor of the feed moves on with every page and is committed to the store
+        once the items of the page have been consumed. A failed poll counts as a poll
+        without new items, it is retried after the next interval.
+
+        :param key: The key of the feed.
+        :type key: tuple
+
+        :returns: A `generator` that yields the new items.
+        :rtype: generator
+        """
+        feed = self.feeds[key]
+        query_parameters = self.client.get_query_parameters_dict(feed['query_parameters'])
+        query_parameters['since'] = feed['cursor']
+        count = 0
+        error = None
+        try:
+            for results in self.client.page_iterator(feed['url'], query_parameters, boundary=feed['boundary']):
+                for item in results['items']:
+                    yield item
+                count += len(results['items'])
+                cursor = results.get('lastTimestamp')
+                if cursor is not None and cursor > feed['cursor']:
+                    feed['cursor'] = cursor
+                    if self.store is not None:
+                        self.store.set_cursor(key, cursor)
+        except requests.exceptions.RequestException as e:
+            error = e
+        finally:
+            feed['polls'] += 1
+            feed['items'] += count
+            feed['errors'] += error is not None
+            if count:
+                feed['interval'] = max(self.minimum, feed['interval'] / self.factor)
+            else:
+                feed['interval'] = min(self.maximum, feed['interval'] * self.factor)
+            # The feed may have been unfollowed while its items were consumed.
+            if key in self.feeds:
+                self.schedule(key, feed['interval'] * random.uniform(1 - self.jitter, 1 + self.jitter))
+            if self.client.hooks:
+                self.client.emit({
+                    'type': 'watch', 'key': key, 'url': feed['url'], 'items': count, 'cursor': feed['cursor'],
+                    'interval': feed['interval'], 'error': error.__class__.__name__ if error is not None else None,
+                })
+
+
+class AsyncAPIClient(BaseAPIClient):
+
+    """AsyncAPIClient object.
+
+    An asyncio client that shares the resources and USBL1 signing of the `APIClient`, but
+    none of its blocking methods. `send_signed_request` and `get_resource` are coroutines,
+    `item_iterator` is an async generator. Requests share one `aiohttp.ClientSession` and at most `max_concurrency`
+    requests are in flight at the same time.
+
+    Requires the `aiohttp` package, see the `async` extra.
+
+    """
+
+    def __init__(self, client_key, secret_key, max_concurrency=10, retry_policy=None, rate_limiter=None,
+                 json_decoder=None, decode_executor=None):
+        """Initialize an AsyncAPIClient object.
+
+        :param max_concurrency: The maximum number of requests in flight.
+        :param retry_policy: A `RetryPolicy` for failed requests, by default requests are not retried.
+        :param rate_limiter: A `RateLimiter` that every request waits for, it can be shared between clients.
+        :param json_decoder: A function that decodes the `bytes` of a body, or the name of a backend
+            for `get_json_decoder`, by default the standard library.
+        :param decode_executor: A `concurrent.futures.Executor` that decodes the bodies off the event loop.
+
+        :type max_concurrency: int
+        :type retry_policy: RetryPolicy
+        :type rate_limiter: RateLimiter
+        :type json_decoder: callable or str
+        :type decode_executor: concurrent.futures.Executor
+        """
+        if aiohttp is None:
+            raise GeneralError('missing dependency', 'The AsyncAPIClient requires the aiohttp package.')
+        if max_concurrency < 1:
+            raise GeneralError('invalid concurrency', 'The maximum concurrency must be at least 1.')
+
+        super(AsyncAPIClient, self).__init__(
+            client_key, secret_key, retry_policy=retry_policy, rate_limiter=rate_limiter,
+            json_decoder=json_decoder, decode_executor=decode_executor)
+        self.max_concurrency = max_concurrency
+        # The session is created on the first request, inside the event loop.
+        self.session = None
+        self._semaphore = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    async def close(self):
+        """Close the underlying HTTP session."""
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    def _get_session(self):
+        # The session and semaphore are created lazily so they bind to the running loop.
+        if self.session is None:
+            self.session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.max_concurrency))
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self.session
+
+    async def send_signed_request(self, scope, query_parameters=None):
+        """Send the signed request to the API.
+
+        :param scope: The resource relative url to query for data.
+        :param query_parameters: A `dict` of query parameters, defaults to the client's query parameters.
+
+        :type scope: str
+        :type query_parameters: dict
+
+        :returns: A `dict` of the data.
+        :rtype: dict
+        :raises aiohttp.ClientResponseError: if an HTTP error occurred
+        """
+        if self.credentials.client_key is None or self.credentials.secret_key is None:
+            raise GeneralError('Invalid Access Key.', 'The Access Key supplied is invalid.')
+
+        if query_parameters is None:
+            canonical_querystring = self.get_query_parameters()
+        else:
+            canonical_querystring = self.encode_query_parameters(query_parameters)
+
+        # The url is already encoded, it must be sent exactly as it was signed.
+        request_url = yarl.URL(self.host_protocol + self.host + scope + '?' + canonical_querystring, encoded=True)
+        session = self._get_session()
+
+        attempt = 0
+        while True:
+            if self.rate_limiter is not None:
+                await asyncio.sleep(self.rate_limiter.reserve())
+
+            async with self._semaphore:
+                # The timings are only taken when there are hooks to report them to. The hooks are read
+                # once, another thread may add one while the request is signed.
+                event = None
+                hooks = self.hooks
+                if hooks:
+                    started = time.perf_counter()
+
+                # Sign every attempt, the date header is part of the signature.
+                headers = self.signer.sign_request(scope, canonical_querystring, self.host, self.method)
+
+                if hooks:
+                    signed = time.perf_counter()
+                    event = {
+                        'type': 'request', 'url': scope, 'query': canonical_querystring, 'attempt': attempt,
+                        'status': None, 'error': None, 'bytes': 0, 'timings': {'sign': signed - started},
+                    }
+                try:
+                    async with session.get(request_url, headers=headers) as r:
+                        if self.retry_policy is None or not self.retry_policy.should_retry(attempt, r.status):
+                            if event is None:
+                                r.raise_for_status()
+                                return await self.decode_async(await r.read())
+                            event['status'] = r.status
+                            event['timings']['response'] = time.perf_counter() - signed
+                            try:
+                                r.raise_for_status()
+                                received = time.perf_counter()
+                                body = await r.read()
+                                decoding = time.perf_counter()
+                                data = await self.decode_async(body)
+                            except Exception as e:
+                                event['error'] = e.__class__.__name__
+                                raise
+                            else:
+                                event['bytes'] = len(body)
+                                event['timings']['download'] = decoding - received
+                                event['timings']['decode'] = time.perf_counter() - decoding
+                                return data
+                            finally:
+                                self.emit(event)
+                        if event is not None:
+                            event['status'] = r.status
+                            event['timings']['response'] = time.perf_counter() - signed
+                            event['error'] = 'ClientResponseError'
+                            self.emit(event)
+                        delay = self.get_retry_delay(attempt, r.status, r.headers.get('Retry-After'))
+                except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                    if event is not None:
+                        event['error'] = e.__class__.__name__
+                        self.emit(event)
+                    if self.retry_policy is None or not self.retry_policy.should_retry(attempt):
+                        raise
+                    delay = self.retry_policy.get_backoff(attempt)
+
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    async def decode_async(self, body):
+        """Decode a response body, on the client's executor if it has one."""
+        if self.decode_executor is not None:
+            return await asyncio.get_running_loop().run_in_executor(
+                self.decode_executor, self.json_decoder or json.loads, body)
+        return (self.json_decoder or json.loads)(body)
+
+    async def item_iterator(self, url, query_parameters=None, deduplicate=True):
+        """Get items using an async iterator.
+
+        The query parameters of the pages are kept per iteration, so many iterations can
+        run on the same client at once. With `deduplicate`, items a page repeats from the
+        end of the page before it are skipped, see `BoundaryFilter`.
+
+        :param url: A `string` that specifies the resource request url
+        :param query_parameters: A `dict` of query parameters, defaults to the client's query parameters
+        :param deduplicate: A `boolean` that specifies whether repeated items are skipped
+
+        :type url: str
+        :type query_parameters: dict
+        :type deduplicate: bool
+
+        :returns: An `async generator` that yields the requested data.
+        :rtype: async generator
+        :raises aiohttp.ClientResponseError: if an HTTP error occurred
+        """
+        query_parameters = self.get_query_parameters_dict(query_parameters)
+        boundary = BoundaryFilter() if deduplicate else None
+        has_more = True
+        while has_more:
+            results = await self.send_signed_request(url, query_parameters)
+            has_more = results['hasMore']
+            items, dropped = results['items'], 0
+            if boundary is not None:
+                items = [item for item in items if boundary.accept(item)]
+                dropped = len(results['items']) - len(items)
+                boundary.end_page(results['lastTimestamp'])
+                if dropped:
+                    self.count_duplicates(dropped)
+            if self.hooks:
+                self.emit_page(url, len(items), results['hasMore'], results['lastTimestamp'], dropped)
+            for item in items:
+                yield item
+            query_parameters = self.next_page_parameters(query_parameters, results)
+
+    def get_resource(self, scope, product, resource, resource_id=None, iterate=False, query_parameters=None):
+        """Retrieves resources of the specified type
+
+        Takes the same arguments as `APIClient.get_resource`, except `prefetch`.
+
+        :returns: An `async generator` that yields the requested data or a coroutine of a single resource
+        :rtype: async generator or coroutine
+        """
+        url = self.handle_id(self.check_resource_validity(scope, product, resource), resource_id)
+
+        if iterate:
+            return self.item_iterator(url, query_parameters)
+        else:
+            return self.send_signed_request(url, query_parameters)
+
+
+def main(argv=None):
+    """Export the items of a resource to files, the `usabilla-export` command."""
+    writers = OrderedDict([('ndjson', NDJSONWriter), ('csv', CSVWriter), ('parquet', ParquetWriter)])
+    parser = argparse.ArgumentParser(prog='usabilla-export', description=main.__doc__.split(',')[0] + '.')
+    parser.add_argument('scope', help='live')
+    parser.add_argument('product', help='websites, email or apps')
+    parser.add_argument('resource', help='the resource type, for example feedback')
+    parser.add_argument('resource_id', nargs='?', help='the resource id, * for all, or ids separated by commas with --shards')
+    parser.add_argument('-o', '--output', required=True, help='the path of the output, may contain {part} and {shard}')
+    parser.add_argument('-f', '--format', choices=list(writers) + ['raw'], default='ndjson',
+                        help='raw copies the response bodies undecoded')
+    parser.add_argument('--compression', help='gzip, bz2 or xz, or a Parquet column compression')
+    parser.add_argument('--batch-size', type=int, default=1000, help='items written at once')
+    parser.add_argument('--max-items', type=int, help='items per file')
+    parser.add_argument('--max-bytes', type=int, help='bytes per file')
+    parser.add_argument('--since', type=int, help='timestamp in milliseconds of the first item')
+    parser.add_argument('--until', type=int, help='timestamp in milliseconds after the last item of sharded exports')
+    parser.add_argument('--shards', help='work on the shards of this lease store with the other workers using it')
+    parser.add_argument('--windows', type=int, default=1, help='time windows per resource id of sharded exports')
+    parser.add_argument('--prefetch', type=int, default=2, help='pages read ahead')
+    parser.add_argument('--report-interval', type=float, default=10.0, help='seconds between progress reports')
+    parser.add_argument('--client-key', default=os.environ.get('USABILLA_CLIENT_KEY'))
+    parser.add_argument('--secret-key', default=os.environ.get('USABILLA_SECRET_KEY'))
+    arguments = parser.parse_args(argv)
+    if not arguments.client_key or not arguments.secret_key:
+        parser.error('set --client-key and --secret-key or USABILLA_CLIENT_KEY and USABILLA_SECRET_KEY')
+    if not arguments.shards and arguments.resource_id and ',' in arguments.resource_id:
+        parser.error('export one resource id at a time, or several separated by commas with --shards')
+    if arguments.shards and arguments.windows > 1 and arguments.until is None:
+        parser.error('set --until with --windows, so all workers split the time range alike')
+
+    def report(event):
+        if event['type'] == 'export':
+            sys.stderr.write('%d items, %d bytes, %d files, %.0f items/s%s\n' % (
+                event['items'], event['bytes'], event['files'], event['items_per_second'],
+                ', done' if event['done'] else ''))
+
+    options = {} if arguments.compression is None else {'compression': arguments.compression}
+    resource = (arguments.scope, arguments.product, arguments.resource, arguments.resource_id)
+    query_parameters = {} if arguments.since is None else {'since': arguments.since}
+    try:
+        client = APIClient(arguments.client_key, arguments.secret_key)
+        with contextlib.closing(client):
+            if arguments.format == 'raw':
+                result = client.export_raw(arguments.output, *resource, query_parameters=query_parameters)
+                sys.stderr.write('%d pages, %d bytes, done\n' % (result['pages'], result['bytes']))
+                return 0
+            if arguments.shards:
+                store = LeaseStore(arguments.shards)
+                store.add_shards(*resource[:3], resource_ids=(arguments.resource_id or '*').split(','),
+                                 since=arguments.since, until=arguments.until, windows=arguments.windows)
+                options.update(batch_size=arguments.batch_size, max_items=arguments.max_items,
+                               max_bytes=arguments.max_bytes)
+                result = client.export_shards(store, arguments.output, writer_class=writers[arguments.format],
+                                              writer_options=options)
+                sys.stderr.write('%(done)d shards done, %(failed)d failed, %(lost)d lost, %(items)d items\n' % result)
+                return 0
+            writer = writers[arguments.format](
+                arguments.output, batch_size=arguments.batch_size, max_items=arguments.max_items,
+                max_bytes=arguments.max_bytes, **options)
+            client.add_hook(report)
+            client.export(writer, *resource, query_parameters=query_parameters, prefetch=arguments.prefetch,
+                          report_interval=arguments.report_interval)
+    except GeneralError as error:
+        parser.exit(1, 'usabilla-export: %s\n' % error)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())